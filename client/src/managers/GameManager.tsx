@@ -1,4 +1,4 @@
-import { ReactNode, useEffect, useState } from "react";
+import { ReactNode, useCallback, useEffect, useRef, useState } from "react";
 import {
   Game,
   GameEvent,
@@ -55,6 +55,15 @@ type PlayerNotification = {
   accepts_action: boolean;
 };
 
+type GameDeltaNotification = {
+  base_revision: number;
+  revision: number;
+  game: Partial<GameNotification>;
+  players: PlayerNotification[];
+  removed_players: number[];
+  events: EventNotification[];
+};
+
 type HandNotification = {
   influence_a: PlayerInfluence;
   influence_b: PlayerInfluence;
@@ -74,26 +83,60 @@ function GameManager({ initializing, children }: Props) {
   const [events, setEvents] = useState<EventNotification[]>([]);
   const [hand, setHand] = useState<HandNotification | null>(null);
   const [emitInitGame] = useEventEmitter("initialize_game");
+  const [emitResyncGame] = useEventEmitter("resync_game");
+  const revision = useRef<number | null>(null);
+
+  const setRevision = useCallback((value: number | null) => {
+    revision.current = value;
+    // Sent when reconnecting, so the server only has to send what was missed
+    socket.auth = { ...socket.auth, revision: value ?? undefined };
+  }, []);
 
   useEffect(() => {
     emitInitGame();
-  }, [emitInitGame]);
+    return () => setRevision(null);
+  }, [emitInitGame, setRevision]);
 
   useEffect(() => {
     const handleGame = ({
+      revision: gameRevision,
       game,
       players,
       events,
     }: {
+      revision: number;
       game: GameNotification;
       players: PlayerNotification[];
       events: EventNotification[];
     }) => {
+      setRevision(gameRevision);
       setGame(game);
       setPlayers(players);
       setEvents(events);
     };
 
+    const handleGameDelta = (delta: GameDeltaNotification) => {
+      if (revision.current !== delta.base_revision) {
+        setRevision(null);
+        emitResyncGame();
+        return;
+      }
+      setRevision(delta.revision);
+
+      setGame((game) => (game == null ? game : { ...game, ...delta.game }));
+      setPlayers((players) => {
+        const changed = new Map(delta.players.map((p) => [p.id, p]));
+        const updated = players
+          .filter((p) => !delta.removed_players.includes(p.id))
+          .map((p) => changed.get(p.id) ?? p);
+        const existing = new Set(players.map((p) => p.id));
+        return updated.concat(
+          delta.players.filter((p) => !existing.has(p.id)),
+        );
+      });
+      setEvents((events) => events.concat(delta.events));
+    };
+
     const handleHand = (hand: HandNotification) => {
       setHand(hand);
     };
@@ -101,15 +144,25 @@ function GameManager({ initializing, children }: Props) {
     const handleReset = () => emitInitGame();
 
     socket.on("game", handleGame);
+    socket.on("game_delta", handleGameDelta);
     socket.on("hand", handleHand);
     socket.on("reset", handleReset);
 
     return () => {
       socket.off("game", handleGame);
+      socket.off("game_delta", handleGameDelta);
       socket.off("hand", handleHand);
       socket.off("reset", handleReset);
     };
-  }, [setGame, setPlayers, setEvents, setHand, emitInitGame]);
+  }, [
+    setGame,
+    setPlayers,
+    setEvents,
+    setHand,
+    emitInitGame,
+    emitResyncGame,
+    setRevision,
+  ]);
 
   const gamePlayers = players.map<Player>((p) => ({
     id: p.id,
@@ -1,32 +1,151 @@
 import os
+from typing import Any, Optional
 
-import socketio
 from aiohttp import web
 
+from coup_clone import cluster as coup_cluster
 from coup_clone import db
+from coup_clone.cache import SessionCache
+from coup_clone.cluster import Cluster
+from coup_clone.cluster.pubsub import create_manager
+from coup_clone.db import migrations
+from coup_clone.db.table import Statements, UnitOfWork
+from coup_clone.db.writer import Writer
+from coup_clone.deadlines import DeadlineScheduler
+from coup_clone.engine import GameEngine
+from coup_clone.estimator import WinEstimator
 from coup_clone.handler import Handler
+from coup_clone.instrumentation import (
+    Instrumentation,
+    InstrumentedServer,
+    record_queries,
+    setup_logging,
+)
 from coup_clone.managers.game import GameManager
 from coup_clone.managers.notifications import NotificationsManager
+from coup_clone.managers.queue import QueueManager
 from coup_clone.managers.session import SessionManager
+from coup_clone.reaper import GameReaper
 
 
 async def app_factory():
     allow_origins = os.environ.get("COUP_ALLOW_ORIGINS", None)
-    sio = socketio.AsyncServer(cors_allowed_origins=allow_origins, cookie="coup_session")
+    metrics_path = os.environ.get("COUP_METRICS_PATH", "/metrics")
+    manager = create_manager(coup_cluster.PUBSUB_URL) if coup_cluster.PUBSUB_URL else None
+    sio = InstrumentedServer(cors_allowed_origins=allow_origins, cookie="coup_session", client_manager=manager)
+    cluster: Optional[Cluster] = None
+    if manager is not None:
+        cluster = Cluster(manager, coup_cluster.WORKER_ID)
+
+    log_listener = setup_logging()
+    log_listener.start()
+    db.on_queries(record_queries)
 
     async with db.open() as conn:
-        await db.init(conn)
-        await conn.commit()
+        await migrations.migrate(conn)
+
+    writer = Writer()
+    await writer.start()
+    read_pool = db.ConnectionPool(readonly=True)
+
+    engine = GameEngine(writer, owns=cluster.owns if cluster is not None else None)
+    # Other workers can move a session between games, so its cached game can only be trusted on a single worker
+    session_cache = SessionCache() if cluster is None else None
+    engine.start()
+    deadlines = DeadlineScheduler(read_pool, owns=engine.owns, flush=engine.flush)
+    if cluster is not None:
+        cluster.on_rebalance(engine.release)
+        cluster.on_rebalance(deadlines.recover)
+
+    estimator = WinEstimator()
+    notifications_manager = NotificationsManager(sio, estimator, engine=engine)
+    # Covers games that were reaped, deleted by their last player leaving, or handed to another worker
+    engine.on_evict(notifications_manager.forget)
+    session_manager = SessionManager(sio, notifications_manager, engine, session_cache)
+    game_manager = GameManager(sio, notifications_manager, cluster, deadlines)
+    queue_manager = QueueManager()
+    reaper = GameReaper(writer, read_pool, sio, engine, cluster, session_cache)
+
+    instrumentation = Instrumentation()
+    instrumentation.track("writer", writer)
+    instrumentation.track("read_pool", read_pool)
+    instrumentation.track("engine", engine)
+    instrumentation.track("unit_of_work", UnitOfWork)
+    instrumentation.track("statements", Statements)
+    instrumentation.track("game_queue", queue_manager)
+    instrumentation.track("deadlines", deadlines)
+    instrumentation.track("reaper", reaper)
+    instrumentation.track("estimator", estimator)
+    instrumentation.track("resume", notifications_manager)
+    instrumentation.track("outbox", notifications_manager.outbox)
+    if session_cache is not None:
+        instrumentation.track("session_cache", session_cache)
+    if cluster is not None:
+        instrumentation.track("cluster", cluster)
+
+    async def metrics(_: web.Request) -> web.Response:
+        return web.Response(text=instrumentation.render(), content_type="text/plain", charset="utf-8")
+
+    async def leave_cluster(*_: Any) -> None:
+        if cluster is not None:
+            await cluster.leave()
+
+    async def stop_notifications(*_: Any) -> None:
+        await notifications_manager.stop()
+
+    async def stop_reaper(*_: Any) -> None:
+        await reaper.stop()
+
+    async def stop_deadlines(*_: Any) -> None:
+        await deadlines.stop()
+
+    async def stop_engine(*_: Any) -> None:
+        await engine.stop()
+
+    async def stop_writer(*_: Any) -> None:
+        await writer.stop()
+
+    async def close_pool(*_: Any) -> None:
+        await read_pool.close()
+
+    async def stop_cluster(*_: Any) -> None:
+        if cluster is not None:
+            await cluster.stop()
 
-    notifications_manager = NotificationsManager(sio)
-    session_manager = SessionManager(sio, notifications_manager)
-    game_manager = GameManager(sio, notifications_manager)
+    async def stop_logging(*_: Any) -> None:
+        log_listener.stop()
 
     app = web.Application()
+    app.on_shutdown.append(stop_notifications)
+    app.on_shutdown.append(leave_cluster)
+    app.on_cleanup.append(stop_reaper)
+    app.on_cleanup.append(stop_deadlines)
+    app.on_cleanup.append(stop_engine)
+    app.on_cleanup.append(stop_writer)
+    app.on_cleanup.append(close_pool)
+    app.on_cleanup.append(stop_cluster)
+    app.on_cleanup.append(stop_logging)
+    app.router.add_get(metrics_path, metrics)
     sio.attach(app)
-    sio.register_namespace(Handler(session_manager, game_manager, notifications_manager))
+    sio.register_namespace(
+        Handler(
+            writer,
+            read_pool,
+            session_manager,
+            game_manager,
+            notifications_manager,
+            queue_manager,
+            instrumentation,
+            cluster,
+            engine,
+        )
+    )
+    if cluster is not None:
+        await cluster.start(sio)
+    await deadlines.start()
+    reaper.start()
     return app
 
 
 if __name__ == "__main__":
-    web.run_app(app_factory())
+    web.run_app(app_factory(), port=int(os.environ.get("COUP_PORT", "8080")))
@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import socketio
+
+from coup_clone.actions import get_action
+from coup_clone.db.games import GameState, TurnAction, TurnState
+from coup_clone.db.players import Influence
+
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SERVER_START_TIMEOUT = 30.0
+
+
+class TableAborted(Exception):
+    pass
+
+
+@dataclass
+class EventStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self.latencies.append(seconds)
+        if not ok:
+            self.errors += 1
+
+    def percentile(self, p: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+    def histogram(self) -> list[int]:
+        counts = [0] * (len(BUCKETS_MS) + 1)
+        for seconds in self.latencies:
+            counts[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        return counts
+
+    def summary(self) -> dict:
+        return {
+            "count": len(self.latencies),
+            "errors": self.errors,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": max(self.latencies) * 1000,
+            "histogram": self.histogram(),
+        }
+
+
+@dataclass
+class LoadReport:
+    stats: dict[str, EventStats] = field(default_factory=lambda: defaultdict(EventStats))
+    outcomes: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    elapsed: float = 0
+
+    @property
+    def events(self) -> int:
+        return sum(len(s.latencies) for s in self.stats.values())
+
+    @property
+    def errors(self) -> int:
+        return sum(s.errors for s in self.stats.values())
+
+    def as_dict(self) -> dict:
+        moves = self.stats["take_action"].latencies if "take_action" in self.stats else []
+        return {
+            "elapsed": self.elapsed,
+            "events": self.events,
+            "errors": self.errors,
+            "events_per_second": self.events / self.elapsed,
+            "moves_per_second": len(moves) / self.elapsed,
+            "outcomes": dict(self.outcomes),
+            "buckets_ms": BUCKETS_MS,
+            "events_by_name": {name: s.summary() for name, s in sorted(self.stats.items())},
+        }
+
+
+class Bot:
+    def __init__(self, name: str, url: str, report: LoadReport, timeout: float):
+        self.name = name
+        self.url = url
+        self.report = report
+        self.timeout = timeout
+        self.session: Optional[dict] = None
+        self.game: Optional[dict] = None
+        self.hand: Optional[dict] = None
+        self.leaving = False
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on("session", self._on_session)
+        self.sio.on("game", self._on_game)
+        self.sio.on("game_delta", self._on_game_delta)
+        self.sio.on("hand", self._on_hand)
+
+    async def _on_session(self, data: dict) -> None:
+        self.session = data
+
+    async def _on_game(self, data: dict) -> None:
+        self.game = data
+
+    async def _on_game_delta(self, data: dict) -> None:
+        if self.game is None or self.game["revision"] != data["base_revision"]:
+            self.game = None
+            if not self.leaving:
+                await self.sio.emit("resync_game")
+            return
+
+        players = {p["id"]: p for p in self.game["players"]}
+        for p in data["players"]:
+            players[p["id"]] = p
+        for player_id in data["removed_players"]:
+            players.pop(player_id, None)
+
+        self.game["revision"] = data["revision"]
+        self.game["game"].update(data["game"])
+        self.game["players"] = sorted(players.values(), key=lambda p: p["id"])
+        self.game["events"] += data["events"]
+
+    async def _on_hand(self, data: dict) -> None:
+        self.hand = data
+
+    @property
+    def player_id(self) -> int:
+        if self.session is None:
+            raise TableAborted(f"{self.name} has no session")
+        return self.session["session"]["player_id"]
+
+    def player(self, player_id: int) -> dict:
+        if self.game is None:
+            raise TableAborted(f"{self.name} has no game state")
+        return next(p for p in self.game["players"] if p["id"] == player_id)
+
+    def unrevealed(self) -> list[Influence]:
+        if self.hand is None:
+            raise TableAborted(f"{self.name} has no hand")
+        me = self.player(self.player_id)
+        return [
+            Influence(self.hand[f"influence_{slot}"])
+            for slot in ("a", "b")
+            if me[f"influence_{slot}"] == Influence.UNKNOWN
+        ]
+
+    async def connect(self) -> None:
+        start = time.perf_counter()
+        try:
+            await self.sio.connect(self.url, transports=["websocket"], wait_timeout=self.timeout)
+        except Exception as e:
+            self.report.stats["connect"].record(time.perf_counter() - start, False)
+            raise TableAborted(f"{self.name} failed to connect") from e
+        self.report.stats["connect"].record(time.perf_counter() - start, True)
+
+    async def call(self, event: str, *args: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            response = await self.sio.call(event, args[0] if args else None, timeout=self.timeout)
+        except socketio.exceptions.TimeoutError as e:
+            self.report.stats[event].record(time.perf_counter() - start, False)
+            raise TableAborted(f"{self.name} timed out on {event}") from e
+
+        ok = response is not None and response["status"] == "success"
+        self.report.stats[event].record(time.perf_counter() - start, ok)
+        if not ok:
+            raise TableAborted(f"{self.name} failed {event}: {response}")
+        return response.get("data", None)
+
+
+class Table:
+    def __init__(self, bots: list[Bot], rng: random.Random, max_turns: int, think: float):
+        self.bots = bots
+        self.rng = rng
+        self.max_turns = max_turns
+        self.think = think
+        self.view = bots[0]
+
+    def _state(self) -> dict:
+        if self.view.game is None:
+            raise TableAborted("Lost game state")
+        return self.view.game["game"]
+
+    def _bot(self, player_id: Optional[int]) -> Bot:
+        bot = next((b for b in self.bots if b.player_id == player_id), None)
+        if bot is None:
+            raise TableAborted(f"No bot for player {player_id}")
+        return bot
+
+    def _alive(self) -> list[Bot]:
+        return [b for b in self.bots if not self._is_out(b)]
+
+    def _is_out(self, bot: Bot) -> bool:
+        player = self.view.player(bot.player_id)
+        return player["influence_a"] != Influence.UNKNOWN and player["influence_b"] != Influence.UNKNOWN
+
+    async def _act(self, bot: Bot, event: str, *args: Any) -> Any:
+        if self.think > 0:
+            await asyncio.sleep(self.rng.uniform(0, self.think))
+        result = await bot.call(event, *args)
+        # Broadcasts reach the caller before its acknowledgement, so its copy of the game is current
+        self.view = bot
+        return result
+
+    async def _reveal(self, bot: Bot) -> None:
+        if self._is_out(bot):
+            raise TableAborted("stalled")
+        await self._act(bot, "reveal", self.rng.choice(bot.unrevealed()))
+
+    async def _exchange(self, bot: Bot) -> None:
+        # The drawn cards are only sent to the current player, which may not have the latest copy yet
+        await self._act(bot, "initialize_game")
+        if bot.hand is None:
+            raise TableAborted(f"{bot.name} has no hand")
+        cards = bot.unrevealed() + [Influence(i) for i in bot.hand["top_of_deck"]]
+        keep = set(self.rng.sample(range(len(cards)), len(cards) - 2))
+        await self._act(bot, "exchange", [{"influence": c, "selected": i in keep} for i, c in enumerate(cards)])
+
+    async def _take_turn(self, current: Bot) -> None:
+        coins = self.view.player(current.player_id)["coins"]
+        opponents = [b for b in self._alive() if b is not current]
+        actions = [TurnAction.INCOME, TurnAction.FOREIGN_AID, TurnAction.TAX, TurnAction.STEAL, TurnAction.EXCHANGE]
+        if coins >= 3:
+            actions.append(TurnAction.ASSASSINATE)
+        if coins >= 7:
+            actions.append(TurnAction.COUP)
+        action = TurnAction.COUP if coins >= 10 else self.rng.choice(actions)
+        target = None
+        if get_action(action).is_targetted or action == TurnAction.STEAL:
+            target = self.rng.choice(opponents).player_id
+        await self._act(current, "take_action", {"action": action, "target": target})
+
+    async def _respond(self, current: Bot) -> None:
+        state = self._state()
+        action = get_action(TurnAction(state["turn_action"]))
+        others = [b for b in self._alive() if b is not current]
+        choice = self.rng.random()
+
+        if action.influence is not None and choice < 0.2:
+            await self._act(self.rng.choice(others), "challenge")
+        elif action.can_be_blocked_by and choice < 0.4:
+            target = state["turn_target"]
+            blocker = self._bot(target) if target is not None else self.rng.choice(others)
+            await self._act(blocker, "block")
+        else:
+            for bot in others:
+                await self._act(bot, "accept_action")
+
+    async def _resolve_block(self, current: Bot) -> None:
+        if self.rng.random() < 0.5:
+            await self._act(current, "accept_block")
+        else:
+            await self._act(current, "challenge_block")
+
+    async def setup(self) -> None:
+        host, *guests = self.bots
+        for bot in self.bots:
+            await bot.connect()
+
+        await host.call("create_game")
+        if host.session is None or host.session["game_id"] is None:
+            raise TableAborted("Game was not created")
+        for bot in guests:
+            await bot.call("join_game", host.session["game_id"])
+        for bot in self.bots:
+            await bot.call("set_name", bot.name)
+        await host.call("start_game")
+        for bot in self.bots:
+            await bot.call("initialize_game")
+
+    async def play(self) -> str:
+        turns = 0
+        while True:
+            state = self._state()
+            if state["state"] == GameState.FINISHED:
+                return "finished"
+
+            current = self._bot(state["player_turn_id"])
+            match state["turn_state"]:
+                case TurnState.START:
+                    if turns >= self.max_turns:
+                        return "turn_limit"
+                    turns += 1
+                    await self._take_turn(current)
+                case TurnState.ATTEMPTED:
+                    await self._respond(current)
+                case TurnState.BLOCKED:
+                    await self._resolve_block(current)
+                case TurnState.CHALLENGED:
+                    await self._reveal(current)
+                case TurnState.CHALLENGER_REVEALING:
+                    await self._reveal(self._bot(state["turn_challenger"]))
+                case TurnState.BLOCK_CHALLENGED:
+                    await self._reveal(self._bot(state["turn_blocker"]))
+                case TurnState.BLOCK_CHALLENGER_REVEALING:
+                    await self._reveal(self._bot(state["turn_block_challenger"]))
+                case TurnState.TARGET_REVEALING:
+                    await self._reveal(self._bot(state["turn_target"]))
+                case TurnState.EXCHANGING:
+                    await self._exchange(current)
+
+    async def close(self) -> None:
+        for bot in self.bots:
+            if bot.sio.connected:
+                bot.leaving = True
+                try:
+                    await bot.call("leave_game")
+                except TableAborted:
+                    pass
+                await bot.sio.disconnect()
+
+
+async def run_table(index: int, url: str, report: LoadReport, args: argparse.Namespace) -> None:
+    rng = random.Random(f"{args.seed}-{index}")
+    players = rng.randint(args.min_players, args.max_players)
+    bots = [Bot(f"t{index}p{i}", url, report, args.timeout) for i in range(players)]
+    table = Table(bots, rng, args.turns, args.think)
+
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    try:
+        await table.setup()
+        outcome = await table.play()
+    except TableAborted as e:
+        outcome = "stalled" if str(e) == "stalled" else "failed"
+    finally:
+        await table.close()
+    report.outcomes[outcome] += 1
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_for_port(port: int, process: asyncio.subprocess.Process) -> None:
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return
+    raise RuntimeError("Server did not start in time")
+
+
+def serve(port: int) -> None:
+    from aiohttp import web
+
+    from app import app_factory
+
+    web.run_app(app_factory(), host="127.0.0.1", port=port)
+
+
+async def run(args: argparse.Namespace) -> LoadReport:
+    report = LoadReport()
+    process = None
+    url = args.url
+    with tempfile.TemporaryDirectory() as directory:
+        if url is None:
+            port = _free_port()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "benchmarks.load",
+                "--serve",
+                str(port),
+                env={"COUP_LOG_LEVEL": "WARNING", **os.environ, "COUP_DB_PATH": os.path.join(directory, "load.db")},
+                stdout=asyncio.subprocess.DEVNULL,
+            )
+            await _wait_for_port(port, process)
+            url = f"http://127.0.0.1:{port}"
+
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(run_table(i, url, report, args) for i in range(args.tables)))
+            report.elapsed = time.perf_counter() - start
+        finally:
+            if process is not None:
+                process.terminate()
+                await process.wait()
+    return report
+
+
+def print_report(report: LoadReport) -> None:
+    result = report.as_dict()
+    print(f"{'event':<20} {'count':>7} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, s in result["events_by_name"].items():
+        print(
+            f"{name:<20} {s['count']:>7} {s['errors']:>7} "
+            f"{s['p50_ms']:>8.1f} {s['p95_ms']:>8.1f} {s['p99_ms']:>8.1f} {s['max_ms']:>8.1f}"
+        )
+
+    print()
+    labels = [f"<{b}" for b in BUCKETS_MS] + [f">={BUCKETS_MS[-1]}"]
+    print(f"{'histogram (ms)':<20} " + " ".join(f"{label:>6}" for label in labels))
+    for name, s in result["events_by_name"].items():
+        print(f"{name:<20} " + " ".join(f"{c:>6}" for c in s["histogram"]))
+
+    print()
+    print(f"tables:     {result['outcomes']}")
+    print(f"events:     {result['events']} in {result['elapsed']:.1f}s ({result['events_per_second']:.0f}/s)")
+    print(f"moves:      {result['moves_per_second']:.0f}/s")
+    print(f"error rate: {result['errors'] / max(result['events'], 1):.2%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play simulated Coup tables against a server and report latencies")
+    parser.add_argument("--url", help="Server to load, a local one is started when omitted")
+    parser.add_argument("--tables", type=int, default=100)
+    parser.add_argument("--min-players", type=int, default=2)
+    parser.add_argument("--max-players", type=int, default=6)
+    parser.add_argument("--turns", type=int, default=30, help="Turns played per table before leaving")
+    parser.add_argument("--think", type=float, default=0, help="Max random delay in seconds before each event")
+    parser.add_argument("--ramp", type=float, default=1, help="Spread table starts over this many seconds")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve)
+        sys.exit(0)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report.as_dict(), f, indent=2)
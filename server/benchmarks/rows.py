@@ -0,0 +1,126 @@
+import argparse
+import sqlite3
+import sys
+import timeit
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+from coup_clone.db.events import EventsTable
+from coup_clone.db.players import Influence, PlayersTable, PlayerState
+from coup_clone.db.table import Table
+
+
+# The row types and factories as they were before rows were slotted and decoded on access
+@dataclass
+class EagerEventRow:
+    id: int
+    game_id: str
+    time_created: datetime
+    message: str
+
+
+@dataclass
+class EagerPlayerRow:
+    id: int
+    game_id: str
+    state: PlayerState
+    name: Optional[str]
+    coins: int
+    influence_a: Influence
+    influence_b: Influence
+    revealed_influence_a: bool
+    revealed_influence_b: bool
+    host: bool
+    accepts_action: bool
+
+
+def eager_event(cursor: Any, row: tuple) -> EagerEventRow:
+    return EagerEventRow(
+        id=row[0],
+        game_id=row[1],
+        time_created=datetime.fromisoformat(row[2]),
+        message=row[3],
+    )
+
+
+def eager_player(cursor: Any, row: tuple) -> EagerPlayerRow:
+    return EagerPlayerRow(
+        id=row[0],
+        game_id=row[1],
+        state=PlayerState(row[2]),
+        name=row[3],
+        coins=row[4],
+        influence_a=Influence(row[5]),
+        influence_b=Influence(row[6]),
+        revealed_influence_a=row[7],
+        revealed_influence_b=row[8],
+        host=bool(row[9]),
+        accepts_action=row[10],
+    )
+
+
+def _read_events(row: Any) -> None:
+    row.time_created
+
+
+def _read_players(row: Any) -> None:
+    row.state, row.influence_a, row.influence_b
+
+
+def _rows(table: type[Table], count: int) -> list[tuple]:
+    conn = sqlite3.connect(":memory:")
+    conn.execute(table.TABLE_DEFINITION)
+    if table is EventsTable:
+        conn.executemany(
+            "INSERT INTO events (game_id, message) VALUES ('g', ?);", [(f"move {n}",) for n in range(count)]
+        )
+    else:
+        conn.executemany(
+            "INSERT INTO players (game_id, name, influence_a, influence_b) VALUES ('g', ?, 1, 4);",
+            [(f"player {n}",) for n in range(count)],
+        )
+    rows = conn.execute(f'SELECT {", ".join(table.COLUMNS)} FROM {table.TABLE_NAME};').fetchall()
+    conn.close()
+    return rows
+
+
+def _size(row: Any) -> int:
+    return sys.getsizeof(row) + (sys.getsizeof(row.__dict__) if hasattr(row, "__dict__") else 0)
+
+
+def _measure(factory: Callable[..., Any], rows: list[tuple], read: Optional[Callable], repeat: int) -> float:
+    def build() -> None:
+        for row in rows:
+            built = factory(None, row)
+            if read is not None:
+                read(built)
+
+    return min(timeit.repeat(build, number=1, repeat=repeat)) / len(rows)
+
+
+def main(count: int, repeat: int) -> None:
+    cases: list[tuple[str, type[Table], Callable[..., Any], Callable]] = [
+        ("events", EventsTable, eager_event, _read_events),
+        ("players", PlayersTable, eager_player, _read_players),
+    ]
+    print(f"{'table':<8} {'setup':<24} {'ns/row':>8} {'bytes/row':>10}")
+    for name, table, eager, read in cases:
+        rows = _rows(table, count)
+        setups: list[tuple[str, Callable[..., Any], Optional[Callable]]] = [
+            ("before", eager, None),
+            ("before, columns read", eager, read),
+            ("after", table.row_factory, None),
+            ("after, columns read", table.row_factory, read),
+        ]
+        for setup, factory, reader in setups:
+            per_row = _measure(factory, rows, reader, repeat)
+            print(f"{name:<8} {setup:<24} {per_row * 1e9:>8.0f} {_size(factory(None, rows[0])):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the cost of building rows before and after slotted rows")
+    parser.add_argument("--rows", type=int, default=10000, help="Rows built in each measurement")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
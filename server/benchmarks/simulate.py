@@ -0,0 +1,34 @@
+import argparse
+import time
+
+from coup_clone.simulator import simulate, simulate_parallel
+
+
+def main(games: int, players: int, seed: int, workers: int) -> None:
+    started = time.perf_counter()
+    if workers == 1:
+        result = simulate(games, players, seed)
+    else:
+        result = simulate_parallel(games, players, seed, workers or None)
+    elapsed = time.perf_counter() - started
+
+    print(f"games     {result.games}")
+    print(f"finished  {result.finished}")
+    print(f"stalled   {result.stalled}")
+    print(f"games/s   {result.games / elapsed:.0f}")
+    print(f"moves/s   {result.steps / elapsed:.0f}")
+    if result.finished:
+        print(f"moves     {result.steps / result.finished:.1f} per game")
+    print(f"wins      {', '.join(f'seat {seat}: {n}' for seat, n in sorted(result.wins.items()))}")
+    for error, n in result.errors.most_common():
+        print(f"error     {n} x {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play random games through the rules without a database")
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0, help="Processes to play in, 0 for one per core")
+    args = parser.parse_args()
+    main(args.games, args.players, args.seed, args.workers)
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Any, Callable, Coroutine
+
+from aiosqlite import Connection
+
+from coup_clone import db, deck
+from coup_clone.db import migrations
+from coup_clone.db.events import EventsTable
+from coup_clone.db.games import GamesTable
+from coup_clone.db.players import Influence, PlayersTable
+from coup_clone.db.writer import Writer
+
+PLAYERS_PER_GAME = 3
+
+Commit = Callable[[Callable[[Connection], Coroutine[Any, Any, None]]], Coroutine[Any, Any, None]]
+
+
+async def _setup_games(path: str, games: int) -> list[tuple[str, list[int]]]:
+    created = []
+    async with db.open(path) as conn:
+        await migrations.migrate(conn)
+        async with conn.cursor() as cursor:
+            for i in range(games):
+                game = await GamesTable.create(cursor, id=f"g{i}", deck=deck.EMPTY)
+                players = []
+                for _ in range(PLAYERS_PER_GAME):
+                    player = await PlayersTable.create(
+                        cursor, game_id=game.id, influence_a=Influence.DUKE, influence_b=Influence.CONTESSA
+                    )
+                    players.append(player.id)
+                created.append((game.id, players))
+        await conn.commit()
+    return created
+
+
+def _move(game_id: str, player_id: int, n: int) -> Callable[[Connection], Coroutine[Any, Any, None]]:
+    async def run(conn: Connection) -> None:
+        async with conn.cursor() as cursor:
+            await EventsTable.create(cursor, game_id=game_id, message=f"move {n}")
+            await GamesTable.update(cursor, game_id, player_turn_id=player_id)
+            await PlayersTable.update(cursor, player_id, coins=n)
+
+    return run
+
+
+async def _play(commit: Commit, games: list[tuple[str, list[int]]], moves: int) -> float:
+    async def play(game_id: str, players: list[int]) -> None:
+        for n in range(moves):
+            await commit(_move(game_id, players[n % len(players)], n))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(play(game_id, players) for game_id, players in games))
+    return time.perf_counter() - start
+
+
+async def pooled(path: str, games: int, moves: int) -> float:
+    created = await _setup_games(path, games)
+    pool = db.ConnectionPool(path, size=min(games, db.POOL_SIZE))
+
+    async def commit(run: Callable[[Connection], Coroutine[Any, Any, None]]) -> None:
+        async with pool.acquire() as conn:
+            await run(conn)
+            await conn.commit()
+
+    try:
+        return await _play(commit, created, moves)
+    finally:
+        await pool.close()
+
+
+async def grouped(path: str, games: int, moves: int) -> float:
+    created = await _setup_games(path, games)
+    writer = Writer(path)
+    await writer.start()
+    try:
+        return await _play(writer.submit, created, moves)
+    finally:
+        await writer.stop()
+
+
+async def main(concurrency: list[int], moves: int) -> None:
+    journal_mode, synchronous = db.JOURNAL_MODE, db.SYNCHRONOUS
+    setups = [
+        ("pool, rollback journal", "delete", "full", pooled),
+        ("writer, wal", journal_mode, synchronous, grouped),
+    ]
+    print(f"{'setup':<24} {'games':>6} {'moves/s':>10}")
+    for games in concurrency:
+        for name, mode, sync, run in setups:
+            # Connections read these when they are opened
+            db.JOURNAL_MODE, db.SYNCHRONOUS = mode, sync
+            with tempfile.TemporaryDirectory() as directory:
+                elapsed = await run(os.path.join(directory, "bench.db"), games, moves)
+            print(f"{name:<24} {games:>6} {games * moves / elapsed:>10.0f}")
+    db.JOURNAL_MODE, db.SYNCHRONOUS = journal_mode, synchronous
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure committed moves per second for each storage setup")
+    parser.add_argument("--games", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--moves", type=int, default=50, help="Moves played in each game")
+    args = parser.parse_args()
+    asyncio.run(main(args.games, args.moves))
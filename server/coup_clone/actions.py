@@ -69,6 +69,7 @@ ACTIONS = {
         effect=steal,
         next_state=TurnState.START,
         influence=Influence.CAPTAIN,
+        is_targetted=True,
         can_be_blocked_by={
             Influence.CAPTAIN,
             Influence.AMBASSADOR,
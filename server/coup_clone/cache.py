@@ -0,0 +1,74 @@
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+SESSION_CACHE_SIZE = int(os.environ.get("COUP_SESSION_CACHE_SIZE", "10000"))
+
+
+@dataclass(frozen=True)
+class CachedSession:
+    player_id: Optional[int]
+    game_id: Optional[str]
+
+
+@dataclass
+class SessionCacheMetrics:
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class SessionCache:
+    """Which player and game each session is in, so most events can skip looking it up"""
+
+    def __init__(self, size: int = SESSION_CACHE_SIZE):
+        self.size = size
+        self.metrics = SessionCacheMetrics()
+        self._sessions: OrderedDict[str, CachedSession] = OrderedDict()
+        self._games: dict[str, set[str]] = {}
+
+    def get(self, session_id: str) -> Optional[CachedSession]:
+        cached = self._sessions.get(session_id)
+        if cached is None:
+            self.metrics.misses += 1
+            return None
+        self._sessions.move_to_end(session_id)
+        self.metrics.hits += 1
+        return cached
+
+    def put(self, session_id: str, player_id: Optional[int], game_id: Optional[str]) -> None:
+        if self.size <= 0:
+            return
+        self._remove(session_id)
+        self._sessions[session_id] = CachedSession(player_id, game_id)
+        if game_id is not None:
+            self._games.setdefault(game_id, set()).add(session_id)
+        while len(self._sessions) > self.size:
+            self._remove(next(iter(self._sessions)))
+            self.metrics.evictions += 1
+        self.metrics.size = len(self._sessions)
+
+    def invalidate(self, session_id: str) -> None:
+        if self._remove(session_id):
+            self.metrics.invalidations += 1
+            self.metrics.size = len(self._sessions)
+
+    def invalidate_game(self, game_id: str) -> None:
+        # Deleting a game clears sessions.player_id through the players foreign key
+        for session_id in list(self._games.get(game_id, ())):
+            self.invalidate(session_id)
+
+    def _remove(self, session_id: str) -> bool:
+        cached = self._sessions.pop(session_id, None)
+        if cached is None:
+            return False
+        if cached.game_id is not None:
+            sessions = self._games.get(cached.game_id)
+            if sessions is not None:
+                sessions.discard(session_id)
+                if not sessions:
+                    del self._games[cached.game_id]
+        return True
@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional
+
+from socketio import AsyncServer
+
+from coup_clone.instrumentation import logger
+from coup_clone.managers.exceptions import (
+    GameMovingException,
+    UserException,
+    WorkerUnavailableException,
+)
+
+if TYPE_CHECKING:
+    from coup_clone.cluster.pubsub import ClusterManager
+
+PUBSUB_URL = os.environ.get("COUP_PUBSUB_URL", None)
+WORKER_ID = os.environ.get("COUP_WORKER_ID", None) or uuid.uuid4().hex[:8]
+CALL_TIMEOUT = float(os.environ.get("COUP_CLUSTER_CALL_TIMEOUT", "10"))
+HEARTBEAT_INTERVAL = float(os.environ.get("COUP_CLUSTER_HEARTBEAT_INTERVAL", "1"))
+HEARTBEAT_TIMEOUT = float(os.environ.get("COUP_CLUSTER_HEARTBEAT_TIMEOUT", "5"))
+
+# Receives the event name, game id, socket id, coup session id and arguments of a forwarded event
+CallHandler = Callable[[str, str, str, str, list], Awaitable[Any]]
+# Flushes and drops the games this worker no longer owns
+RebalanceHandler = Callable[[], Awaitable[None]]
+# Returns the given games that have a socket connected to this worker
+ConnectedHandler = Callable[[list[str]], list[str]]
+
+
+class ForwardedCallException(Exception):
+    pass
+
+
+class ForwardedUserException(UserException):
+    def __init__(self, response: dict):
+        super().__init__(response["message"])
+        self.response = response
+
+    def as_error_response(self) -> dict:
+        return self.response
+
+
+def owner_of(game_id: str, workers: list[str]) -> str:
+    # Rendezvous hashing, so only the games of a worker that joins or leaves change owner
+    return max(workers, key=lambda w: hashlib.sha1(f"{w}:{game_id}".encode()).digest())
+
+
+@dataclass
+class ClusterMetrics:
+    calls_sent: int = 0
+    calls_received: int = 0
+    call_errors: int = 0
+    call_timeouts: int = 0
+    rooms_forwarded: int = 0
+    workers: int = 1
+    rebalances: int = 0
+    handoffs: int = 0
+
+
+class Cluster:
+    def __init__(
+        self,
+        manager: "ClusterManager",
+        worker_id: str = WORKER_ID,
+        call_timeout: float = CALL_TIMEOUT,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+    ):
+        self.manager = manager
+        self.worker_id = worker_id
+        self.workers = [worker_id]
+        self.call_timeout = call_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.metrics = ClusterMetrics()
+        self.leaving = False
+        self._seen: dict[str, float] = {}
+        self._previous: Optional[list[str]] = None
+        self._taken: set[str] = set()
+        self._handoffs: dict[str, asyncio.Future] = {}
+        self._calls: dict[str, asyncio.Future] = {}
+        self._handler: Optional[CallHandler] = None
+        self._rebalance: list[RebalanceHandler] = []
+        self._connected: Optional[ConnectedHandler] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        manager.cluster = self
+
+    def owner(self, game_id: str) -> str:
+        return owner_of(game_id, self.workers)
+
+    def owns(self, game_id: str) -> bool:
+        return not self.leaving and self.owner(game_id) == self.worker_id
+
+    def handle_calls(self, handler: CallHandler) -> None:
+        self._handler = handler
+
+    def on_rebalance(self, handler: RebalanceHandler) -> None:
+        self._rebalance.append(handler)
+
+    def handle_connected(self, handler: ConnectedHandler) -> None:
+        self._connected = handler
+
+    async def connected(self, game_ids: list[str]) -> set[str]:
+        """Finds which of the games have a player connected to any other worker"""
+        others = [w for w in self.workers if w != self.worker_id]
+        results = await asyncio.gather(
+            *[self.call(w, "connected", "", "", "", [game_ids]) for w in others], return_exceptions=True
+        )
+        connected: set[str] = set()
+        for result in results:
+            # Without an answer every game has to be assumed in use
+            connected.update(game_ids if isinstance(result, BaseException) else result)
+        return connected
+
+    async def start(self, server: AsyncServer) -> None:
+        # python-socketio only starts listening on the first connection, but events can be forwarded here before then
+        server.manager_initialized = True
+        self.manager.initialize()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        # Give the other workers a chance to answer before deciding which games are ours
+        await asyncio.sleep(self.heartbeat_interval)
+
+    async def leave(self) -> None:
+        """Hands every game back to the rest of the cluster before shutting down"""
+        self.leaving = True
+        await self._run_rebalance()
+        try:
+            await self.manager.publish({"method": "coup_leave", "from": self.worker_id})
+        except Exception:
+            # The others will notice once our heartbeats stop
+            logger.exception("leave message failed")
+
+    async def stop(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await self.manager.close()
+
+    def _set_workers(self, workers: list[str]) -> None:
+        workers = sorted(workers)
+        if workers == self.workers:
+            return
+        self._previous = self.workers
+        self._taken = set()
+        self._handoffs = {}
+        self.workers = workers
+        self.metrics.workers = len(workers)
+        self.metrics.rebalances += 1
+        asyncio.create_task(self._run_rebalance())
+
+    async def _run_rebalance(self) -> None:
+        for handler in self._rebalance:
+            try:
+                await handler()
+            except Exception:
+                logger.exception("rebalance failed")
+
+    async def _heartbeat(self) -> None:
+        while True:
+            try:
+                await self.manager.publish({"method": "coup_heartbeat", "from": self.worker_id})
+            except Exception:
+                logger.exception("heartbeat failed")
+            expired = time.monotonic() - self.heartbeat_timeout
+            for worker_id, seen in list(self._seen.items()):
+                if seen < expired:
+                    del self._seen[worker_id]
+            self._set_workers([self.worker_id, *self._seen])
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def receive_heartbeat(self, message: dict) -> None:
+        worker_id = message["from"]
+        if worker_id == self.worker_id:
+            return
+        joined = worker_id not in self._seen
+        self._seen[worker_id] = time.monotonic()
+        if joined:
+            # Answer straight away so a worker that just started learns about us quickly
+            self.manager.publish_nowait({"method": "coup_heartbeat", "from": self.worker_id})
+            self._set_workers([self.worker_id, *self._seen])
+
+    def receive_leave(self, message: dict) -> None:
+        if self._seen.pop(message["from"], None) is not None:
+            self._set_workers([self.worker_id, *self._seen])
+
+    async def take_over(self, game_id: str) -> None:
+        """Waits for the previous owner of a game to flush it after the workers changed"""
+        if self.leaving or not self.owns(game_id):
+            raise GameMovingException(game_id)
+        if self._previous is None or game_id in self._taken:
+            return
+        previous = owner_of(game_id, self._previous)
+        # A worker that left flushed everything before saying so, one that stopped answering can't be waited on
+        if previous != self.worker_id and previous in self._seen:
+            handoff = self._handoffs.get(game_id)
+            if handoff is None:
+                self.metrics.handoffs += 1
+                handoff = asyncio.ensure_future(self.call(previous, "handoff", game_id, "", "", []))
+                self._handoffs[game_id] = handoff
+            try:
+                await asyncio.shield(handoff)
+            except WorkerUnavailableException:
+                pass
+        self._taken.add(game_id)
+
+    async def call(self, worker_id: str, event: str, game_id: str, sid: str, session_id: str, args: list) -> Any:
+        call_id = uuid.uuid4().hex
+        result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = result
+        self.metrics.calls_sent += 1
+        try:
+            await self.manager.publish(
+                {
+                    "method": "coup_call",
+                    "to": worker_id,
+                    "from": self.worker_id,
+                    "id": call_id,
+                    "event": event,
+                    "game_id": game_id,
+                    "sid": sid,
+                    "session_id": session_id,
+                    "args": args,
+                }
+            )
+            return await asyncio.wait_for(result, self.call_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.call_timeouts += 1
+            raise WorkerUnavailableException(worker_id)
+        finally:
+            self._calls.pop(call_id, None)
+
+    async def receive_call(self, message: dict) -> None:
+        self.metrics.calls_received += 1
+        reply = {"method": "coup_reply", "to": message["from"], "id": message["id"]}
+        try:
+            if message["event"] == "handoff":
+                await self._run_rebalance()
+            elif message["event"] == "connected":
+                reply["result"] = self._connected(*message["args"]) if self._connected is not None else []
+            elif self._handler is None:
+                raise ForwardedCallException(f"Worker {self.worker_id} does not accept calls")
+            else:
+                reply["result"] = await self._handler(
+                    message["event"], message["game_id"], message["sid"], message["session_id"], message["args"]
+                )
+        except UserException as e:
+            reply["user_error"] = e.as_error_response()
+        except Exception as e:
+            logger.exception("forwarded call failed", extra={"fields": {"event": message.get("event")}})
+            self.metrics.call_errors += 1
+            reply["error"] = f"{type(e).__name__}: {e}"
+        await self.manager.publish(reply)
+
+    def receive_reply(self, message: dict) -> None:
+        result = self._calls.get(message["id"])
+        if result is None or result.done():
+            return
+        if "user_error" in message:
+            result.set_exception(ForwardedUserException(message["user_error"]))
+        elif "error" in message:
+            result.set_exception(ForwardedCallException(message["error"]))
+        else:
+            result.set_result(message.get("result"))
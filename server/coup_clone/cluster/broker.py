@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import os
+from urllib.parse import urlparse
+
+from coup_clone.cluster import PUBSUB_URL
+from coup_clone.cluster.pubsub import read_frame, write_frame
+
+DEFAULT_SOCKET = "/tmp/coup.sock"
+
+
+async def serve(path: str) -> None:
+    subscribers: set[asyncio.StreamWriter] = set()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscribers.add(writer)
+        try:
+            while True:
+                payload = await read_frame(reader)
+                # Publishers receive their own messages too, as python-socketio expects from Redis
+                for subscriber in list(subscribers):
+                    write_frame(subscriber, payload)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            subscribers.discard(writer)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path)
+    print(f"Broker listening on {path}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    default = urlparse(PUBSUB_URL).path if PUBSUB_URL and PUBSUB_URL.startswith("unix:") else DEFAULT_SOCKET
+    parser = argparse.ArgumentParser(description="Relay pub/sub messages between local coup workers")
+    parser.add_argument("--socket", default=default, help="Path of the UNIX socket to listen on")
+    args = parser.parse_args()
+    asyncio.run(serve(args.socket))
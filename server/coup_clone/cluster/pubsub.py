@@ -0,0 +1,177 @@
+import asyncio
+import pickle
+import struct
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional
+from urllib.parse import urlparse
+
+from socketio import AsyncRedisManager
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+
+if TYPE_CHECKING:
+    from coup_clone.cluster import Cluster
+
+RECONNECT_DELAY = 1.0
+
+_HEADER = struct.Struct("!I")
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(_HEADER.size)
+    return await reader.readexactly(_HEADER.unpack(header)[0])
+
+
+def write_frame(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    writer.write(_HEADER.pack(len(payload)) + payload)
+
+
+class UnixSocketManager(AsyncPubSubManager):
+    """Client for the broker in coup_clone.cluster.broker, a local stand-in for Redis"""
+
+    name = "asyncunixsocket"
+
+    def __init__(self, path: str, channel: str = "socketio", write_only: bool = False, logger: Any = None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connecting: Optional[asyncio.Lock] = None
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self._reader is None or self._writer is None or self._writer.is_closing():
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+            return self._reader, self._writer
+
+    def _reset(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _publish(self, data: Any) -> None:
+        _, writer = await self._connect()
+        write_frame(writer, pickle.dumps(data))
+        await writer.drain()
+
+    async def _listen(self) -> AsyncIterator[bytes]:
+        while True:
+            try:
+                reader, _ = await self._connect()
+                while True:
+                    yield await read_frame(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                self._get_logger().error(f"Lost connection to the broker at {self.path}, retrying")
+                self._reset()
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def close(self) -> None:
+        self._reset()
+
+
+class ClusterManager(AsyncPubSubManager):
+    """Forwards events and room changes for sockets that are connected to other workers"""
+
+    cluster: Optional["Cluster"] = None
+
+    def initialize(self) -> None:
+        self._outbox: asyncio.Queue[tuple[Any, Optional[asyncio.Future]]] = asyncio.Queue()
+        self._sender = asyncio.create_task(self._send())
+        super().initialize()
+
+    async def _send(self) -> None:
+        # Everything is published from one task so messages go out in the order they were sent,
+        # a room change is always seen before a broadcast to that room
+        while True:
+            data, sent = await self._outbox.get()
+            try:
+                await super()._publish(data)
+            except Exception as e:
+                if sent is None:
+                    self._get_logger().exception("Failed to publish message")
+                elif not sent.done():
+                    sent.set_exception(e)
+            else:
+                if sent is not None and not sent.done():
+                    sent.set_result(None)
+
+    async def _publish(self, data: Any) -> None:
+        sent = asyncio.get_running_loop().create_future()
+        self._outbox.put_nowait((data, sent))
+        await sent
+
+    async def publish(self, data: dict) -> None:
+        await self._publish(data)
+
+    def publish_nowait(self, data: dict) -> None:
+        self._outbox.put_nowait((data, None))
+
+    def enter_room(self, sid: str, namespace: str, room: Any, eio_sid: Optional[str] = None) -> None:
+        if eio_sid is not None or self.eio_sid_from_sid(sid, namespace) is not None:
+            super().enter_room(sid, namespace, room, eio_sid=eio_sid)
+            return
+        if self.cluster is not None:
+            self.cluster.metrics.rooms_forwarded += 1
+        self.publish_nowait({"method": "coup_enter_room", "sid": sid, "namespace": namespace, "room": room})
+
+    def leave_room(self, sid: str, namespace: str, room: Any) -> None:
+        if sid in self.rooms.get(namespace, {}).get(room, {}) or self.eio_sid_from_sid(sid, namespace) is not None:
+            super().leave_room(sid, namespace, room)
+            return
+        if self.cluster is not None:
+            self.cluster.metrics.rooms_forwarded += 1
+        self.publish_nowait({"method": "coup_leave_room", "sid": sid, "namespace": namespace, "room": room})
+
+    def _handle_cluster_message(self, data: dict) -> None:
+        match data["method"]:
+            case "coup_call":
+                if self.cluster is not None and data["to"] == self.cluster.worker_id:
+                    asyncio.create_task(self.cluster.receive_call(data))
+            case "coup_reply":
+                if self.cluster is not None and data["to"] == self.cluster.worker_id:
+                    self.cluster.receive_reply(data)
+            case "coup_heartbeat":
+                if self.cluster is not None:
+                    self.cluster.receive_heartbeat(data)
+            case "coup_leave":
+                if self.cluster is not None:
+                    self.cluster.receive_leave(data)
+            case "coup_enter_room":
+                if self.eio_sid_from_sid(data["sid"], data["namespace"]) is not None:
+                    super().enter_room(data["sid"], data["namespace"], data["room"])
+            case "coup_leave_room":
+                super().leave_room(data["sid"], data["namespace"], data["room"])
+
+    async def _listen(self) -> AsyncIterator[Any]:
+        async for message in super()._listen():
+            data = pickle.loads(message) if isinstance(message, bytes) else message
+            if isinstance(data, dict) and str(data.get("method", "")).startswith("coup_"):
+                self._handle_cluster_message(data)
+                continue
+            yield data
+
+    async def close(self) -> None:
+        if getattr(self, "thread", None) is not None:
+            self.thread.cancel()
+        if getattr(self, "_sender", None) is not None:
+            self._sender.cancel()
+        closing = getattr(super(), "close", None)
+        if closing is not None:
+            await closing()
+
+
+class UnixClusterManager(ClusterManager, UnixSocketManager):
+    pass
+
+
+class RedisClusterManager(ClusterManager, AsyncRedisManager):
+    pass
+
+
+def create_manager(url: str) -> ClusterManager:
+    parsed = urlparse(url)
+    if parsed.scheme == "unix":
+        return UnixClusterManager(parsed.path)
+    if parsed.scheme in ("redis", "rediss"):
+        return RedisClusterManager(url)
+    raise ValueError(f"Unsupported pub/sub URL: {url}")
@@ -1,107 +1,231 @@
+import asyncio
 import os
+import pathlib
+import sqlite3
+import time
+import weakref
 from contextlib import asynccontextmanager
-from typing import AsyncIterator
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Optional
 
 import aiosqlite
-from aiosqlite import Connection
+from aiosqlite import Connection, Cursor
 
 from .events import EventsTable
 from .games import GamesTable
 from .players import PlayersTable
 from .sessions import SessionsTable
+from .table import Table
 
 DB_FILE = os.environ.get("COUP_DB_PATH", "./test.db")
-TABLE_DEFINITIONS = [
-    PlayersTable.TABLE_DEFINITION,
-    EventsTable.TABLE_DEFINITION,
-    GamesTable.TABLE_DEFINITION,
-    SessionsTable.TABLE_DEFINITION,
+POOL_SIZE = int(os.environ.get("COUP_DB_POOL_SIZE", "5"))
+POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get("COUP_DB_POOL_HEALTH_CHECK_INTERVAL", "30"))
+JOURNAL_MODE = os.environ.get("COUP_DB_JOURNAL_MODE", "wal")
+SYNCHRONOUS = os.environ.get("COUP_DB_SYNCHRONOUS", "normal")
+CACHE_SIZE_KB = int(os.environ.get("COUP_DB_CACHE_SIZE_KB", "16384"))
+MMAP_SIZE = int(os.environ.get("COUP_DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+BUSY_TIMEOUT_MS = int(os.environ.get("COUP_DB_BUSY_TIMEOUT_MS", "5000"))
+# Compiled statements sqlite keeps per connection, keyed by SQL text, see coup_clone.db.table.Statements
+STATEMENT_CACHE_SIZE = int(os.environ.get("COUP_DB_STATEMENT_CACHE_SIZE", "256"))
+# Only takes effect on a new database, an existing one keeps its mode until a full VACUUM
+AUTO_VACUUM = os.environ.get("COUP_DB_AUTO_VACUUM", "incremental")
+TABLES: list[type[Table]] = [
+    PlayersTable,
+    EventsTable,
+    GamesTable,
+    SessionsTable,
 ]
+TABLE_DEFINITIONS = [table.TABLE_DEFINITION for table in TABLES]
+INDEX_DEFINITIONS = [index for table in TABLES for index in table.INDEX_DEFINITIONS]
 
-TRIGGERS = [
-    """
-    CREATE TRIGGER IF NOT EXISTS check_player_count_in_game
-    BEFORE INSERT
-    ON players
-    WHEN (SELECT COUNT(id) FROM players WHERE game_id = NEW.game_id) >= 6
-    BEGIN
-        SELECT RAISE(FAIL, "Game full");
-    END;
-    """,
-    """
-    CREATE TRIGGER IF NOT EXISTS clear_playerless_games_on_delete
-    AFTER DELETE
-    ON players
-    WHEN (
-        SELECT COUNT(sessions.id)
-        FROM sessions
-        JOIN players ON sessions.player_id = players.id
-        WHERE game_id = OLD.game_id
-    ) = 0
-    BEGIN
-        DELETE FROM games WHERE id = OLD.game_id;
-    END;
-    """,
-    """
-    CREATE TRIGGER IF NOT EXISTS clear_sessionless_games_on_update
-    AFTER UPDATE
-    ON sessions
-    WHEN (
-        SELECT COUNT(sessions.id)
-        FROM sessions
-        JOIN players ON sessions.player_id = players.id
-        WHERE game_id = (
-            SELECT game_id
-            FROM players
-            WHERE id = OLD.player_id
-            LIMIT 1
-        )
-    ) = 0
-    BEGIN
-        DELETE FROM games WHERE id = (
-            SELECT game_id
-            FROM players
-            WHERE id = OLD.player_id
-            LIMIT 1
-        );
-    END;
-    """,
-    """
-    CREATE TRIGGER IF NOT EXISTS clear_sessionless_games_on_delete
-    AFTER DELETE
-    ON sessions
-    WHEN (
-        SELECT COUNT(sessions.id)
-        FROM sessions
-        JOIN players ON sessions.player_id = players.id
-        WHERE game_id = (
-            SELECT game_id
-            FROM players
-            WHERE id = OLD.player_id
-            LIMIT 1
-        )
-    ) = 0
-    BEGIN
-        DELETE FROM games WHERE id = (
-            SELECT game_id
-            FROM players
-            WHERE id = OLD.player_id
-            LIMIT 1
-        );
-    END;
-    """,
-]
+
+async def _setup_connection(db: Connection, readonly: bool = False) -> None:
+    await db.execute("PRAGMA foreign_keys = ON;")
+    await db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    await db.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB};")
+    await db.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+    if not readonly:
+        await db.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM};")
+        await db.execute(f"PRAGMA journal_mode = {JOURNAL_MODE};")
+        await db.execute(f"PRAGMA synchronous = {SYNCHRONOUS};")
+
+
+@dataclass
+class _ConnectionState:
+    statements: int = 0
+    cursor: Optional[Cursor] = None
+    depth: int = 0
+
+    def trace(self, statement: str) -> None:
+        # Statements run by triggers are reported too, prefixed with a comment
+        if not statement.startswith("--"):
+            self.statements += 1
+
+
+_connections: "weakref.WeakKeyDictionary[Connection, _ConnectionState]" = weakref.WeakKeyDictionary()
+# Called with the seconds spent and statements run in each reuse_cursor block, from the task that ran it
+_query_handlers: list[Callable[[float, int], None]] = []
+
+
+def on_queries(handler: Callable[[float, int], None]) -> None:
+    if handler not in _query_handlers:
+        _query_handlers.append(handler)
+
+
+async def connect(path: str = DB_FILE, readonly: bool = False, **kwargs: Any) -> Connection:
+    kwargs.setdefault("cached_statements", STATEMENT_CACHE_SIZE)
+    if readonly:
+        path = f"{pathlib.Path(path).absolute().as_uri()}?mode=ro"
+        kwargs["uri"] = True
+    conn = await aiosqlite.connect(path, iter_chunk_size=64, **kwargs)
+    state = _connections[conn] = _ConnectionState()
+    try:
+        await conn.set_trace_callback(state.trace)
+        await _setup_connection(conn, readonly)
+    except BaseException:
+        await conn.close()
+        raise
+    return conn
+
+
+@asynccontextmanager
+async def reuse_cursor(conn: Connection) -> AsyncIterator[Cursor]:
+    # A connection is only used by one task at a time and results are fetched before the next statement, so one
+    # cursor is kept per connection instead of a trip to its thread to open one and another to close it
+    state = _connections.get(conn)
+    if state is None:
+        async with conn.cursor() as cursor:
+            yield cursor
+        return
+    if state.cursor is None:
+        state.cursor = await conn.cursor()
+    if state.depth > 0 or not _query_handlers:
+        yield state.cursor
+        return
+
+    start = time.perf_counter()
+    statements = state.statements
+    state.depth += 1
+    try:
+        yield state.cursor
+    finally:
+        state.depth -= 1
+        for handler in _query_handlers:
+            handler(time.perf_counter() - start, state.statements - statements)
 
 
 @asynccontextmanager
-async def open() -> AsyncIterator[Connection]:
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("PRAGMA foreign_keys = ON;")
+async def open(path: str = DB_FILE) -> AsyncIterator[Connection]:
+    db = await connect(path)
+    try:
         yield db
+    finally:
+        await db.close()
+
+
+@dataclass
+class PoolMetrics:
+    connections_opened: int = 0
+    connections_closed: int = 0
+    health_checks_failed: int = 0
+    acquired: int = 0
+    released: int = 0
+    in_use: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+
+@dataclass
+class _PooledConnection:
+    conn: Connection
+    last_used: float
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        path: str = DB_FILE,
+        size: int = POOL_SIZE,
+        health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL,
+        readonly: bool = False,
+    ):
+        if size < 1:
+            raise ValueError("Connection pool size must be at least 1")
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self.health_check_interval = health_check_interval
+        self.metrics = PoolMetrics()
+        self._slots = asyncio.Semaphore(size)
+        self._idle: list[_PooledConnection] = []
+        self._closed = False
+
+    async def _connect(self) -> _PooledConnection:
+        conn = await connect(self.path, readonly=self.readonly)
+        self.metrics.connections_opened += 1
+        return _PooledConnection(conn, time.monotonic())
+
+    async def _discard(self, pooled: _PooledConnection) -> None:
+        self.metrics.connections_closed += 1
+        try:
+            await pooled.conn.close()
+        except (sqlite3.Error, ValueError):
+            pass
+
+    async def _is_healthy(self, pooled: _PooledConnection) -> bool:
+        if time.monotonic() - pooled.last_used < self.health_check_interval:
+            return True
+        try:
+            await pooled.conn.execute("SELECT 1")
+            return True
+        except (sqlite3.Error, ValueError):
+            return False
+
+    async def _checkout(self) -> _PooledConnection:
+        while self._idle:
+            pooled = self._idle.pop()
+            if await self._is_healthy(pooled):
+                return pooled
+            self.metrics.health_checks_failed += 1
+            await self._discard(pooled)
+        return await self._connect()
+
+    async def _checkin(self, pooled: _PooledConnection) -> None:
+        try:
+            if pooled.conn.in_transaction:
+                await pooled.conn.rollback()
+        except (sqlite3.Error, ValueError):
+            await self._discard(pooled)
+            return
+
+        if self._closed:
+            await self._discard(pooled)
+            return
+
+        pooled.last_used = time.monotonic()
+        self._idle.append(pooled)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
 
+        started = time.perf_counter()
+        async with self._slots:
+            pooled = await self._checkout()
+            waited = time.perf_counter() - started
+            self.metrics.acquired += 1
+            self.metrics.in_use += 1
+            self.metrics.wait_seconds_total += waited
+            self.metrics.wait_seconds_max = max(self.metrics.wait_seconds_max, waited)
+            try:
+                yield pooled.conn
+            finally:
+                self.metrics.in_use -= 1
+                self.metrics.released += 1
+                await self._checkin(pooled)
 
-async def init(db: Connection) -> None:
-    for table in TABLE_DEFINITIONS:
-        await db.execute(table)
-    for trigger in TRIGGERS:
-        await db.execute(trigger)
+    async def close(self) -> None:
+        self._closed = True
+        while self._idle:
+            await self._discard(self._idle.pop())
@@ -1,12 +1,13 @@
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
 
 from aiosqlite import Cursor, Row
 
 from coup_clone.db.table import Table, TableRow
 
 
-@dataclass
+@dataclass(slots=True)
 class EventRow(TableRow[int]):
     game_id: str
     time_created: datetime
@@ -25,6 +26,9 @@ class EventsTable(Table[EventRow, int]):
             message TEXT NOT NULL
         );
     """
+    INDEX_DEFINITIONS = [
+        "CREATE INDEX IF NOT EXISTS events_game_id_id ON events (game_id, id);",
+    ]
     COLUMNS = ["id", "game_id", "time_created", "message"]
 
     @staticmethod
@@ -35,3 +39,26 @@ class EventsTable(Table[EventRow, int]):
             time_created=datetime.fromisoformat(row[2]),
             message=row[3],
         )
+
+    @classmethod
+    async def query_after(cls, cursor: Cursor, game_id: str, after_id: int) -> list[EventRow]:
+        select = f'SELECT {", ".join(cls.COLUMNS)}'
+        from_table = f"FROM {cls.TABLE_NAME}"
+        where = "WHERE game_id = :game_id AND id > :after_id"
+        query = f"{select} {from_table} {where} ORDER BY id;"
+        async with cls.wrap_row_factory(cursor):
+            await cursor.execute(query, {"game_id": game_id, "after_id": after_id})
+            return await cursor.fetchall()  # type: ignore[return-value]
+
+    @classmethod
+    async def query_before(
+        cls, cursor: Cursor, game_id: str, limit: int, before_id: Optional[int] = None
+    ) -> list[EventRow]:
+        select = f'SELECT {", ".join(cls.COLUMNS)}'
+        from_table = f"FROM {cls.TABLE_NAME}"
+        where = "WHERE game_id = :game_id" + (" AND id < :before_id" if before_id is not None else "")
+        query = f"{select} {from_table} {where} ORDER BY id DESC LIMIT :limit;"
+        async with cls.wrap_row_factory(cursor):
+            await cursor.execute(query, {"game_id": game_id, "before_id": before_id, "limit": limit})
+            rows: list[EventRow] = await cursor.fetchall()  # type: ignore[assignment]
+        return list(reversed(rows))
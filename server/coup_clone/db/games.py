@@ -5,7 +5,7 @@ from typing import Optional
 
 from aiosqlite import Cursor, Row
 
-from coup_clone.db.table import Table, TableRow
+from coup_clone.db.table import Table, TableRow, decoded_on_access
 
 
 class GameState(enum.IntEnum):
@@ -36,10 +36,18 @@ class TurnAction(enum.IntEnum):
     COUP = 6
 
 
-@dataclass()
+@decoded_on_access(
+    state=GameState,
+    turn_action=TurnAction,
+    turn_state=TurnState,
+    turn_state_modified=datetime,
+    turn_state_deadline=datetime,
+)
+@dataclass(slots=True)
 class GameRow(TableRow[str]):
     state: GameState
-    deck: str
+    # Packed by coup_clone.deck
+    deck: int
     player_turn_id: Optional[int]
     turn_action: Optional[TurnAction]
     turn_state: Optional[TurnState]
@@ -58,7 +66,7 @@ class GamesTable(Table[GameRow, str]):
         CREATE TABLE IF NOT EXISTS games (
             id TEXT PRIMARY KEY,
             state INTEGER NOT NULL DEFAULT(0),
-            deck TEXT NOT NULL,
+            deck INTEGER NOT NULL,
             player_turn_id INTEGER REFERENCES players,
             turn_action INTEGER,
             turn_state INTEGER,
@@ -68,7 +76,9 @@ class GamesTable(Table[GameRow, str]):
             block_challenged_by_id INTEGER REFERENCES players,
             turn_state_modified DATETIME,
             turn_state_deadline DATETIME,
-            winner_id INTEGER REFERENCES players
+            winner_id INTEGER REFERENCES players,
+            player_count INTEGER NOT NULL DEFAULT(0),
+            session_count INTEGER NOT NULL DEFAULT(0)
         );
     """
     COLUMNS = [
@@ -91,16 +101,61 @@ class GamesTable(Table[GameRow, str]):
     def row_factory(cursor: Cursor, row: Row) -> GameRow:
         return GameRow(
             id=row[0],
-            state=GameState(row[1]),
+            state=row[1],
             deck=row[2],
             player_turn_id=row[3],
-            turn_action=TurnAction(row[4]) if row[4] is not None else None,
-            turn_state=TurnState(row[5]) if row[5] is not None else None,
+            turn_action=row[4],
+            turn_state=row[5],
             target_id=row[6],
             challenged_by_id=row[7],
             blocked_by_id=row[8],
             block_challenged_by_id=row[9],
-            turn_state_modified=datetime.fromisoformat(row[10]) if row[10] is not None else None,
-            turn_state_deadline=datetime.fromisoformat(row[11]) if row[11] is not None else None,
+            turn_state_modified=row[10],
+            turn_state_deadline=row[11],
             winner_id=row[12],
         )
+
+    @staticmethod
+    async def pending_deadlines(cursor: Cursor) -> list[tuple[str, datetime]]:
+        await cursor.execute(
+            """
+            SELECT id, turn_state_deadline FROM games
+            WHERE state = :state AND turn_state_deadline IS NOT NULL;
+            """,
+            {"state": GameState.RUNNING},
+        )
+        return [(row[0], datetime.fromisoformat(row[1])) for row in await cursor.fetchall()]
+
+    @staticmethod
+    async def idle(cursor: Cursor, cutoff: datetime, after: str, limit: int) -> list[str]:
+        await cursor.execute(
+            """
+            SELECT id FROM games
+            WHERE id > :after AND (turn_state_modified IS NULL OR turn_state_modified < :cutoff)
+            ORDER BY id
+            LIMIT :limit;
+            """,
+            {"after": after, "cutoff": cutoff, "limit": limit},
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+    @staticmethod
+    async def count_children(cursor: Cursor, ids: list[str]) -> tuple[int, int]:
+        placeholders = ", ".join("?" for _ in ids)
+        await cursor.execute(
+            f"""
+            SELECT
+                (SELECT COUNT(*) FROM players WHERE game_id IN ({placeholders})),
+                (SELECT COUNT(*) FROM events WHERE game_id IN ({placeholders}));
+            """,
+            [*ids, *ids],
+        )
+        row = await cursor.fetchone()
+        return (row[0], row[1]) if row is not None else (0, 0)
+
+    @staticmethod
+    async def delete_many(cursor: Cursor, ids: list[str]) -> int:
+        # Players and events go with their game through ON DELETE CASCADE
+        placeholders = ", ".join("?" for _ in ids)
+        await cursor.execute(f"DELETE FROM games WHERE id IN ({placeholders});", ids)
+        return cursor.rowcount
@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from aiosqlite import Connection
+
+from coup_clone import db, deck
+
+BATCH_SIZE = int(os.environ.get("COUP_MIGRATION_BATCH_SIZE", "1000"))
+
+Step = Union[str, Callable[[Connection], Awaitable[None]]]
+
+
+@dataclass
+class Backfill:
+    table: str
+    # Run once per batch with :first and :last bound to an inclusive rowid range
+    statement: str
+    # Skipped when the table has no such column, as in databases created while the first migration made the tables
+    # from their current definitions
+    requires_column: Optional[str] = None
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    steps: list[Step] = field(default_factory=list)
+    backfills: list[Backfill] = field(default_factory=list)
+    # Run once every backfill has finished
+    cleanup: list[Step] = field(default_factory=list)
+
+
+@dataclass
+class MigrationEstimate:
+    migration: Migration
+    rows: int
+    seconds: float
+
+
+async def _column_types(conn: Connection, table: str) -> dict[str, str]:
+    return {row[1]: row[2] for row in await conn.execute_fetchall(f"PRAGMA table_info({table});")}
+
+
+def add_column(table: str, column: str, definition: str) -> Step:
+    async def step(conn: Connection) -> None:
+        if column not in await _column_types(conn, table):
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+    return step
+
+
+def rename_column(table: str, column: str, new_name: str, declared_type: str) -> Step:
+    async def step(conn: Connection) -> None:
+        if (await _column_types(conn, table)).get(column) == declared_type:
+            await conn.execute(f"ALTER TABLE {table} RENAME COLUMN {column} TO {new_name};")
+
+    return step
+
+
+def drop_column(table: str, column: str) -> Step:
+    async def step(conn: Connection) -> None:
+        if column in await _column_types(conn, table):
+            await conn.execute(f"ALTER TABLE {table} DROP COLUMN {column};")
+
+    return step
+
+
+def create_function(name: str, num_params: int, func: Callable[..., Any]) -> Step:
+    async def step(conn: Connection) -> None:
+        await conn.create_function(name, num_params, func, deterministic=True)
+
+    return step
+
+
+def replace_trigger(name: str, definition: str) -> list[Step]:
+    return [f"DROP TRIGGER IF EXISTS {name};", definition]
+
+
+# Written out as they were, a migration must do the same thing however the tables change later
+MIGRATIONS = [
+    Migration(
+        version=1,
+        name="create_tables",
+        steps=[
+            """
+            CREATE TABLE IF NOT EXISTS players (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                game_id INTEGER REFERENCES games
+                    ON DELETE CASCADE
+                    NOT NULL,
+                state INTEGER NOT NULL DEFAULT(0),
+                name TEXT,
+                coins INTEGER NOT NULL DEFAULT(2) CHECK (coins >= 0),
+                influence_a INTEGER NOT NULL,
+                influence_b INTEGER NOT NULL,
+                revealed_influence_a INTEGER NOT NULL DEFAULT(0),
+                revealed_influence_b INTEGER NOT NULL DEFAULT(0),
+                host INTEGER NOT NULL DEFAULT(0),
+                accepts_action INTEGER DEFAULT(0)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                game_id INTEGER REFERENCES games
+                    ON DELETE CASCADE
+                    NOT NULL,
+                time_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                message TEXT NOT NULL
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS games (
+                id TEXT PRIMARY KEY,
+                state INTEGER NOT NULL DEFAULT(0),
+                deck TEXT NOT NULL,
+                player_turn_id INTEGER REFERENCES players,
+                turn_action INTEGER,
+                turn_state INTEGER,
+                target_id INTEGER REFERENCES players,
+                challenged_by_id INTEGER REFERENCES players,
+                blocked_by_id INTEGER REFERENCES players,
+                block_challenged_by_id INTEGER REFERENCES players,
+                turn_state_modified DATETIME,
+                turn_state_deadline DATETIME,
+                winner_id INTEGER REFERENCES players
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                player_id INTEGER REFERENCES players
+                    ON DELETE SET NULL
+            );
+            """,
+        ],
+    ),
+    Migration(
+        version=2,
+        name="create_indexes",
+        steps=[
+            "CREATE INDEX IF NOT EXISTS players_game_id ON players (game_id);",
+            "CREATE INDEX IF NOT EXISTS events_game_id_id ON events (game_id, id);",
+            "CREATE INDEX IF NOT EXISTS sessions_player_id ON sessions (player_id);",
+        ],
+    ),
+    Migration(
+        version=3,
+        name="game_counters",
+        steps=[
+            add_column("games", "player_count", "INTEGER NOT NULL DEFAULT(0)"),
+            add_column("games", "session_count", "INTEGER NOT NULL DEFAULT(0)"),
+            # Cleanup is driven by the player_count and session_count columns on games so that every trigger is a
+            # primary key or index lookup, whatever the table sizes
+            *replace_trigger(
+                "check_player_count_in_game",
+                """
+                CREATE TRIGGER check_player_count_in_game
+                BEFORE INSERT
+                ON players
+                WHEN (SELECT player_count FROM games WHERE id = NEW.game_id) >= 6
+                BEGIN
+                    SELECT RAISE(FAIL, "Game full");
+                END;
+                """,
+            ),
+            *replace_trigger(
+                "count_players_on_insert",
+                """
+                CREATE TRIGGER count_players_on_insert
+                AFTER INSERT
+                ON players
+                BEGIN
+                    UPDATE games SET player_count = player_count + 1 WHERE id = NEW.game_id;
+                END;
+                """,
+            ),
+            # Runs before the foreign key sets sessions.player_id to NULL, which happens
+            # once the player row is already gone and its game can no longer be found
+            *replace_trigger(
+                "count_players_on_delete",
+                """
+                CREATE TRIGGER count_players_on_delete
+                BEFORE DELETE
+                ON players
+                BEGIN
+                    UPDATE games
+                    SET
+                        player_count = player_count - 1,
+                        session_count = session_count - (SELECT COUNT(id) FROM sessions WHERE player_id = OLD.id)
+                    WHERE id = OLD.game_id;
+                END;
+                """,
+            ),
+            *replace_trigger(
+                "clear_playerless_games_on_delete",
+                """
+                CREATE TRIGGER clear_playerless_games_on_delete
+                AFTER DELETE
+                ON players
+                WHEN (SELECT session_count FROM games WHERE id = OLD.game_id) = 0
+                BEGIN
+                    DELETE FROM games WHERE id = OLD.game_id;
+                END;
+                """,
+            ),
+            *replace_trigger(
+                "count_sessions_on_insert",
+                """
+                CREATE TRIGGER count_sessions_on_insert
+                AFTER INSERT
+                ON sessions
+                WHEN NEW.player_id IS NOT NULL
+                BEGIN
+                    UPDATE games
+                    SET session_count = session_count + 1
+                    WHERE id = (SELECT game_id FROM players WHERE id = NEW.player_id);
+                END;
+                """,
+            ),
+            *replace_trigger(
+                "clear_sessionless_games_on_update",
+                """
+                CREATE TRIGGER clear_sessionless_games_on_update
+                AFTER UPDATE OF player_id
+                ON sessions
+                WHEN OLD.player_id IS NOT NEW.player_id
+                BEGIN
+                    UPDATE games
+                    SET session_count = session_count + 1
+                    WHERE id = (SELECT game_id FROM players WHERE id = NEW.player_id);
+                    UPDATE games
+                    SET session_count = session_count - 1
+                    WHERE id = (SELECT game_id FROM players WHERE id = OLD.player_id);
+                    DELETE FROM games
+                    WHERE id = (SELECT game_id FROM players WHERE id = OLD.player_id)
+                    AND session_count = 0;
+                END;
+                """,
+            ),
+            *replace_trigger(
+                "clear_sessionless_games_on_delete",
+                """
+                CREATE TRIGGER clear_sessionless_games_on_delete
+                AFTER DELETE
+                ON sessions
+                WHEN OLD.player_id IS NOT NULL
+                BEGIN
+                    UPDATE games
+                    SET session_count = session_count - 1
+                    WHERE id = (SELECT game_id FROM players WHERE id = OLD.player_id);
+                    DELETE FROM games
+                    WHERE id = (SELECT game_id FROM players WHERE id = OLD.player_id)
+                    AND session_count = 0;
+                END;
+                """,
+            ),
+        ],
+        backfills=[
+            Backfill(
+                table="games",
+                statement="""
+                UPDATE games
+                SET
+                    player_count = (SELECT COUNT(id) FROM players WHERE game_id = games.id),
+                    session_count = (
+                        SELECT COUNT(sessions.id)
+                        FROM sessions
+                        JOIN players ON sessions.player_id = players.id
+                        WHERE players.game_id = games.id
+                    )
+                WHERE rowid BETWEEN :first AND :last;
+                """,
+            ),
+        ],
+    ),
+    Migration(
+        version=4,
+        name="packed_deck",
+        steps=[
+            # The digits of the old text deck are repacked into an integer of 3 bits a card
+            rename_column("games", "deck", "deck_digits", "TEXT"),
+            add_column("games", "deck", f"INTEGER NOT NULL DEFAULT({deck.EMPTY})"),
+            create_function("pack_deck", 1, deck.from_digits),
+        ],
+        backfills=[
+            Backfill(
+                table="games",
+                statement="""
+                UPDATE games
+                SET deck = pack_deck(deck_digits)
+                WHERE rowid BETWEEN :first AND :last;
+                """,
+                requires_column="deck_digits",
+            ),
+        ],
+        cleanup=[
+            drop_column("games", "deck_digits"),
+        ],
+    ),
+]
+
+
+async def get_version(conn: Connection) -> int:
+    rows = list(await conn.execute_fetchall("PRAGMA user_version;"))
+    return rows[0][0]
+
+
+async def get_pending(conn: Connection) -> list[Migration]:
+    version = await get_version(conn)
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m.version) if m.version > version]
+
+
+async def _run_steps(conn: Connection, steps: list[Step]) -> None:
+    for step in steps:
+        if isinstance(step, str):
+            await conn.execute(step)
+        else:
+            await step(conn)
+
+
+async def _rowid_range(conn: Connection, table: str) -> tuple[int, int]:
+    rows = list(await conn.execute_fetchall(f"SELECT MIN(rowid), MAX(rowid) FROM {table};"))
+    first, last = rows[0]
+    if first is None:
+        return (0, -1)
+    return (first, last)
+
+
+async def _applies(conn: Connection, backfill: Backfill) -> bool:
+    return backfill.requires_column is None or backfill.requires_column in await _column_types(conn, backfill.table)
+
+
+async def _run_backfill(conn: Connection, backfill: Backfill, batch_size: int) -> None:
+    if not await _applies(conn, backfill):
+        return
+    first, last = await _rowid_range(conn, backfill.table)
+    for start in range(first, last + 1, batch_size):
+        await conn.execute(backfill.statement, {"first": start, "last": start + batch_size - 1})
+        await conn.commit()
+        # Let anything else on the loop run between batches
+        await asyncio.sleep(0)
+
+
+async def migrate(conn: Connection, batch_size: int = BATCH_SIZE) -> list[Migration]:
+    applied = []
+    for migration in await get_pending(conn):
+        await conn.execute("BEGIN;")
+        await _run_steps(conn, migration.steps)
+        await conn.commit()
+
+        for backfill in migration.backfills:
+            await _run_backfill(conn, backfill, batch_size)
+
+        await conn.execute("BEGIN;")
+        await _run_steps(conn, migration.cleanup)
+        await conn.commit()
+
+        await conn.execute(f"PRAGMA user_version = {migration.version};")
+        await conn.commit()
+        applied.append(migration)
+    return applied
+
+
+async def dry_run(conn: Connection, batch_size: int = BATCH_SIZE) -> list[MigrationEstimate]:
+    estimates = []
+    await conn.execute("BEGIN;")
+    try:
+        for migration in await get_pending(conn):
+            started = time.perf_counter()
+            await _run_steps(conn, migration.steps)
+            seconds = time.perf_counter() - started
+
+            rows = 0
+            for backfill in migration.backfills:
+                if not await _applies(conn, backfill):
+                    continue
+                first, last = await _rowid_range(conn, backfill.table)
+                rows += last - first + 1
+                batches = (last - first + batch_size) // batch_size
+                if batches == 0:
+                    continue
+                # Time a single batch and assume the rest cost the same
+                started = time.perf_counter()
+                await conn.execute(backfill.statement, {"first": first, "last": first + batch_size - 1})
+                seconds += (time.perf_counter() - started) * batches
+
+            started = time.perf_counter()
+            await _run_steps(conn, migration.cleanup)
+            seconds += time.perf_counter() - started
+            estimates.append(MigrationEstimate(migration, rows, seconds))
+    finally:
+        await conn.rollback()
+    return estimates
+
+
+async def main(path: str, batch_size: int, dry: bool) -> None:
+    async with db.open(path) as conn:
+        print(f"Database {path} is at version {await get_version(conn)}")
+        if dry:
+            estimates = await dry_run(conn, batch_size)
+            for estimate in estimates:
+                migration = estimate.migration
+                print(
+                    f"  {migration.version} {migration.name}: "
+                    f"{estimate.rows} rows to backfill, ~{estimate.seconds:.3f}s"
+                )
+            print(f"Estimated total: ~{sum(e.seconds for e in estimates):.3f}s")
+            return
+
+        for migration in await migrate(conn, batch_size):
+            print(f"  applied {migration.version} {migration.name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply pending database migrations")
+    parser.add_argument("--db", default=db.DB_FILE, help="path to the SQLite database")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per backfill batch")
+    parser.add_argument("--dry-run", action="store_true", help="report pending migrations and estimated time")
+    args = parser.parse_args()
+    asyncio.run(main(args.db, args.batch_size, args.dry_run))
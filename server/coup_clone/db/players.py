@@ -4,7 +4,7 @@ from typing import Optional
 
 from aiosqlite import Cursor, Row
 
-from coup_clone.db.table import Table, TableRow
+from coup_clone.db.table import Table, TableRow, decoded_on_access
 
 
 class PlayerState(enum.IntEnum):
@@ -21,7 +21,8 @@ class Influence(enum.IntEnum):
     CAPTAIN = 5
 
 
-@dataclass
+@decoded_on_access(state=PlayerState, influence_a=Influence, influence_b=Influence)
+@dataclass(slots=True)
 class PlayerRow(TableRow[int]):
     game_id: str
     state: PlayerState
@@ -54,6 +55,9 @@ class PlayersTable(Table[PlayerRow, int]):
             accepts_action INTEGER DEFAULT(0)
         );
     """
+    INDEX_DEFINITIONS = [
+        "CREATE INDEX IF NOT EXISTS players_game_id ON players (game_id);",
+    ]
     COLUMNS = [
         "id",
         "game_id",
@@ -73,38 +77,13 @@ class PlayersTable(Table[PlayerRow, int]):
         return PlayerRow(
             id=row[0],
             game_id=row[1],
-            state=PlayerState(row[2]),
+            state=row[2],
             name=row[3],
             coins=row[4],
-            influence_a=Influence(row[5]),
-            influence_b=Influence(row[6]),
+            influence_a=row[5],
+            influence_b=row[6],
             revealed_influence_a=row[7],
             revealed_influence_b=row[8],
             host=bool(row[9]),
             accepts_action=row[10],
         )
-
-    @staticmethod
-    async def reset_accepts_action(cursor: Cursor, game_id: str) -> None:
-        await cursor.execute(
-            """
-        UPDATE players
-        SET accepts_action = 0
-        WHERE game_id = :game_id
-        """,
-            {"game_id": game_id},
-        )
-
-    @staticmethod
-    async def reset_players(cursor: Cursor, game_id: str) -> None:
-        await cursor.execute(
-            """
-        UPDATE players
-        SET
-            coins = 2,
-            revealed_influence_a = 0,
-            revealed_influence_b = 0
-        WHERE game_id = :game_id
-        """,
-            {"game_id": game_id},
-        )
@@ -6,7 +6,7 @@ from aiosqlite import Cursor, Row
 from coup_clone.db.table import Table, TableRow
 
 
-@dataclass
+@dataclass(slots=True)
 class SessionRow(TableRow[str]):
     player_id: Optional[int]
 
@@ -20,6 +20,9 @@ class SessionsTable(Table[SessionRow, str]):
                 ON DELETE SET NULL
         );
     """
+    INDEX_DEFINITIONS = [
+        "CREATE INDEX IF NOT EXISTS sessions_player_id ON sessions (player_id);",
+    ]
     COLUMNS = [
         "id",
         "player_id",
@@ -31,3 +34,16 @@ class SessionsTable(Table[SessionRow, str]):
             id=row[0],
             player_id=row[1],
         )
+
+    @staticmethod
+    async def get_game_id(cursor: Cursor, session_id: str) -> Optional[str]:
+        await cursor.execute(
+            """
+            SELECT players.game_id FROM sessions
+            JOIN players ON players.id = sessions.player_id
+            WHERE sessions.id = :session_id;
+            """,
+            {"session_id": session_id},
+        )
+        row = await cursor.fetchone()
+        return row[0] if row is not None else None
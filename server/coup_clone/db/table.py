@@ -1,9 +1,13 @@
 from abc import ABC, abstractmethod
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Any, AsyncIterator, Generic, Optional, TypeVar
+from datetime import datetime
+from enum import Enum
+from typing import Any, AsyncIterator, Callable, ClassVar, Generic, Optional, TypeVar
 
-from aiosqlite import Cursor, Row
+from aiosqlite import Connection, Cursor, Row
+
+from coup_clone.scope import scoped_value
 
 TID = TypeVar("TID", int, str)
 
@@ -12,17 +16,118 @@ class MissingAfterCreateException(Exception):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class TableRow(Generic[TID]):
     id: TID
 
 
 T = TypeVar("T", bound=TableRow)
+R = TypeVar("R", bound=type)
+
+_DECODERS: dict[type, Callable[[Any], Any]] = {datetime: datetime.fromisoformat}
+
+
+class _Decoded:
+    """Keeps a column as sqlite returned it until it is first read, then keeps the decoded value instead"""
+
+    def __init__(self, slot: Any, decoded_type: type):
+        self.slot = slot
+        self.decoded_type = decoded_type
+        if issubclass(decoded_type, Enum):
+            # Much cheaper than calling the enum, which goes through EnumType.__call__
+            self.decode = decoded_type._value2member_map_.__getitem__
+        else:
+            self.decode = _DECODERS.get(decoded_type, decoded_type)
+
+    def __get__(self, row: Any, owner: Optional[type] = None) -> Any:
+        if row is None:
+            return self
+        value = self.slot.__get__(row, owner)
+        if value is None or type(value) is self.decoded_type:
+            return value
+        value = self.decode(value)
+        self.slot.__set__(row, value)
+        return value
+
+
+def decoded_on_access(**columns: type) -> Callable[[R], R]:
+    """Row factories can then pass these columns through untouched, most reads never look at them"""
+
+    def wrap(cls: R) -> R:
+        for name, decoded_type in columns.items():
+            slot = cls.__dict__[name]
+            # Writes go straight to the slot, so building a row costs no more than with a plain slot
+            descriptor = type(f"_Decoded_{name}", (_Decoded,), {"__set__": staticmethod(slot.__set__)})
+            setattr(cls, name, descriptor(slot, decoded_type))
+        return cls
+
+    return wrap
+
+
+StatementKey = tuple[type["Table"], str, tuple[str, ...], tuple[str, ...]]
+
+
+@dataclass
+class StatementMetrics:
+    statements: int = 0
+    hits: int = 0
+    misses: int = 0
+
+
+class Statements:
+    """SQL text for the generic Table operations, built once for each table, operation and set of columns
+
+    Columns are sorted before building, so callers passing the same columns in another order share one statement
+    and with it the compiled statement that sqlite caches for each distinct piece of SQL.
+    """
+
+    metrics: ClassVar[StatementMetrics] = StatementMetrics()
+    _sql: ClassVar[dict[StatementKey, str]] = {}
+    _distinct: ClassVar[set[str]] = set()
+
+    @classmethod
+    def get(
+        cls, table: type["Table"], operation: str, columns: tuple[str, ...] = (), order: tuple[str, ...] = ()
+    ) -> str:
+        key = (table, operation, columns, order)
+        sql = cls._sql.get(key)
+        if sql is not None:
+            cls.metrics.hits += 1
+            return sql
+
+        cls.metrics.misses += 1
+        sql = cls._sql[key] = cls._build(table, operation, sorted(columns), order)
+        cls._distinct.add(sql)
+        cls.metrics.statements = len(cls._distinct)
+        return sql
+
+    @staticmethod
+    def _build(table: type["Table"], operation: str, columns: list[str], order: tuple[str, ...]) -> str:
+        select = f'SELECT {", ".join(table.COLUMNS)} FROM {table.TABLE_NAME}'
+        matches = " AND ".join(f"{c} = :{c}" for c in columns)
+        if operation == "get":
+            return f"{select} WHERE id = :id;"
+        if operation == "query":
+            order_by = f' ORDER BY {", ".join(order)}' if order else ""
+            return f"{select} WHERE {matches}{order_by};"
+        if operation in ("insert", "create"):
+            values = ", ".join(f":{c}" for c in columns)
+            insert = f'INSERT INTO {table.TABLE_NAME} ({", ".join(columns)}) VALUES ({values})'
+            # executemany refuses statements that return rows, so only create reads the row back
+            return f'{insert} RETURNING {", ".join(table.COLUMNS)};' if operation == "create" else f"{insert};"
+        if operation == "update":
+            return f'UPDATE {table.TABLE_NAME} SET {", ".join(f"{c} = :{c}" for c in columns)} WHERE id = :id;'
+        if operation == "delete":
+            return f"DELETE FROM {table.TABLE_NAME} WHERE id = :id;"
+        if operation == "count":
+            return f"SELECT COUNT(*) FROM {table.TABLE_NAME} WHERE {matches};"
+        raise ValueError(f"Unknown statement: {operation}")
 
 
 class Table(Generic[T, TID], ABC):
     TABLE_NAME = ""
     TABLE_DEFINITION = ""
+    INDEX_DEFINITIONS: list[str] = []
     COLUMNS: list[str] = []
 
     @staticmethod
@@ -40,68 +145,147 @@ class Table(Generic[T, TID], ABC):
 
     @classmethod
     async def get(cls, cursor: Cursor, id: TID) -> T:
-        select = f'SELECT {", ".join(cls.COLUMNS)}'
-        from_table = f"FROM {cls.TABLE_NAME}"
-        where = "WHERE id = :id"
-        query = f"{select} {from_table} {where};"
         async with cls.wrap_row_factory(cursor):
-            await cursor.execute(query, {"id": id})
+            await cursor.execute(Statements.get(cls, "get"), {"id": id})
             return await cursor.fetchone()  # type: ignore[return-value]
 
     @classmethod
     async def query(cls, cursor: Cursor, order_by: Optional[list[str]] = None, **kwargs: Any) -> list[T]:
-        matches = [f"{c} = :{c}" for c in kwargs.keys()]
-        select = f'SELECT {", ".join(cls.COLUMNS)}'
-        from_table = f"FROM {cls.TABLE_NAME}"
-        where = f'WHERE {" AND ".join(matches)}'
-        order = f'ORDER BY {", ".join(order_by)}' if order_by is not None else ""
-        query = f"{select} {from_table} {where} {order};"
+        query = Statements.get(cls, "query", tuple(kwargs), tuple(order_by) if order_by is not None else ())
         async with cls.wrap_row_factory(cursor):
             await cursor.execute(query, kwargs)
             return await cursor.fetchall()  # type: ignore[return-value]
 
     @classmethod
     async def create(cls, cursor: Cursor, **kwargs: Any) -> T:
-        columns = list(kwargs.keys())
-        value_list = [f":{c}" for c in columns]
-        insert = f'INSERT INTO {cls.TABLE_NAME} ({", ".join(columns)})'
-        values = f'VALUES ({", ".join(value_list)})'
-        query = f"{insert} {values};"
-        await cursor.execute(query, kwargs)
-        await cursor.execute(f'SELECT {",".join(cls.COLUMNS)} FROM {cls.TABLE_NAME} WHERE ROWID = last_insert_rowid()')
         async with cls.wrap_row_factory(cursor):
-            result = await cursor.fetchone()
-        if result is None:
-            raise MissingAfterCreateException(f"Last inserted row not found for table: {cls.TABLE_NAME}")
-        return result  # type: ignore[return-value]
+            await cursor.execute(Statements.get(cls, "create", tuple(kwargs)), kwargs)
+            # Fetched in full so the statement is finished and the row is written before the next one runs
+            result: list[T] = list(await cursor.fetchall())  # type: ignore[arg-type]
+        if not result:
+            raise MissingAfterCreateException(f"Inserted row not returned for table: {cls.TABLE_NAME}")
+        return result[0]
+
+    @classmethod
+    async def insert_many(cls, cursor: Cursor, columns: list[str], rows: list[dict[str, Any]]) -> None:
+        await cursor.executemany(Statements.get(cls, "insert", tuple(columns)), rows)
 
     @classmethod
     async def update(cls, cursor: Cursor, id: TID, **kwargs: Any) -> None:
-        fields = [f"{f} = :{f}" for f in kwargs.keys()]
-        update = f"UPDATE {cls.TABLE_NAME}"
-        values = f'SET {", ".join(fields)}'
-        where = "WHERE id = :id"
-        query = f"{update} {values} {where};"
         await cursor.execute(
-            query,
+            Statements.get(cls, "update", tuple(kwargs)),
             {
                 "id": id,
                 **kwargs,
             },
         )
 
+    @classmethod
+    async def update_many(cls, cursor: Cursor, columns: list[str], rows: list[dict[str, Any]]) -> None:
+        await cursor.executemany(Statements.get(cls, "update", tuple(columns)), rows)
+
     @classmethod
     async def delete(cls, cursor: Cursor, id: TID) -> None:
-        query = f"DELETE FROM {cls.TABLE_NAME} WHERE id = :id"
-        await cursor.execute(query, {"id": id})
+        await cursor.execute(Statements.get(cls, "delete"), {"id": id})
 
     @classmethod
     async def count(cls, cursor: Cursor, **kwargs: Any) -> int:
-        matches = [f"{c} = :{c}" for c in kwargs.keys()]
-        where = f'WHERE {" AND ".join(matches)}'
-        query = f"SELECT COUNT(*) FROM {cls.TABLE_NAME} {where}"
-        await cursor.execute(query, kwargs)
+        await cursor.execute(Statements.get(cls, "count", tuple(kwargs)), kwargs)
         row = await cursor.fetchone()
         if row is None:
             return 0
         return row[0]
+
+
+RowKey = tuple[type[Table], Any]
+
+
+@dataclass
+class UnitOfWorkMetrics:
+    units: int = 0
+    updates: int = 0
+    appended: int = 0
+    statements: int = 0
+    deferred: int = 0
+    statements_saved: int = 0
+
+
+class UnitOfWork:
+    """The row changes a request makes on a connection, written together when it commits
+
+    Kept in the request scope, so changes a request leaves unwritten go with it instead of to the next request on the
+    connection.
+    """
+
+    metrics: ClassVar[UnitOfWorkMetrics] = UnitOfWorkMetrics()
+
+    def __init__(self) -> None:
+        self.rows: dict[RowKey, tuple[TableRow, set[str]]] = {}
+        self.appends: dict[tuple[type[Table], tuple[str, ...]], list[dict[str, Any]]] = {}
+        self.updates = 0
+        self.appended = 0
+        self.statements = 0
+        # Updates to rows someone else writes out, the unit saves nothing on those
+        self.deferred = 0
+        self._recorded: dict[RowKey, int] = {}
+
+    @classmethod
+    def of(cls, conn: Connection) -> "UnitOfWork":
+        active = scoped_value(cls)
+        if active is None:
+            raise RuntimeError("Rows can only be changed inside a request scope")
+        if conn not in active:
+            active[conn] = cls()
+        return active[conn]
+
+    @classmethod
+    def finish(cls, conn: Connection) -> "UnitOfWork":
+        active = scoped_value(cls)
+        work = active.pop(conn, None) if active is not None else None
+        return work if work is not None else cls()
+
+    @property
+    def statements_saved(self) -> int:
+        # Every update used to cost an UPDATE followed by a SELECT to refresh the row, every appended row an INSERT
+        # followed by a SELECT to read it back
+        return (self.updates - self.deferred + self.appended) * 2 - self.statements
+
+    def record(self, table: type[Table], row: TableRow, **kwargs: Any) -> None:
+        _, fields = self.rows.setdefault((table, row.id), (row, set()))
+        fields.update(kwargs.keys())
+        for f, value in kwargs.items():
+            setattr(row, f, value)
+        self.updates += 1
+        self._recorded[(table, row.id)] = self._recorded.get((table, row.id), 0) + 1
+
+    def append(self, table: type[Table], **values: Any) -> None:
+        # For rows nothing reads back before the commit, each table and set of columns is one executemany
+        self.appends.setdefault((table, tuple(values)), []).append(values)
+        self.appended += 1
+
+    def take(self, key: RowKey) -> dict[str, Any]:
+        row, fields = self.rows.pop(key)
+        return {f: getattr(row, f) for f in fields}
+
+    def defer(self, key: RowKey) -> dict[str, Any]:
+        """Takes a row's changes out of the unit to be written by someone else"""
+        self.deferred += self._recorded.get(key, 0)
+        return self.take(key)
+
+    async def flush(self, cursor: Cursor) -> None:
+        # Appended first, an update below can delete the game they belong to through the triggers
+        for (table, columns), rows in self.appends.items():
+            await table.insert_many(cursor, list(columns), rows)
+            self.statements += 1
+        self.appends = {}
+
+        for table, id in list(self.rows.keys()):
+            await table.update(cursor, id, **self.take((table, id)))
+            self.statements += 1
+
+        self.metrics.units += 1
+        self.metrics.updates += self.updates
+        self.metrics.appended += self.appended
+        self.metrics.statements += self.statements
+        self.metrics.deferred += self.deferred
+        self.metrics.statements_saved += self.statements_saved
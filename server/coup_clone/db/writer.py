@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Coroutine, Optional, TypeVar
+
+from aiosqlite import Connection
+
+from coup_clone.db import DB_FILE, connect
+
+# A child of the coup_clone logger, the db package doesn't depend on the rest of the app
+logger = logging.getLogger(__name__)
+
+WRITER_MAX_BATCH = int(os.environ.get("COUP_DB_WRITER_MAX_BATCH", "64"))
+
+R = TypeVar("R")
+WriteJob = Callable[[Connection], Coroutine[Any, Any, Any]]
+
+
+@dataclass
+class WriterMetrics:
+    jobs: int = 0
+    failed_jobs: int = 0
+    commits: int = 0
+    failed_commits: int = 0
+    largest_batch: int = 0
+    queued: int = 0
+
+
+@dataclass
+class _QueuedJob:
+    run: WriteJob
+    result: asyncio.Future
+    context: contextvars.Context
+
+
+class Writer:
+    def __init__(self, path: str = DB_FILE, max_batch: int = WRITER_MAX_BATCH):
+        self.path = path
+        self.max_batch = max_batch
+        self.metrics = WriterMetrics()
+        self._queue: asyncio.Queue[_QueuedJob] = asyncio.Queue()
+        self._conn: Optional[Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        # Transactions on the writer connection are managed explicitly below
+        self._conn = await connect(self.path, isolation_level=None)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def submit(self, run: Callable[[Connection], Coroutine[Any, Any, R]]) -> R:
+        if self._task is None:
+            raise RuntimeError("Writer is not running")
+        result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_QueuedJob(run, result, contextvars.copy_context()))
+        self.metrics.queued = self._queue.qsize()
+        return await result
+
+    async def _run_job(self, conn: Connection, job: _QueuedJob) -> Optional[tuple[_QueuedJob, Any]]:
+        try:
+            await conn.execute("SAVEPOINT job;")
+            try:
+                # Run in the submitter's context so that per request state follows the job
+                value = await asyncio.create_task(job.run(conn), context=job.context)
+            except BaseException as e:
+                await conn.execute("ROLLBACK TO job;")
+                await conn.execute("RELEASE job;")
+                self.metrics.failed_jobs += 1
+                if not job.result.done():
+                    job.result.set_exception(e)
+                return None
+            await conn.execute("RELEASE job;")
+        except BaseException as e:
+            # The savepoint itself failed, which fails the whole batch, but this job isn't in it yet to be told
+            if not job.result.done():
+                job.result.set_exception(e)
+            raise
+        return (job, value)
+
+    async def _run_batch(self, conn: Connection, first: _QueuedJob) -> None:
+        done: list[tuple[_QueuedJob, Any]] = []
+        taken = 1
+        # Take the write lock up front, another worker process may be writing to the same file
+        await conn.execute("BEGIN IMMEDIATE;")
+        try:
+            job: Optional[_QueuedJob] = first
+            while job is not None:
+                completed = await self._run_job(conn, job)
+                if completed is not None:
+                    done.append(completed)
+
+                # Keep the transaction open for whatever queued up meanwhile so
+                # that they all share one commit
+                job = None
+                if taken < self.max_batch and not self._queue.empty():
+                    job = self._queue.get_nowait()
+                    taken += 1
+            await conn.execute("COMMIT;")
+            self.metrics.commits += 1
+        except BaseException as e:
+            self.metrics.failed_commits += 1
+            if conn.in_transaction:
+                await conn.execute("ROLLBACK;")
+            for queued, _ in done:
+                if not queued.result.done():
+                    queued.result.set_exception(e)
+            raise
+        finally:
+            for _ in range(taken):
+                self._queue.task_done()
+            self.metrics.jobs += taken
+            self.metrics.largest_batch = max(self.metrics.largest_batch, taken)
+            self.metrics.queued = self._queue.qsize()
+
+        for queued, value in done:
+            if not queued.result.done():
+                queued.result.set_result(value)
+
+    async def _run(self) -> None:
+        conn = self._conn
+        if conn is None:
+            raise RuntimeError("Writer connection is not open")
+        while True:
+            first = await self._queue.get()
+            try:
+                await self._run_batch(conn, first)
+            except Exception:
+                logger.exception("writer batch failed")
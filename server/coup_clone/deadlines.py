@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from coup_clone.db import ConnectionPool, reuse_cursor
+from coup_clone.db.games import GamesTable
+from coup_clone.instrumentation import LATENCY_BUCKETS, Histogram, logger
+
+# Receives the game id and the deadline that passed
+ExpireHandler = Callable[[str, datetime], Awaitable[None]]
+
+
+@dataclass
+class DeadlineMetrics:
+    scheduled: int = 0
+    pending: int = 0
+    fired: int = 0
+    errors: int = 0
+    lag: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+
+
+class DeadlineScheduler:
+    """Keeps the turn deadline of every game in one heap, served by a single task"""
+
+    def __init__(
+        self,
+        read_pool: ConnectionPool,
+        owns: Optional[Callable[[str], bool]] = None,
+        flush: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.read_pool = read_pool
+        self._owns = owns
+        # Writes out deadlines still held in memory, so they can be read back
+        self._flush = flush
+        self.metrics = DeadlineMetrics()
+        self._heap: list[tuple[float, int, str, datetime]] = []
+        self._deadlines: dict[str, datetime] = {}
+        self._order = itertools.count()
+        self._handler: Optional[ExpireHandler] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._expiring: set[asyncio.Task] = set()
+
+    def handle_expired(self, handler: ExpireHandler) -> None:
+        self._handler = handler
+
+    def schedule(self, game_id: str, deadline: datetime) -> None:
+        # A game's deadlines only move forward, an older one is either stale or already scheduled
+        current = self._deadlines.get(game_id)
+        if current is not None and current >= deadline:
+            return
+        self._deadlines[game_id] = deadline
+        self.metrics.scheduled += 1
+        self.metrics.pending = len(self._deadlines)
+
+        when = time.monotonic() + (deadline - datetime.utcnow()).total_seconds()
+        heapq.heappush(self._heap, (when, next(self._order), game_id, deadline))
+        if self._heap[0][2] == game_id:
+            self._wake.set()
+
+    async def recover(self) -> None:
+        if self._flush is not None:
+            await self._flush()
+        async with self.read_pool.acquire() as conn:
+            async with reuse_cursor(conn) as cursor:
+                pending = await GamesTable.pending_deadlines(cursor)
+        for game_id, deadline in pending:
+            if self._owns is None or self._owns(game_id):
+                self.schedule(game_id, deadline)
+
+    async def _expire(self, game_id: str, deadline: datetime) -> None:
+        try:
+            if self._handler is not None:
+                await self._handler(game_id, deadline)
+        except Exception:
+            self.metrics.errors += 1
+            logger.exception("deadline failed", extra={"fields": {"game_id": game_id}})
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, _, game_id, deadline = heapq.heappop(self._heap)
+            # Entries replaced by a later deadline are left in the heap and skipped here
+            if self._deadlines.get(game_id) != deadline:
+                continue
+            del self._deadlines[game_id]
+            self.metrics.pending = len(self._deadlines)
+            self.metrics.fired += 1
+            self.metrics.lag.observe(time.monotonic() - when)
+            task = asyncio.create_task(self._expire(game_id, deadline))
+            self._expiring.add(task)
+            task.add_done_callback(self._expiring.discard)
+
+    async def start(self) -> None:
+        await self.recover()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Expiries already started still write to the database, they finish before the writer stops
+        if self._expiring:
+            await asyncio.wait(self._expiring)
@@ -0,0 +1,70 @@
+import random
+from typing import Iterable, Optional
+
+from coup_clone.db.players import Influence
+from coup_clone.managers.exceptions import NotEnoughCardsException
+
+# A deck is packed into one integer, 3 bits a card with the top card in the lowest bits. The single bit above the
+# last card marks where the deck ends, so a deck can hold any card value and still know its own size.
+CARD_BITS = 3
+CARD_MASK = (1 << CARD_BITS) - 1
+EMPTY = 1
+
+
+def pack(cards: Iterable[int]) -> int:
+    """Cards from the bottom of the deck to the top, the order the digits of the old text column were in"""
+    deck = EMPTY
+    for card in cards:
+        deck = (deck << CARD_BITS) | int(card)
+    return deck
+
+
+def from_digits(digits: str) -> int:
+    return pack(int(c) for c in digits)
+
+
+def size(deck: int) -> int:
+    return (deck.bit_length() - 1) // CARD_BITS
+
+
+def _top(deck: int, n: int) -> list[Influence]:
+    if size(deck) < n:
+        raise NotEnoughCardsException()
+    cards = []
+    for _ in range(n):
+        cards.append(Influence(deck & CARD_MASK))
+        deck >>= CARD_BITS
+    return cards
+
+
+def unpack(deck: int) -> list[Influence]:
+    return list(reversed(_top(deck, size(deck))))
+
+
+def peek(deck: int, n: int) -> list[Influence]:
+    """The top n cards, in the order they sit in the deck so the top card comes last"""
+    return list(reversed(_top(deck, n)))
+
+
+def draw(deck: int, n: int) -> tuple[int, list[Influence]]:
+    """Takes n cards off the top, the top card first"""
+    return deck >> (n * CARD_BITS), _top(deck, n)
+
+
+def _swap(deck: int, i: int, j: int) -> int:
+    shift_i, shift_j = i * CARD_BITS, j * CARD_BITS
+    different = ((deck >> shift_i) ^ (deck >> shift_j)) & CARD_MASK
+    return deck ^ ((different << shift_i) | (different << shift_j))
+
+
+def put_back(deck: int, cards: Iterable[Influence], rng: Optional[random.Random] = None) -> int:
+    """Returns the cards to random places in the deck
+
+    Each card goes on top and is swapped with a random position, the inside-out Fisher-Yates step, which keeps a deck
+    nobody has seen the order of uniformly shuffled without touching the rest of it.
+    """
+    randrange = rng.randrange if rng is not None else random.randrange
+    for card in cards:
+        deck = (deck << CARD_BITS) | card.value
+        deck = _swap(deck, 0, randrange(size(deck)))
+    return deck
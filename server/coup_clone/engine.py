@@ -0,0 +1,288 @@
+import asyncio
+import os
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from aiosqlite import Connection, Cursor
+
+from coup_clone.db import reuse_cursor
+from coup_clone.db.games import GameRow, GamesTable
+from coup_clone.db.players import PlayerRow, PlayersTable
+from coup_clone.db.table import RowKey, Table, TableRow, UnitOfWork
+from coup_clone.db.writer import Writer
+from coup_clone.instrumentation import logger
+
+FLUSH_INTERVAL = float(os.environ.get("COUP_FLUSH_INTERVAL", "1.0"))
+
+
+@dataclass
+class LiveGame:
+    game: GameRow
+    players: dict[int, PlayerRow] = field(default_factory=dict)
+
+
+@dataclass
+class EngineMetrics:
+    games_loaded: int = 0
+    games_evicted: int = 0
+    hits: int = 0
+    misses: int = 0
+    flushes: int = 0
+    flush_errors: int = 0
+    rows_flushed: int = 0
+
+
+@dataclass
+class _Journal:
+    undo: list[Callable[[], None]] = field(default_factory=list)
+
+
+@dataclass
+class StagedChanges:
+    undo: list[Callable[[], None]]
+    dirty: dict[RowKey, dict[str, Any]]
+
+
+class GameEngine:
+    def __init__(
+        self,
+        writer: Writer,
+        flush_interval: float = FLUSH_INTERVAL,
+        owns: Optional[Callable[[str], bool]] = None,
+    ):
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self._owns = owns
+        self.metrics = EngineMetrics()
+        self.games: dict[str, LiveGame] = {}
+        self.players: dict[int, PlayerRow] = {}
+        self._journals: dict[Connection, _Journal] = {}
+        self._dirty: dict[RowKey, dict[str, Any]] = {}
+        # Taken by a flush that hasn't committed yet
+        self._flushing: dict[RowKey, dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._evicted: list[Callable[[str], None]] = []
+
+    @property
+    def write_behind(self) -> bool:
+        return self.flush_interval > 0
+
+    def owns(self, game_id: str) -> bool:
+        return self._owns is None or self._owns(game_id)
+
+    def on_evict(self, handler: Callable[[str], None]) -> None:
+        self._evicted.append(handler)
+
+    def _journal(self, conn: Connection) -> _Journal:
+        if conn not in self._journals:
+            self._journals[conn] = _Journal()
+        return self._journals[conn]
+
+    def tracks(self, row: TableRow) -> bool:
+        if isinstance(row, GameRow):
+            live = self.games.get(row.id)
+            return live is not None and live.game is row
+        if isinstance(row, PlayerRow):
+            return self.players.get(row.id) is row
+        return False
+
+    def loaded(self, game_id: str) -> Optional[LiveGame]:
+        """The game if it is held in memory, without going to the database"""
+        return self.games.get(game_id)
+
+    async def load(self, conn: Connection, game_id: str) -> Optional[LiveGame]:
+        live = self.games.get(game_id)
+        if live is not None:
+            self.metrics.hits += 1
+            return live
+
+        self.metrics.misses += 1
+        async with reuse_cursor(conn) as cursor:
+            game = await GamesTable.get(cursor, game_id)
+            if game is None:
+                return None
+            players = await PlayersTable.query(cursor, game_id=game_id, order_by=["id"])
+        self._pending(GamesTable, game)
+        for player in players:
+            self._pending(PlayersTable, player)
+
+        # Another request may have loaded the game while we were waiting on the database
+        live = self.games.get(game_id)
+        if live is not None:
+            return live
+
+        live = LiveGame(game, {p.id: p for p in players})
+        if not self.owns(game_id):
+            # The worker that owns the game keeps it in memory, a copy kept here would go stale
+            return live
+        self.games[game_id] = live
+        self.players.update(live.players)
+        self.metrics.games_loaded += 1
+        return live
+
+    async def load_player(self, conn: Connection, player_id: int) -> Optional[PlayerRow]:
+        player = self.players.get(player_id)
+        if player is not None:
+            self.metrics.hits += 1
+            return player
+
+        async with reuse_cursor(conn) as cursor:
+            row = await PlayersTable.get(cursor, player_id)
+        if row is None:
+            return None
+        live = await self.load(conn, row.game_id)
+        if live is None:
+            return None
+        return live.players.get(player_id)
+
+    def add_game(self, conn: Connection, row: GameRow) -> None:
+        if not self.owns(row.id):
+            return
+        self.games[row.id] = LiveGame(row)
+        self._journal(conn).undo.append(lambda: self._drop(row.id))
+
+    def add_player(self, conn: Connection, row: PlayerRow) -> None:
+        live = self.games.get(row.game_id)
+        if live is None:
+            return
+        live.players[row.id] = row
+        self.players[row.id] = row
+
+        def undo() -> None:
+            live.players.pop(row.id, None)
+            self.players.pop(row.id, None)
+
+        self._journal(conn).undo.append(undo)
+
+    def remove_player(self, conn: Connection, row: PlayerRow) -> None:
+        live = self.games.get(row.game_id)
+        if live is None or live.players.get(row.id) is not row:
+            return
+        del live.players[row.id]
+        del self.players[row.id]
+
+        def undo() -> None:
+            live.players[row.id] = row
+            live.players = dict(sorted(live.players.items()))
+            self.players[row.id] = row
+
+        self._journal(conn).undo.append(undo)
+
+    def update(self, conn: Connection, table: type[Table], row: TableRow, **kwargs: Any) -> None:
+        previous = {f: getattr(row, f) for f in kwargs.keys()}
+
+        def undo() -> None:
+            for f, value in previous.items():
+                setattr(row, f, value)
+
+        self._journal(conn).undo.append(undo)
+        UnitOfWork.of(conn).record(table, row, **kwargs)
+
+    def _pending(self, table: type[Table], row: TableRow) -> None:
+        # The database can be behind by whatever hasn't been written behind yet
+        for changes in (self._flushing, self._dirty):
+            for f, value in changes.get((table, row.id), {}).items():
+                setattr(row, f, value)
+
+    def _drop(self, game_id: str) -> None:
+        live = self.games.pop(game_id, None)
+        if live is None:
+            return
+        for player_id in live.players.keys():
+            self.players.pop(player_id, None)
+
+    def evict(self, game_id: str) -> None:
+        if game_id in self.games:
+            self._drop(game_id)
+            self.metrics.games_evicted += 1
+        # Whatever else is kept about the game goes too, it's been deleted or is now looked after elsewhere
+        for handler in self._evicted:
+            handler(game_id)
+
+    def stage(self, conn: Connection, work: UnitOfWork) -> StagedChanges:
+        """Takes the request's changes to tracked rows out of work, to be written behind once it has committed"""
+        journal = self._journals.pop(conn, None)
+        staged = StagedChanges(journal.undo if journal is not None else [], {})
+        if self.write_behind:
+            for key, (row, _) in list(work.rows.items()):
+                if self.tracks(row):
+                    staged.dirty[key] = work.defer(key)
+        return staged
+
+    def apply(self, staged: StagedChanges) -> None:
+        for key, values in staged.dirty.items():
+            self._dirty.setdefault(key, {}).update(values)
+
+    def revert(self, staged: StagedChanges) -> None:
+        for undo in reversed(staged.undo):
+            undo()
+
+    def rollback(self, conn: Connection) -> None:
+        journal = self._journals.pop(conn, None)
+        if journal is None:
+            return
+        for undo in reversed(journal.undo):
+            undo()
+
+    async def _write(self, cursor: Cursor, changes: dict[RowKey, dict[str, Any]]) -> None:
+        batches: dict[tuple[type[Table], tuple[str, ...]], list[dict[str, Any]]] = defaultdict(list)
+        for (table, id), values in changes.items():
+            batches[(table, tuple(sorted(values.keys())))].append({"id": id, **values})
+        for (table, columns), rows in batches.items():
+            await table.update_many(cursor, list(columns), rows)
+        self.metrics.rows_flushed += len(changes)
+
+    async def flush(self) -> None:
+        dirty: dict[RowKey, dict[str, Any]] = {}
+
+        async def write(conn: Connection) -> None:
+            # Taken here so changes from requests queued ahead of the flush are written too
+            dirty.update(self._dirty)
+            self._dirty = {}
+            self._flushing = dirty
+            if dirty:
+                async with reuse_cursor(conn) as cursor:
+                    await self._write(cursor, dirty)
+
+        try:
+            await self.writer.submit(write)
+        except BaseException:
+            self.metrics.flush_errors += 1
+            for key, values in dirty.items():
+                self._dirty[key] = {**values, **self._dirty.get(key, {})}
+            raise
+        finally:
+            self._flushing = {}
+        if dirty:
+            self.metrics.flushes += 1
+
+    async def release(self) -> None:
+        """Writes out and forgets the games this worker no longer owns"""
+        await self.flush()
+        for game_id in [g for g in self.games.keys() if not self.owns(g)]:
+            self.evict(game_id)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if not self._dirty:
+                continue
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("engine flush failed")
+
+    def start(self) -> None:
+        if self.write_behind and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from coup_clone.db.games import GameRow, GameState
+from coup_clone.db.players import Influence, PlayerRow
+from coup_clone.models import DECK
+
+ESTIMATOR_WORLDS = int(os.environ.get("COUP_ESTIMATOR_WORLDS", "1000"))
+ESTIMATOR_TURNS = int(os.environ.get("COUP_ESTIMATOR_TURNS", "40"))
+
+# An empty slot in a hand, either revealed or never dealt
+GONE = 0
+
+
+@dataclass
+class EstimatorMetrics:
+    estimates: int = 0
+    reused: int = 0
+    # Finished after the game had moved on, so never sent
+    stale: int = 0
+    worlds: int = 0
+    seconds: float = 0
+
+
+class WinEstimator:
+    """Estimates each player's chance of winning from what everyone at the table can see
+
+    Hidden cards are dealt at random from the deck less every revealed card, many times over, and each of those
+    worlds is played out with a simple honest policy. Every world moves forward together, one turn at a time.
+    """
+
+    def __init__(
+        self,
+        worlds: int = ESTIMATOR_WORLDS,
+        turns: int = ESTIMATOR_TURNS,
+        seed: Optional[int] = None,
+    ):
+        self.worlds = worlds
+        self.turns = turns
+        self.rng = np.random.default_rng(seed)
+        self.metrics = EstimatorMetrics()
+        # One thread, estimates share the random generator
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="estimator")
+
+    @property
+    def enabled(self) -> bool:
+        return self.worlds > 0
+
+    def estimate(self, game: GameRow, players: list[PlayerRow]) -> dict[int, float]:
+        if not self.enabled or game.state != GameState.RUNNING or not players:
+            return {}
+        started = time.perf_counter()
+
+        players = sorted(players, key=lambda p: p.id)
+        hands, coins = self._deal(players)
+        current = next((i for i, p in enumerate(players) if p.id == game.player_turn_id), 0)
+        winners = self._play_out(hands, coins, np.full(self.worlds, current))
+        wins = np.bincount(winners, minlength=len(players)) / self.worlds
+
+        self.metrics.estimates += 1
+        self.metrics.worlds += self.worlds
+        self.metrics.seconds += time.perf_counter() - started
+        return {p.id: round(float(wins[i]), 3) for i, p in enumerate(players)}
+
+    async def estimate_in_background(self, game: GameRow, players: list[PlayerRow]) -> dict[int, float]:
+        """Runs estimate off the event loop, the rows must not change until it's done"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.estimate, game, players)
+
+    def stop(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _deal(self, players: list[PlayerRow]) -> tuple[np.ndarray, np.ndarray]:
+        remaining = Counter(i.value for i in DECK)
+        hidden = []
+        for seat, player in enumerate(players):
+            for slot, (influence, revealed) in enumerate(
+                [
+                    (player.influence_a, player.revealed_influence_a),
+                    (player.influence_b, player.revealed_influence_b),
+                ]
+            ):
+                if revealed:
+                    remaining[influence.value] -= 1
+                else:
+                    hidden.append((seat, slot))
+        pool = np.array(sorted(remaining.elements()), dtype=np.int8)
+
+        # A random permutation of the pool for every world at once, its first cards go to the hidden slots
+        order = self.rng.random((self.worlds, len(pool))).argsort(axis=1)
+        hands = np.full((self.worlds, len(players), 2), GONE, dtype=np.int8)
+        if hidden:
+            seats, slots = zip(*hidden)
+            hands[:, seats, slots] = pool[order[:, : len(hidden)]]
+        coins = np.tile(np.array([p.coins for p in players], dtype=np.int16), (self.worlds, 1))
+        return hands, coins
+
+    def _play_out(self, hands: np.ndarray, coins: np.ndarray, turn: np.ndarray) -> np.ndarray:
+        worlds, seats, _ = hands.shape
+        world = np.arange(worlds)
+        # Rows are picked out by flat index, which numpy does much faster than by a pair of index arrays
+        row = world * seats
+        # Each slot on its own, reducing over an axis of two is far slower than comparing two arrays
+        a, b = hands[:, :, 0].copy(), hands[:, :, 1].copy()
+        flat_a, flat_b, flat_coins = a.ravel(), b.ravel(), coins.ravel()
+        for _ in range(self.turns):
+            alive = (a != GONE) | (b != GONE)
+            playing = alive.sum(axis=1) > 1
+            if not playing.any():
+                break
+
+            current = row + turn
+            held_a, held_b = flat_a[current], flat_b[current]
+            money = flat_coins[current]
+            coup = playing & (money >= 7)
+            rest = playing & ~coup
+            assassinate = rest & (money >= 3) & _holds(held_a, held_b, Influence.ASSASSIN)
+            rest &= ~assassinate
+            tax = rest & _holds(held_a, held_b, Influence.DUKE)
+            rest &= ~tax
+            steal = rest & _holds(held_a, held_b, Influence.CAPTAIN)
+            income = rest & ~steal
+
+            # A random opponent still in the game
+            scores = self.rng.random((worlds, seats))
+            scores[~alive] = -1
+            scores.ravel()[current] = -1
+            targeted = row + scores.argmax(axis=1)
+            defending_a, defending_b = flat_a[targeted], flat_b[targeted]
+            contessa = _holds(defending_a, defending_b, Influence.CONTESSA)
+            blocks_steal = _holds(defending_a, defending_b, Influence.CAPTAIN) | _holds(
+                defending_a, defending_b, Influence.AMBASSADOR
+            )
+
+            stolen = np.where(steal & ~blocks_steal, np.minimum(flat_coins[targeted], 2), 0)
+            flat_coins[targeted] -= stolen
+            flat_coins[current] += stolen + 3 * tax + income - 7 * coup - 3 * assassinate
+
+            loses = coup | (assassinate & ~contessa)
+            first = (defending_a != GONE) & ((defending_b == GONE) | (self.rng.random(worlds) < 0.5))
+            flat_a[targeted[loses & first]] = GONE
+            flat_b[targeted[loses & ~first]] = GONE
+
+            # The next seat along still in the game, finished worlds stay where they are
+            alive = (a != GONE) | (b != GONE)
+            following = (turn[:, None] + np.arange(1, seats + 1)) % seats
+            first_alive = np.take_along_axis(alive, following, axis=1).argmax(axis=1)
+            turn = np.where(playing, following[world, first_alive], turn)
+
+        # Worlds still going at the end go to whoever leads on influence, then coins
+        standing = ((a != GONE).astype(np.int16) + (b != GONE)) * 1000 + coins
+        return standing.argmax(axis=1)
+
+
+def _holds(a: np.ndarray, b: np.ndarray, influence: Influence) -> np.ndarray:
+    return (a == influence.value) | (b == influence.value)
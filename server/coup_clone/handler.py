@@ -1,45 +1,168 @@
 import functools
-import traceback
-from typing import Any, Callable
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
 
+from aiosqlite import Connection
 from socketio import AsyncNamespace
 from socketio.exceptions import ConnectionRefusedError
 
-from coup_clone import db
+from coup_clone.cluster import Cluster
+from coup_clone.db import ConnectionPool, reuse_cursor
+from coup_clone.db.games import TurnAction
 from coup_clone.db.players import Influence
+from coup_clone.db.sessions import SessionsTable
+from coup_clone.db.writer import Writer
+from coup_clone.engine import GameEngine
+from coup_clone.instrumentation import (
+    Instrumentation,
+    RequestStats,
+    current_request,
+    logger,
+)
 from coup_clone.managers.exceptions import GameNotFoundException, UserException
 from coup_clone.managers.game import ExchangeInfluence, GameManager
 from coup_clone.managers.notifications import NotificationsManager
-from coup_clone.managers.session import NoActiveSessionException, SessionManager
+from coup_clone.managers.queue import QueueManager
+from coup_clone.managers.session import (
+    SESSION_KEY,
+    SessionManager,
+    forwarded_session_id,
+)
 from coup_clone.request import Request
+from coup_clone.scope import request_scope
+from coup_clone.utils import not_null
 
 
 def with_request(f: Callable[..., Any]) -> Callable[..., Any]:
+    """Runs the event on a connection of its own, only its changes are written as a job on the writer"""
+
+    @functools.wraps(f)
+    async def wrapper(self: "Handler", sid: str, *args: Any) -> Any:
+        async with request_scope(), self.read_pool.acquire() as conn:
+            session = await self.session_manager.get(conn, sid)
+            request = Request(
+                sid=sid,
+                conn=conn,
+                session=session,
+                engine=self.engine,
+                writer=self.writer,
+            )
+            try:
+                return await f(
+                    self,
+                    request,
+                    *args,
+                )
+            finally:
+                request.rollback()
+
+    return wrapper
+
+
+def with_write_request(f: Callable[..., Any]) -> Callable[..., Any]:
+    """Runs the whole event as a job on the writer, for events that insert or delete rows as they go"""
+
+    @functools.wraps(f)
+    async def wrapper(self: "Handler", sid: str, *args: Any) -> Any:
+        async def run(conn: Connection) -> Any:
+            session = await self.session_manager.get(conn, sid)
+            request = Request(
+                sid=sid,
+                conn=conn,
+                session=session,
+                engine=self.engine,
+            )
+            try:
+                return await f(
+                    self,
+                    request,
+                    *args,
+                )
+            finally:
+                request.rollback()
+
+        async with request_scope():
+            return await self.writer.submit(run)
+
+    return wrapper
+
+
+def with_read_request(f: Callable[..., Any]) -> Callable[..., Any]:
     @functools.wraps(f)
-    async def wrapper(self: "Handler", sid: str, *args: Any) -> None:
-        async with db.open() as conn:
+    async def wrapper(self: "Handler", sid: str, *args: Any) -> Any:
+        async with self.read_pool.acquire() as conn:
+            session = await self.session_manager.get(conn, sid, fill_cache=False)
+            request = Request(
+                sid=sid,
+                conn=conn,
+                session=session,
+                engine=self.engine,
+            )
             try:
-                session = await self.session_manager.get(conn, sid)
-                await f(
+                return await f(
                     self,
-                    Request(
-                        sid=sid,
-                        conn=conn,
-                        session=session,
-                    ),
+                    request,
                     *args,
                 )
-            except NoActiveSessionException:
-                raise
+            finally:
+                request.rollback()
 
     return wrapper
 
 
+def routed(game_id: Optional[Callable[..., str]] = None) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Runs the event in the queue for its game on the worker that owns it, the player's current game unless given"""
+
+    def decorator(f: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(f)
+        async def wrapper(self: "Handler", sid: str, *args: Any) -> Any:
+            session_id = await self.session_manager.get_id(sid)
+            game = game_id(*args) if game_id is not None else await self.current_game(session_id)
+            if game is None:
+                return await f(self, sid, *args)
+            if self.cluster is not None and not self.cluster.owns(game):
+                owner = self.cluster.owner(game)
+                return await self.cluster.call(owner, f.__name__, game, sid, not_null(session_id), list(args))
+            return await self.run_in_game(game, lambda: f(self, sid, *args))
+
+        wrapper.local = f  # type: ignore[attr-defined]
+        return wrapper
+
+    return decorator
+
+
 def log_event(f: Callable[..., Any]) -> Callable[..., Any]:
     @functools.wraps(f)
-    async def wrapper(self: "Handler", sid: str, *args: Any) -> None:
-        print(f.__name__, sid)
-        await f(self, sid, *args)
+    async def wrapper(self: "Handler", sid: str, *args: Any) -> Any:
+        stats = RequestStats()
+        token = current_request.set(stats)
+        error = None
+        start = time.perf_counter()
+        try:
+            return await f(self, sid, *args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            current_request.reset(token)
+            self.instrumentation.observe(f.__name__, duration, stats, error)
+            logger.info(
+                f.__name__,
+                exc_info=error if error is not None and not isinstance(error, UserException) else None,
+                extra={
+                    "fields": {
+                        "event": f.__name__,
+                        "sid": sid,
+                        "duration_ms": round(duration * 1000, 3),
+                        "db_ms": round(stats.db_seconds * 1000, 3),
+                        "emit_ms": round(stats.emit_seconds * 1000, 3),
+                        "statements": stats.statements,
+                        "error": type(error).__name__ if error is not None else None,
+                    }
+                },
+            )
 
     return wrapper
 
@@ -48,15 +171,17 @@ def socket_response(f: Callable[..., Any]) -> Callable[..., Any]:
     @functools.wraps(f)
     async def wrapper(self: "Handler", *args: Any) -> dict:
         try:
-            await f(
+            result = await f(
                 self,
                 *args,
             )
-            return {
+            response = {
                 "status": "success",
             }
+            if result is not None:
+                response["data"] = result
+            return response
         except UserException as e:
-            traceback.print_exc()
             return {"status": "error", "error": e.as_error_response()}
 
     return wrapper
@@ -65,50 +190,161 @@ def socket_response(f: Callable[..., Any]) -> Callable[..., Any]:
 class Handler(AsyncNamespace):
     def __init__(
         self,
+        writer: Writer,
+        read_pool: ConnectionPool,
         session_manager: SessionManager,
         game_manager: GameManager,
         notifications_manager: NotificationsManager,
+        queue_manager: QueueManager,
+        instrumentation: Instrumentation,
+        cluster: Optional[Cluster] = None,
+        engine: Optional[GameEngine] = None,
     ):
+        self.writer = writer
+        self.read_pool = read_pool
         self.session_manager = session_manager
         self.game_manager = game_manager
         self.notifications_manager = notifications_manager
+        self.queue_manager = queue_manager
+        self.instrumentation = instrumentation
+        self.cluster = cluster
+        self.engine = engine
+        if cluster is not None:
+            cluster.handle_calls(self.handle_forwarded)
+        if game_manager.deadlines is not None:
+            game_manager.deadlines.handle_expired(self.expire_deadline)
         super().__init__()
 
+    async def current_game(self, session_id: Optional[str]) -> Optional[str]:
+        if session_id is None:
+            return None
+        cached = self.session_manager.cached(session_id)
+        if cached is not None:
+            return cached.game_id
+        async with self.read_pool.acquire() as conn:
+            async with reuse_cursor(conn) as cursor:
+                return await SessionsTable.get_game_id(cursor, session_id)
+
+    async def run_in_game(self, game_id: str, move: Callable[[], Awaitable[Any]]) -> Any:
+        if self.cluster is not None:
+            await self.cluster.take_over(game_id)
+        return await self.queue_manager.run(game_id, move)
+
+    async def handle_forwarded(self, event: str, game_id: str, sid: str, session_id: str, args: list) -> Any:
+        handler: Optional[Callable[..., Any]] = getattr(getattr(self, event, None), "local", None)
+        if handler is None:
+            raise Exception(f"Event {event} can't be forwarded")
+        local = handler
+        token = forwarded_session_id.set(session_id)
+        try:
+            return await self.run_in_game(game_id, lambda: local(self, sid, *args))
+        finally:
+            forwarded_session_id.reset(token)
+
+    async def expire_deadline(self, game_id: str, deadline: datetime) -> None:
+        if self.cluster is not None and not self.cluster.owns(game_id):
+            return
+
+        async def expire() -> None:
+            async with request_scope(), self.read_pool.acquire() as conn:
+                await self.game_manager.expire_deadline(conn, game_id, deadline, self.engine, self.writer)
+
+        await self.run_in_game(game_id, expire)
+
     @log_event
-    async def on_connect(self, sid: str, environ: dict, auth: dict) -> None:
-        async with db.open() as conn:
-            session = await self.session_manager.setup(conn, sid, auth)
-            game = auth.get("game", None) if auth else None
-            if game:
+    async def on_connect(self, sid: str, environ: dict, auth: Optional[dict] = None) -> None:
+        async def setup(conn: Connection) -> None:
+            await self.session_manager.setup(conn, sid, auth)
+
+        auth = auth or {}
+        session_id = auth.get(SESSION_KEY, None)
+        cached = await self.session_manager.resume(sid, session_id) if session_id else None
+        if cached is None:
+            # The session is kept even if joining the requested game is refused below
+            async with request_scope():
+                await self.writer.submit(setup)
+
+        game = auth.get("game", None)
+        if (
+            game
+            and not (cached is not None and cached.game_id == game)
+            and not await self.join_requested_game(sid, game)
+        ):
+            raise ConnectionRefusedError("invalid game id")
+
+        # The last revision the client saw before it lost its connection
+        revision = auth.get("revision", None)
+        if isinstance(revision, int):
+            await self.resume_game(sid, revision)
+
+    @routed()
+    async def resume_game(self, sid: str, revision: int) -> None:
+        # Scoped so what it sends keeps its place among the game's other notifications
+        async with request_scope():
+            session_id = not_null(await self.session_manager.get_id(sid))
+            cached = self.session_manager.cached(session_id)
+            game_id = cached.game_id if cached is not None else None
+            player_id = cached.player_id if cached is not None else None
+            if game_id is not None and player_id is not None:
+                if await self.notifications_manager.resume(game_id, player_id, revision, to=sid):
+                    return
+
+            async with self.read_pool.acquire() as conn:
+                session = await self.session_manager.get(conn, sid, fill_cache=False)
                 player = await session.get_player()
-                if player:
-                    if player.game_id != game:
-                        raise ConnectionRefusedError("invalid game id")
-                else:
-                    try:
-                        await self.game_manager.join(Request(sid, conn=conn, session=session), game)
-                    except GameNotFoundException:
-                        raise ConnectionRefusedError("invalid game id")
+                if player is None:
+                    return
+                if cached is None and await self.notifications_manager.resume(
+                    player.game_id, player.id, revision, to=sid
+                ):
+                    return
+                await self.notifications_manager.notify_player(conn, player)
+
+    @routed(lambda game: game)
+    async def join_requested_game(self, sid: str, game: str) -> bool:
+        async def join(conn: Connection) -> bool:
+            session = await self.session_manager.get(conn, sid)
+            player = await session.get_player()
+            if player:
+                return player.game_id == game
+
+            request = Request(sid, conn=conn, session=session, engine=self.engine)
+            try:
+                await self.game_manager.join(request, game)
+            except GameNotFoundException:
+                return False
+            finally:
+                request.rollback()
+            return True
+
+        async with request_scope():
+            return await self.writer.submit(join)
+
+    async def on_disconnect(self, sid: str) -> None:
+        self.session_manager.disconnect(sid)
 
     @socket_response
     @log_event
-    @with_request
+    @with_write_request
     async def on_create_game(self, request: Request) -> None:
         await self.game_manager.create(request)
 
     @socket_response
+    @routed(lambda game_id: game_id.lower())
     @log_event
-    @with_request
+    @with_write_request
     async def on_join_game(self, request: Request, game_id: str) -> None:
         await self.game_manager.join(request, game_id.lower())
 
     @socket_response
+    @routed()
     @log_event
-    @with_request
+    @with_write_request
     async def on_leave_game(self, request: Request) -> None:
         await self.game_manager.leave(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_initialize_game(self, request: Request) -> None:
@@ -116,60 +352,93 @@ class Handler(AsyncNamespace):
         await self.notifications_manager.notify_player(request.conn, player)
 
     @socket_response
+    @routed()
+    @log_event
+    @with_request
+    async def on_resync_game(self, request: Request) -> None:
+        player = await request.session.get_playerX()
+        await self.notifications_manager.resync_player(request.conn, player)
+
+    @socket_response
+    @log_event
+    @with_read_request
+    async def on_get_events(self, request: Request, before_id: Optional[int] = None) -> dict:
+        player = await request.session.get_playerX()
+        return await self.notifications_manager.get_events(request.conn, player.game_id, before_id)
+
+    @socket_response
+    @routed()
+    @log_event
+    @with_read_request
+    async def on_get_legal_moves(self, request: Request) -> list[dict]:
+        # Routed so it is answered by the worker holding the latest copy of the game, between its moves
+        return await self.game_manager.get_legal_moves(request)
+
+    @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_set_name(self, request: Request, name: str) -> None:
         await self.game_manager.set_name(request, name)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_start_game(self, request: Request) -> None:
         await self.game_manager.start(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_take_action(self, request: Request, action: dict) -> None:
-        await self.game_manager.take_action(request, action["action"], action.get("target", None))
+        await self.game_manager.take_action(request, TurnAction(action["action"]), action.get("target", None))
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_accept_action(self, request: Request) -> None:
         await self.game_manager.accept_action(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_reveal(self, request: Request, influence: int) -> None:
         await self.game_manager.reveal_influence(request, Influence(influence))
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_challenge(self, request: Request) -> None:
         await self.game_manager.challenge(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_block(self, request: Request) -> None:
         await self.game_manager.block(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_accept_block(self, request: Request) -> None:
         await self.game_manager.accept_block(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_challenge_block(self, request: Request) -> None:
         await self.game_manager.challenge_block(request)
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_exchange(self, request: Request, exchange: list[dict]) -> None:
@@ -185,6 +454,7 @@ class Handler(AsyncNamespace):
         )
 
     @socket_response
+    @routed()
     @log_event
     @with_request
     async def on_restart(self, request: Request) -> None:
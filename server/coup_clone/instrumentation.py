@@ -0,0 +1,178 @@
+import bisect
+import copy
+import json
+import logging
+import os
+import queue
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields, is_dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
+
+from socketio import AsyncServer
+
+LOG_LEVEL = os.environ.get("COUP_LOG_LEVEL", "INFO")
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+STATEMENT_BUCKETS: list[float] = [1, 2, 5, 10, 20, 50, 100, 200]
+
+logger = logging.getLogger("coup_clone")
+
+
+@dataclass
+class RequestStats:
+    db_seconds: float = 0
+    emit_seconds: float = 0
+    statements: int = 0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def record_queries(seconds: float, statements: int) -> None:
+    stats = current_request.get()
+    if stats is not None:
+        stats.db_seconds += seconds
+        stats.statements += statements
+
+
+@dataclass
+class Histogram:
+    buckets: list[float]
+    counts: list[int] = field(default_factory=list)
+    sum: float = 0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        prefix = f"{labels}," if labels else ""
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bucket}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+@dataclass
+class HandlerMetrics:
+    duration: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+    db: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+    emit: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+    statements: Histogram = field(default_factory=lambda: Histogram(STATEMENT_BUCKETS))
+    errors: dict[str, int] = field(default_factory=dict)
+
+
+class Instrumentation:
+    def __init__(self) -> None:
+        self.handlers: dict[str, HandlerMetrics] = {}
+        self.sources: dict[str, Any] = {}
+
+    def track(self, prefix: str, source: Any) -> None:
+        self.sources[prefix] = source
+
+    def observe(self, handler: str, seconds: float, stats: RequestStats, error: Optional[Exception]) -> None:
+        if handler not in self.handlers:
+            self.handlers[handler] = HandlerMetrics()
+        metrics = self.handlers[handler]
+        metrics.duration.observe(seconds)
+        metrics.db.observe(stats.db_seconds)
+        metrics.emit.observe(stats.emit_seconds)
+        metrics.statements.observe(stats.statements)
+        if error is not None:
+            name = type(error).__name__
+            metrics.errors[name] = metrics.errors.get(name, 0) + 1
+
+    def render(self) -> str:
+        lines = []
+        histograms = [
+            ("coup_handler_duration_seconds", "duration"),
+            ("coup_handler_db_seconds", "db"),
+            ("coup_handler_emit_seconds", "emit"),
+            ("coup_handler_statements", "statements"),
+        ]
+        for name, attribute in histograms:
+            lines.append(f"# TYPE {name} histogram")
+            for handler, metrics in sorted(self.handlers.items()):
+                lines.extend(getattr(metrics, attribute).render(name, f'handler="{handler}"'))
+
+        lines.append("# TYPE coup_handler_errors_total counter")
+        for handler, metrics in sorted(self.handlers.items()):
+            for error, count in sorted(metrics.errors.items()):
+                lines.append(f'coup_handler_errors_total{{handler="{handler}",error="{error}"}} {count}')
+
+        for prefix, source in self.sources.items():
+            metrics = getattr(source, "metrics", source)
+            if not is_dataclass(metrics):
+                continue
+            for f in fields(metrics):
+                value = getattr(metrics, f.name)
+                if isinstance(value, Histogram):
+                    lines.append(f"# TYPE coup_{prefix}_{f.name} histogram")
+                    lines.extend(value.render(f"coup_{prefix}_{f.name}", ""))
+                elif isinstance(value, (int, float)):
+                    lines.append(f"# TYPE coup_{prefix}_{f.name} gauge")
+                    lines.append(f"coup_{prefix}_{f.name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedServer(AsyncServer):
+    async def emit(self, *args: Any, **kwargs: Any) -> None:
+        start = time.perf_counter()
+        try:
+            await super().emit(*args, **kwargs)
+        finally:
+            stats = current_request.get()
+            if stats is not None:
+                stats.emit_seconds += time.perf_counter() - start
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _BufferedHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def setup_logging() -> QueueListener:
+    # Log records are handed to a background thread so that handlers never block on writing them out
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(records, output, respect_handler_level=True)
+
+    logger.handlers = [_BufferedHandler(records)]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return listener
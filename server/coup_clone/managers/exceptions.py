@@ -49,3 +49,28 @@ class NoActiveSessionException(UserException):
 class NotEnoughPlayersException(UserException):
     def __init__(self, game_id: str):
         super().__init__(f"Not enough players in the game with ID: {game_id}")
+
+
+class WorkerUnavailableException(UserException):
+    def __init__(self, worker_id: str):
+        super().__init__(f"Worker {worker_id} is not responding")
+
+
+class GameMovingException(UserException):
+    def __init__(self, game_id: str):
+        super().__init__(f"Game {game_id} is moving to another worker, try again")
+
+
+class GameBusyException(UserException):
+    def __init__(self, game_id: str):
+        super().__init__(f"Too many moves waiting for game {game_id}, try again")
+
+
+class IllegalMoveException(UserException):
+    def __init__(self, move: str):
+        super().__init__(f"Can't {move.replace('_', ' ')} right now")
+
+
+class NotEnoughCardsException(UserException):
+    def __init__(self):
+        super().__init__("Not enough cards left in the deck")
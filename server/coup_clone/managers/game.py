@@ -1,31 +1,46 @@
+import os
 import random
 import string
 from collections import Counter
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 from sqlite3 import IntegrityError
 from typing import Optional, Tuple
 
+from aiosqlite import Connection
 from socketio import AsyncServer
 
+from coup_clone import deck, rules, turns
 from coup_clone.actions import get_action
+from coup_clone.cluster import Cluster
 from coup_clone.db.events import EventsTable
-from coup_clone.db.games import GamesTable, GameState, TurnAction, TurnState
-from coup_clone.db.players import Influence, PlayerRow, PlayersTable, PlayerState
+from coup_clone.db.games import GameState, TurnAction, TurnState
+from coup_clone.db.players import Influence, PlayerRow, PlayerState
+from coup_clone.db.table import UnitOfWork
+from coup_clone.db.writer import Writer
+from coup_clone.deadlines import DeadlineScheduler
+from coup_clone.engine import GameEngine
 from coup_clone.managers.exceptions import (
     GameFullException,
     GameNotFoundException,
     InvalidGameStateException,
+    NoActiveSessionException,
     NotEnoughPlayersException,
     NotPlayerTurnException,
     PlayerAlreadyInGameException,
     PlayerNotHostException,
     PlayerNotInGameException,
 )
-from coup_clone.managers.notifications import NotificationsManager
+from coup_clone.managers.notifications import NotificationsManager, map_legal_move
 from coup_clone.models import Game, Player, get_shuffled_deck
-from coup_clone.request import Request
+from coup_clone.request import Request, commit, rollback
+from coup_clone.rules import Move, Transition
 from coup_clone.utils import not_null
 
+# Seconds an attempted action or a block waits on the other players before it goes through on its own, 0 waits for
+# as long as it takes, as games always did
+TURN_DEADLINE = int(os.environ.get("COUP_TURN_DEADLINE", "0"))
+
 
 @dataclass
 class ExchangeInfluence:
@@ -38,17 +53,35 @@ class GameManager:
         self,
         socket_server: AsyncServer,
         notifications_manager: NotificationsManager,
+        cluster: Optional[Cluster] = None,
+        deadlines: Optional[DeadlineScheduler] = None,
+        turn_deadline: int = TURN_DEADLINE,
     ):
         self.socket_server = socket_server
         self.notifications_manager = notifications_manager
-
-    async def _add_log_message(self, game: Game, message: str) -> None:
-        async with game.conn.cursor() as cursor:
-            await EventsTable.create(
-                cursor,
-                game_id=game.id,
-                message=message,
-            )
+        self.cluster = cluster
+        self.deadlines = deadlines
+        self.turn_deadline = turn_deadline
+
+    def _add_log_message(self, game: Game, message: str) -> None:
+        # Nothing reads the log before the move commits, so a move's messages are written together then
+        UnitOfWork.of(game.conn).append(EventsTable, game_id=game.id, message=message)
+
+    def _generate_game_id(self) -> str:
+        while True:
+            game_id = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
+            # Games are created on the worker that owns them
+            if self.cluster is None or self.cluster.owns(game_id):
+                return game_id
+
+    def _deadline(self) -> Optional[datetime]:
+        if self.turn_deadline <= 0:
+            return None
+        return datetime.utcnow() + timedelta(seconds=self.turn_deadline)
+
+    def _schedule_deadline(self, game: Game) -> None:
+        if self.deadlines is not None and game.row.turn_state_deadline is not None:
+            self.deadlines.schedule(game.id, game.row.turn_state_deadline)
 
     async def _get_player_in_game(self, request: Request) -> Player:
         player = await request.session.get_player()
@@ -61,38 +94,41 @@ class GameManager:
         if current_player is not None:
             raise PlayerAlreadyInGameException(current_player.game_id)
 
-        game_id = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
-        game = await Game.create(request.conn, id=game_id, deck="".join(str(c) for c in get_shuffled_deck()))
+        game_id = self._generate_game_id()
+        game = await Game.create(request.conn, request.engine, id=game_id, deck=deck.pack(get_shuffled_deck()))
         hand = await game.take_from_deck()
-        player = await Player.create(request.conn, game_id=game.id, host=True, influence_a=hand[0], influence_b=hand[1])
+        player = await Player.create(
+            request.conn, request.engine, game_id=game.id, host=True, influence_a=hand[0], influence_b=hand[1]
+        )
         await request.session.set_player(player.id)
         await game.reset_turn_state(player.id)
-        await request.conn.commit()
+        await request.commit()
         self.socket_server.enter_room(request.sid, game.id)
         await self.notifications_manager.notify_session(request.session)
 
     async def join(self, request: Request, game_id: str) -> Tuple[str, PlayerRow]:
-        async with request.conn.cursor() as cursor:
-            current_player = await request.session.get_player()
-            if current_player is not None:
-                raise PlayerAlreadyInGameException(current_player.game_id)
-            game_row = await GamesTable.get(cursor, game_id)
-            if game_row is None:
-                raise GameNotFoundException(game_id)
-            game = Game(request.conn, await GamesTable.get(cursor, game_id))
-            hand = await game.take_from_deck()
-            try:
-                player = await PlayersTable.create(cursor, game_id=game_id, influence_a=hand[0], influence_b=hand[1])
-            except IntegrityError as e:
-                if str(e) == "Game full":
-                    raise GameFullException(game_id)
-            await request.session.set_player(player.id)
-            await request.conn.commit()
+        current_player = await request.session.get_player()
+        if current_player is not None:
+            raise PlayerAlreadyInGameException(current_player.game_id)
+        game = await Game.get(request.conn, game_id, request.engine)
+        if game is None:
+            raise GameNotFoundException(game_id)
+        hand = await game.take_from_deck()
+        try:
+            player = await Player.create(
+                request.conn, request.engine, game_id=game_id, influence_a=hand[0], influence_b=hand[1]
+            )
+        except IntegrityError as e:
+            if str(e) == "Game full":
+                raise GameFullException(game_id)
+            raise
+        await request.session.set_player(player.id)
+        await request.commit()
 
         self.socket_server.enter_room(request.sid, game_id)
         await self.notifications_manager.broadcast_game(request.conn, game_id)
         await self.notifications_manager.notify_session(request.session)
-        return (game_id, player)
+        return (game_id, player.row)
 
     async def leave(self, request: Request) -> None:
         player = await request.session.get_player()
@@ -114,18 +150,18 @@ class GameManager:
                 revealed_influence_b=True,
             )
 
-            players_remaining = [p for p in await game.get_players() if not p.is_out]
-            await self._add_log_message(game, f"{player.row.name} left the game")
-            if len(players_remaining) == 1:
-                winner = players_remaining[0]
-                await self._add_log_message(game, f"{winner.row.name} wins the game!")
+            winner = turns.winner(p.row for p in await game.get_players())
+            self._add_log_message(game, f"{player.row.name} left the game")
+            if winner is not None:
+                self._add_log_message(game, f"{winner.name} wins the game!")
                 await game.update(state=GameState.FINISHED, winner_id=winner.id)
         elif game.row.state == GameState.LOBBY:
             await game.return_to_deck([player.influence_a, player.influence_b])
             await player.delete()
 
         await request.session.clear_current_player()
-        await request.conn.commit()
+        await request.commit()
+        await game.release_if_deleted()
         self.socket_server.leave_room(request.sid, game.id)
         await self.notifications_manager.broadcast_game(request.conn, game.id)
         await self.notifications_manager.notify_session(request.session)
@@ -133,23 +169,21 @@ class GameManager:
     async def set_name(self, request: Request, name: str) -> None:
         if len(name) < 2:
             raise Exception("Name must be minimum of 2 characters")
-        async with request.conn.cursor() as cursor:
-            player = await self._get_player_in_game(request)
-            await PlayersTable.update(cursor, player.id, name=name, state=PlayerState.READY)
-            await request.conn.commit()
+        player = await self._get_player_in_game(request)
+        await player.update(name=name, state=PlayerState.READY)
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def start(self, request: Request) -> None:
-        async with request.conn.cursor() as cursor:
-            player = await self._get_player_in_game(request)
-            game = await player.get_game()
-            players = await game.get_players()
-            if len(players) < 2:
-                raise NotEnoughPlayersException(game.id)
-            await GamesTable.update(cursor, player.game_id, state=GameState.RUNNING)
-            await game.next_player_turn()
-            await self._add_log_message(game, "Welcome to Coup!")
-            await request.conn.commit()
+        player = await self._get_player_in_game(request)
+        game = await player.get_game()
+        players = await game.get_players()
+        if len(players) < 2:
+            raise NotEnoughPlayersException(game.id)
+        await game.update(state=GameState.RUNNING)
+        await game.next_player_turn()
+        self._add_log_message(game, "Welcome to Coup!")
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def take_action(self, request: Request, turn_action: TurnAction, target_id: Optional[int]) -> None:
@@ -158,9 +192,7 @@ class GameManager:
         if game.row.player_turn_id != player.id:
             raise NotPlayerTurnException()
 
-        if game.row.turn_state != TurnState.START:
-            raise InvalidGameStateException(game.id)
-
+        transition = rules.transition(game.row, player.id, Move.TAKE_ACTION, action=turn_action)
         action = get_action(turn_action)
 
         if player.row.coins >= 10 and turn_action != TurnAction.COUP:
@@ -170,49 +202,44 @@ class GameManager:
         if action.is_targetted:
             if target_id is None:
                 raise Exception("Missing target")
-            target = await Player.get(request.conn, target_id)
+            target = await Player.get(request.conn, target_id, request.engine)
             if target is None:
                 raise Exception("Really missing target")
 
-        if action.cost > 0:
-            if action.cost > player.row.coins:
-                raise Exception("Player can't affort it")
-            await player.decrement_coins(action.cost)
+        if action.cost > player.row.coins:
+            raise Exception("Player can't affort it")
 
-        await game.update(turn_action=turn_action, target_id=target_id)
+        await game.apply_changes(turns.take_action(player.row, turn_action, action.cost, target_id))
 
-        if action.influence is None and not action.can_be_blocked_by:
-            if action.effect:
-                await action.effect(game)
-            await self._add_log_message(
+        if transition.resolves:
+            await self._apply(game, transition)
+        elif self.turn_deadline > 0:
+            await game.set_action_deadline(turn_action, self.turn_deadline)
+            self._add_log_message(
                 game,
-                action.success_message.format(
+                not_null(action.attempt_message).format(
                     player=player.row.name, target=target.row.name if target is not None else None
                 ),
             )
-            if action.next_state == TurnState.START:
-                await game.next_player_turn()
-            else:
-                await game.update(turn_state=action.next_state)
         else:
             await game.update(
-                turn_state=TurnState.ATTEMPTED,
+                turn_state=transition.next_state,
             )
-            await self._add_log_message(
+            self._add_log_message(
                 game,
                 not_null(action.attempt_message).format(
                     player=player.row.name, target=target.row.name if target is not None else None
                 ),
             )
 
-        await request.conn.commit()
+        await request.commit()
+        self._schedule_deadline(game)
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def accept_action(self, request: Request) -> None:
         player = await self._get_player_in_game(request)
         game = await player.get_game()
-        if game.row.turn_state != TurnState.ATTEMPTED:
-            raise Exception("Invalid turn state")
+        transition = rules.transition(game.row, player.id, Move.ACCEPT_ACTION)
 
         await player.update(accepts_action=True)
 
@@ -222,27 +249,68 @@ class GameManager:
             raise Exception("Get a better exception..")
 
         if all_players_accepted:
+            await self._apply(game, transition)
+
+        await request.commit()
+        await self.notifications_manager.broadcast_game(request.conn, player.game_id)
+        await self.notifications_manager.notify_hand(game, current_player)
+
+    async def _apply(self, game: Game, transition: Transition) -> None:
+        if transition.resolves:
             action = get_action(not_null(game.row.turn_action))
             if action.effect:
                 await action.effect(game)
+            current_player = not_null(await game.get_current_player())
             target = await game.get_target_player()
-            await self._add_log_message(
+            self._add_log_message(
                 game,
                 action.success_message.format(
-                    player=player.row.name, target=target.row.name if target is not None else None
+                    player=current_player.row.name, target=target.row.name if target is not None else None
                 ),
             )
-            if action.next_state == TurnState.START:
-                await game.next_player_turn()
-            else:
-                await game.update(turn_state=action.next_state)
+        players = [p.row for p in await game.get_players()]
+        await game.apply_changes(turns.advance(game.row, players, transition.next_state))
 
-        await request.conn.commit()
-        await self.notifications_manager.broadcast_game(request.conn, player.game_id)
-        await self.notifications_manager.notify_player(request.conn, current_player)
+    async def expire_deadline(
+        self,
+        conn: Connection,
+        game_id: str,
+        deadline: datetime,
+        engine: Optional[GameEngine] = None,
+        writer: Optional[Writer] = None,
+    ) -> None:
+        game = await Game.get(conn, game_id, engine)
+        # Any move since the deadline was set will have replaced or cleared it
+        if game is None or game.row.state != GameState.RUNNING or game.row.turn_state_deadline != deadline:
+            return
+        current_player = await game.get_current_player()
+        if current_player is None:
+            return
+
+        try:
+            match game.row.turn_state:
+                case TurnState.ATTEMPTED:
+                    for player in await game.get_players():
+                        if player.id != current_player.id and not player.is_out and not player.row.accepts_action:
+                            await player.update(accepts_action=True)
+                    await self._apply(game, rules.accepted(not_null(game.row.turn_action)))
+                case TurnState.BLOCKED:
+                    transition = rules.transition(game.row, current_player.id, Move.ACCEPT_BLOCK)
+                    self._add_log_message(game, f"{current_player.row.name} backs down")
+                    await self._apply(game, transition)
+                case _:
+                    return
+            await commit(conn, engine, writer)
+        finally:
+            rollback(conn, engine)
+
+        await self.notifications_manager.broadcast_game(conn, game_id)
+        try:
+            await self.notifications_manager.notify_hand(game, current_player)
+        except NoActiveSessionException:
+            pass
 
     async def reveal_influence(self, request: Request, influence: Influence) -> None:
-        # This is all horrible, must refactor... writing this makes me feel better in the meantime
         player = await self._get_player_in_game(request)
         game = await player.get_game()
 
@@ -250,134 +318,41 @@ class GameManager:
         if current_player is None:
             raise Exception("Current player is missing")
 
-        if game.row.turn_state not in {
-            TurnState.TARGET_REVEALING,
-            TurnState.CHALLENGED,
-            TurnState.CHALLENGER_REVEALING,
-            TurnState.BLOCK_CHALLENGED,
-            TurnState.BLOCK_CHALLENGER_REVEALING,
-        }:
-            raise Exception("Invalid turn state")
-
-        if game.row.turn_state == TurnState.CHALLENGED and player.id != game.row.player_turn_id:
-            raise Exception("Expecting current turn player to reveal")
-
-        if game.row.turn_state == TurnState.TARGET_REVEALING and player.id != game.row.target_id:
-            raise Exception("Expecting current turn target to reveal")
-
-        if game.row.turn_state == TurnState.CHALLENGER_REVEALING and player.id != game.row.challenged_by_id:
-            raise Exception("Expecting current turn challenger to reveal")
-
-        if game.row.turn_state == TurnState.BLOCK_CHALLENGED and player.id != game.row.blocked_by_id:
-            raise Exception("Expecting blocker to reveal")
-
-        if game.row.turn_state == TurnState.BLOCK_CHALLENGER_REVEALING and player.id != game.row.block_challenged_by_id:
-            raise Exception("Expecting blocker to reveal")
-
-        revealed = None
-        if player.row.influence_a == influence and not player.row.revealed_influence_a:
-            revealed = "A"
-            await player.update(revealed_influence_a=True)
-        elif player.row.influence_b == influence and not player.row.revealed_influence_b:
-            revealed = "B"
-            await player.update(revealed_influence_b=True)
-        else:
-            raise Exception("Invalid influence for reveal")
-
-        await self._add_log_message(game, f"{player.row.name} revealed a {influence.name}")
-
-        action = get_action(not_null(game.row.turn_action))
-        target = await game.get_target_player()
-        match game.row.turn_state:
-            case TurnState.CHALLENGED:
-                if action.influence == influence:
-                    if action.effect:
-                        await action.effect(game)
-                    await game.return_to_deck([influence])
-                    new_card = await game.take_from_deck(1)
-                    await self._add_log_message(
-                        game,
-                        action.success_message.format(
-                            player=player.row.name, target=target.row.name if target is not None else None
-                        ),
-                    )
-                    match revealed:
-                        case "A":
-                            await player.update(influence_a=new_card[0], revealed_influence_a=False)
-                        case "B":
-                            await player.update(influence_b=new_card[0], revealed_influence_b=False)
-                    await game.update(turn_state=TurnState.CHALLENGER_REVEALING)
-                else:
-                    await game.next_player_turn()
-
-            case TurnState.BLOCK_CHALLENGED:
-                if influence in action.can_be_blocked_by:
-                    await self._add_log_message(
-                        game, f"{player.row.name} succesfully blocked {current_player.row.name}"
-                    )
-                    await game.return_to_deck([influence])
-                    new_card = await game.take_from_deck(1)
-                    match revealed:
-                        case "A":
-                            await player.update(influence_a=new_card[0], revealed_influence_a=False)
-                        case "B":
-                            await player.update(influence_b=new_card[0], revealed_influence_b=False)
-                    await game.update(turn_state=TurnState.BLOCK_CHALLENGER_REVEALING)
-                else:
-                    if action.effect:
-                        await action.effect(game)
-                    await self._add_log_message(
-                        game,
-                        action.success_message.format(
-                            player=player.row.name, target=target.row.name if target is not None else None
-                        ),
-                    )
-                    if action.next_state == TurnState.START:
-                        await game.next_player_turn()
-                    else:
-                        await game.update(turn_state=action.next_state)
-
-            case TurnState.BLOCK_CHALLENGER_REVEALING:
-                await game.next_player_turn()
+        transition = rules.transition(game.row, player.id, Move.REVEAL, influence=influence)
+
+        await game.apply_changes(turns.reveal(game.row, player.row, influence, transition.proves))
+        self._add_log_message(game, f"{player.row.name} revealed a {influence.name}")
+        if transition.proves and game.row.turn_state == TurnState.BLOCK_CHALLENGED:
+            self._add_log_message(game, f"{player.row.name} succesfully blocked {current_player.row.name}")
 
-            case _:
-                await game.update(turn_state=action.next_state)
+        await self._apply(game, transition)
 
         if player.is_out:
-            await self._add_log_message(game, f"{player.row.name} is out of the game!")
+            self._add_log_message(game, f"{player.row.name} is out of the game!")
 
-        players_remaining = [p for p in await game.get_players() if not p.is_out]
-        if len(players_remaining) == 1:
-            winner = players_remaining[0]
-            await self._add_log_message(game, f"{winner.row.name} wins the game!")
+        winner = turns.winner(p.row for p in await game.get_players())
+        if winner is not None:
+            self._add_log_message(game, f"{winner.name} wins the game!")
             await game.update(state=GameState.FINISHED, winner_id=winner.id)
 
-        await request.conn.commit()
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
-        await self.notifications_manager.notify_player(request.conn, player)
-        await self.notifications_manager.notify_player(request.conn, current_player)
+        await self.notifications_manager.notify_hand(game, player)
+        await self.notifications_manager.notify_hand(game, current_player)
 
     async def challenge(self, request: Request) -> None:
         player = await self._get_player_in_game(request)
         game = await player.get_game()
 
-        if game.row.turn_state != TurnState.ATTEMPTED:
-            raise Exception("Invalid turn state")
-
-        if game.row.player_turn_id == player.id:
-            raise Exception("Cannot challenge self")
-
-        action = get_action(not_null(game.row.turn_action))
-        if action.influence is None:
-            raise Exception("Cannot challenge this action")
+        transition = rules.transition(game.row, player.id, Move.CHALLENGE)
 
         current_player = await game.get_current_player()
         if current_player is None:
             raise Exception("Get a better exception..")
 
-        await self._add_log_message(game, f"{player.row.name} challenges {current_player.row.name}")
-        await game.update(turn_state=TurnState.CHALLENGED, challenged_by_id=player.id)
-        await request.conn.commit()
+        self._add_log_message(game, f"{player.row.name} challenges {current_player.row.name}")
+        await game.apply_changes(turns.challenge(player.row, transition.next_state))
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def block(self, request: Request) -> None:
@@ -387,59 +362,46 @@ class GameManager:
         if current_player is None:
             raise Exception("No current player")
 
-        if game.row.turn_state != TurnState.ATTEMPTED:
-            raise Exception("Invalid turn state")
-
-        if game.row.player_turn_id == player.id:
-            raise Exception("Cannot block self")
-
-        if game.row.target_id is not None and game.row.target_id != player.id:
-            raise Exception("Invalid requester for blocking")
+        transition = rules.transition(game.row, player.id, Move.BLOCK)
 
-        action = get_action(not_null(game.row.turn_action))
-
-        if not action.can_be_blocked_by:
-            raise Exception("Cannot block current action")
-
-        await game.update(turn_state=TurnState.BLOCKED, blocked_by_id=player.id)
-        await self._add_log_message(game, f"{player.row.name} blocks {current_player.row.name}")
-        await request.conn.commit()
+        changes = turns.block(player.row, transition.next_state)
+        changes.game.update(turn_state_modified=datetime.utcnow(), turn_state_deadline=self._deadline())
+        await game.apply_changes(changes)
+        self._add_log_message(game, f"{player.row.name} blocks {current_player.row.name}")
+        await request.commit()
+        self._schedule_deadline(game)
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def accept_block(self, request: Request) -> None:
         player = await self._get_player_in_game(request)
         game = await player.get_game()
-        if player.id != game.row.player_turn_id:
-            raise Exception("Current turn player can only accept blocks")
+        transition = rules.transition(game.row, player.id, Move.ACCEPT_BLOCK)
 
-        await self._add_log_message(game, f"{player.row.name} backs down")
-        await game.next_player_turn()
-        await request.conn.commit()
+        self._add_log_message(game, f"{player.row.name} backs down")
+        await self._apply(game, transition)
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def challenge_block(self, request: Request) -> None:
         player = await self._get_player_in_game(request)
         game = await player.get_game()
-        if player.id == game.row.blocked_by_id:
-            raise Exception("Player can't challenge own block")
+        transition = rules.transition(game.row, player.id, Move.CHALLENGE_BLOCK)
 
         blocking = await game.get_blocking_player()
         if blocking is None:
             raise Exception("There's no blockign player")
 
-        await game.update(turn_state=TurnState.BLOCK_CHALLENGED, block_challenged_by_id=player.id)
-        await self._add_log_message(game, f"{player.row.name} challenged {blocking.row.name}")
-        await request.conn.commit()
+        await game.apply_changes(turns.challenge_block(player.row, transition.next_state))
+        self._add_log_message(game, f"{player.row.name} challenged {blocking.row.name}")
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
 
     async def exchange(self, request: Request, exchanges: list[ExchangeInfluence]) -> None:
         player = await self._get_player_in_game(request)
         game = await player.get_game()
-        expected_influence = [Influence(int(i)) for i in game.row.deck[-2:]]
-        if not player.row.revealed_influence_a:
-            expected_influence.append(player.influence_a)
-        if not player.row.revealed_influence_b:
-            expected_influence.append(player.influence_b)
+        transition = rules.transition(game.row, player.id, Move.EXCHANGE)
+
+        expected_influence = turns.exchange_hand(game.row, player.row)
         received_influence = [e.influence for e in exchanges]
 
         if Counter(expected_influence) != Counter(received_influence):
@@ -451,30 +413,19 @@ class GameManager:
         if len(return_to_deck) != 2:
             raise Exception("Must return 2 to deck")
 
-        await game.take_from_deck(n=2)
-        await game.return_to_deck(return_to_deck)
+        await game.apply_changes(turns.exchange(game.row, player.row, keep_in_hand, return_to_deck))
 
-        if len(keep_in_hand) == 1:
-            if player.row.revealed_influence_a:
-                await player.update(influence_b=keep_in_hand[0])
-            elif player.row.revealed_influence_b:
-                await player.update(influence_a=keep_in_hand[0])
-            else:
-                raise Exception("Something weird has happened")
-        elif len(keep_in_hand) == 2:
-            await player.update(
-                influence_a=keep_in_hand[0],
-                influence_b=keep_in_hand[1],
-            )
-        else:
-            raise Exception("Something weird has happened")
-
-        await self._add_log_message(game, f"{player.row.name} returns 2 cards to the deck")
-        await game.next_player_turn()
+        self._add_log_message(game, f"{player.row.name} returns 2 cards to the deck")
+        await self._apply(game, transition)
 
-        await request.conn.commit()
+        await request.commit()
         await self.notifications_manager.broadcast_game(request.conn, player.game_id)
-        await self.notifications_manager.notify_player(request.conn, player)
+        await self.notifications_manager.notify_hand(game, player)
+
+    async def get_legal_moves(self, request: Request) -> list[dict]:
+        player = await self._get_player_in_game(request)
+        game = await player.get_game()
+        return [map_legal_move(move) for move in rules.legal_moves(game.row, player.row)]
 
     async def restart(self, request: Request) -> None:
         player = await self._get_player_in_game(request)
@@ -486,8 +437,8 @@ class GameManager:
             raise InvalidGameStateException(game.id)
 
         await game.reset()
-        await self._add_log_message(game, f"{player.row.name} has restarted the game")
+        self._add_log_message(game, f"{player.row.name} has restarted the game")
 
-        await request.conn.commit()
+        await request.commit()
 
         await self.notifications_manager.broadcast_reset(request)
@@ -1,20 +1,43 @@
+import asyncio
+import copy
+import functools
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
+
 from aiosqlite import Connection
 from socketio import AsyncServer
 
+from coup_clone import deck
+from coup_clone.db import reuse_cursor
 from coup_clone.db.events import EventRow, EventsTable
-from coup_clone.db.games import GameRow, GamesTable, TurnState
-from coup_clone.db.players import Influence, PlayerRow, PlayersTable
+from coup_clone.db.games import GameRow, GameState, TurnState
+from coup_clone.db.players import Influence, PlayerRow
+from coup_clone.engine import GameEngine
+from coup_clone.estimator import WinEstimator
+from coup_clone.instrumentation import logger
 from coup_clone.managers.exceptions import (
     GameNotFoundException,
     NoActiveSessionException,
     PlayerNotInGameException,
 )
 from coup_clone.models import Game, Player, Session
+from coup_clone.outbox import Outbox
 from coup_clone.request import Request
+from coup_clone.rules import LegalMove
+from coup_clone.scope import after_commit, scoped_value
+
+SNAPSHOT_EVENT_LIMIT = int(os.environ.get("COUP_SNAPSHOT_EVENT_LIMIT", "50"))
+# Deltas kept for each game so a reconnecting player can be sent just what they missed
+RESUME_BUFFER_SIZE = int(os.environ.get("COUP_RESUME_BUFFER_SIZE", "64"))
+EVENT_PAGE_LIMIT = 50
 
 
-def map_session(session: Session) -> dict:
-    return {"id": session.id, "player_id": session.player_id}
+def map_session(session_id: str, player_id: Optional[int]) -> dict:
+    return {"id": session_id, "player_id": player_id}
 
 
 def map_player(player: PlayerRow) -> dict:
@@ -55,40 +78,359 @@ def map_game(game: GameRow) -> dict:
     }
 
 
+def map_hand(player: PlayerRow, game: GameRow) -> dict:
+    return {
+        "influence_a": player.influence_a,
+        "influence_b": player.influence_b,
+        "top_of_deck": deck.peek(game.deck, 2)
+        if game.turn_state == TurnState.EXCHANGING and game.player_turn_id == player.id
+        else [],
+    }
+
+
+def map_legal_move(move: LegalMove) -> dict:
+    mapped: dict = {"move": move.move.value}
+    if move.action is not None:
+        mapped["action"] = move.action
+    if move.influence is not None:
+        mapped["influence"] = move.influence
+    return mapped
+
+
+def _merge_deltas(deltas: list[dict]) -> dict:
+    game: dict = {}
+    players: dict[int, dict] = {}
+    removed: dict[int, None] = {}
+    events: list[dict] = []
+    for delta in deltas:
+        game.update(delta["game"])
+        for player in delta["players"]:
+            players[player["id"]] = player
+            removed.pop(player["id"], None)
+        for id in delta["removed_players"]:
+            players.pop(id, None)
+            removed[id] = None
+        events.extend(delta["events"])
+
+    return {
+        "base_revision": deltas[0]["base_revision"],
+        "revision": deltas[-1]["revision"],
+        "game": game,
+        "players": list(players.values()),
+        "removed_players": list(removed),
+        "events": events,
+    }
+
+
+def _merge_two_deltas(earlier: dict, later: dict) -> dict:
+    return _merge_deltas([earlier, later])
+
+
+def _estimated_from(game: dict, players: dict[int, dict]) -> tuple:
+    shown = tuple((id, p["coins"], p["influence_a"], p["influence_b"]) for id, p in players.items())
+    return (game["state"], game["player_turn_id"], shown)
+
+
+@dataclass
+class GameRevision:
+    revision: int
+    game: dict
+    players: dict[int, dict]
+    events: list[dict]
+    has_earlier_events: bool
+    last_event_id: int
+
+    @cached_property
+    def snapshot(self) -> dict:
+        return {
+            "revision": self.revision,
+            "game": self.game,
+            "players": list(self.players.values()),
+            "events": self.events,
+            "has_earlier_events": self.has_earlier_events,
+        }
+
+
+@dataclass
+class ResumeMetrics:
+    resumed: int = 0
+    deltas_replayed: int = 0
+    snapshots: int = 0
+
+
 class NotificationsManager:
     def __init__(
         self,
         socket_server: AsyncServer,
+        estimator: Optional[WinEstimator] = None,
+        resume_buffer_size: int = RESUME_BUFFER_SIZE,
+        outbox: Optional[Outbox] = None,
+        engine: Optional[GameEngine] = None,
     ):
         self.socket_server = socket_server
+        self.engine = engine
+        self.outbox = outbox or Outbox(socket_server)
+        self.estimator = estimator
+        self.resume_buffer_size = resume_buffer_size
+        self.revisions: dict[str, GameRevision] = {}
+        self.history: dict[str, deque[dict]] = {}
+        # Sent apart from the deltas, an estimate doesn't change the game so it takes no revision
+        self.win_probabilities: dict[str, dict[int, float]] = {}
+        self.metrics = ResumeMetrics()
+        # The latest rows of each game waiting to be estimated, with what the estimate is made from
+        self._pending_estimates: dict[str, tuple[GameRow, list[PlayerRow], tuple]] = {}
+        self._estimating: dict[str, asyncio.Task] = {}
+        # Revisions a request has made but not sent yet, an estimate finished in the meantime waits to go after them
+        self._held: dict[str, GameRevision] = {}
+        self._ready_estimates: dict[str, tuple[tuple, dict[int, float]]] = {}
+        self._syncing: dict[str, asyncio.Lock] = {}
 
-    async def _send_game(self, conn: Connection, game_id: str, to: str) -> None:
-        async with conn.cursor() as cursor:
-            game = await GamesTable.get(cursor, game_id)
-            if game is None:
+    def forget(self, game_id: str) -> None:
+        self.revisions.pop(game_id, None)
+        self.history.pop(game_id, None)
+        self.win_probabilities.pop(game_id, None)
+        self._pending_estimates.pop(game_id, None)
+        self._held.pop(game_id, None)
+        self._ready_estimates.pop(game_id, None)
+        syncing = self._syncing.get(game_id)
+        if syncing is not None and not syncing.locked():
+            del self._syncing[game_id]
+
+    async def stop(self) -> None:
+        for task in list(self._estimating.values()):
+            task.cancel()
+        if self.estimator is not None:
+            self.estimator.stop()
+        await self.outbox.stop()
+
+    def _estimate(
+        self,
+        game_id: str,
+        game: GameRow,
+        players: list[PlayerRow],
+        current_game: dict,
+        current_players: dict[int, dict],
+        previous: Optional[GameRevision],
+    ) -> None:
+        if self.estimator is None or not self.estimator.enabled:
+            return
+        if game.state != GameState.RUNNING:
+            if self.win_probabilities.pop(game_id, None):
+                self.outbox.send("win_probabilities", {"win_probabilities": {}}, to=game_id)
+            return
+        # Most moves change nothing an estimate is made from, those keep the one before
+        inputs = _estimated_from(current_game, current_players)
+        if previous is not None and _estimated_from(previous.game, previous.players) == inputs:
+            self.estimator.metrics.reused += 1
+            return
+
+        # Too slow to hold up the move, the last estimate stands until a new one is sent
+        self._pending_estimates[game_id] = (copy.copy(game), [copy.copy(p) for p in players], inputs)
+        if not after_commit(functools.partial(self._start_estimates, game_id)):
+            self._start_estimates(game_id)
+
+    def _start_estimates(self, game_id: str) -> None:
+        if game_id not in self._estimating:
+            self._estimating[game_id] = asyncio.create_task(self._run_estimates(game_id))
+
+    async def _run_estimates(self, game_id: str) -> None:
+        # One estimate at a time for each game, made from its latest rows, so moves made while one runs are skipped
+        try:
+            while game_id in self._pending_estimates and self.estimator is not None:
+                game, players, inputs = self._pending_estimates.pop(game_id)
+                probabilities = await self.estimator.estimate_in_background(game, players)
+                self._send_estimate(game_id, inputs, probabilities)
+        except Exception:
+            logger.exception("estimate failed", extra={"fields": {"game_id": game_id}})
+        finally:
+            self._pending_estimates.pop(game_id, None)
+            del self._estimating[game_id]
+
+    def _send_estimate(self, game_id: str, inputs: tuple, probabilities: dict[int, float]) -> None:
+        if game_id in self._held:
+            self._ready_estimates[game_id] = (inputs, probabilities)
+            return
+        latest = self.revisions.get(game_id)
+        if latest is None or _estimated_from(latest.game, latest.players) != inputs:
+            if self.estimator is not None:
+                self.estimator.metrics.stale += 1
+            return
+        if probabilities == self.win_probabilities.get(game_id):
+            return
+
+        self.win_probabilities[game_id] = probabilities
+        self.outbox.send("win_probabilities", {"win_probabilities": probabilities}, to=game_id)
+
+    def _hold(self, game_id: str, latest: GameRevision) -> None:
+        def release() -> None:
+            if self._held.get(game_id) is not latest:
                 return
-            players = await PlayersTable.query(cursor, game_id=game.id)
-            events = await EventsTable.query(cursor, game_id=game.id)
+            del self._held[game_id]
+            ready = self._ready_estimates.pop(game_id, None)
+            if ready is not None:
+                self._send_estimate(game_id, *ready)
 
-        await self.socket_server.emit(
-            "game",
-            {
-                "game": map_game(game),
-                "players": [map_player(p) for p in players],
-                "events": [map_event(e) for e in events],
-            },
-            room=to,
+        # Held after the delta was queued, so it is released once the delta has gone out
+        if after_commit(release, release):
+            self._held[game_id] = latest
+
+    def _revise(self, game_id: str, latest: Optional[GameRevision], delta: Optional[dict] = None) -> None:
+        previous = self.revisions.pop(game_id, None)
+        history = self.history.pop(game_id, None) if latest is None else self.history.get(game_id)
+        if latest is not None:
+            self.revisions[game_id] = latest
+        if delta is not None and self.resume_buffer_size > 0:
+            if history is None:
+                history = self.history[game_id] = deque(maxlen=self.resume_buffer_size)
+            history.append(delta)
+
+        def restore() -> None:
+            # Put back as it was if the request's writes are thrown away, unless a later revision has replaced it
+            if self.revisions.get(game_id) is not latest:
+                return
+            if previous is not None:
+                self.revisions[game_id] = previous
+            else:
+                self.revisions.pop(game_id, None)
+            if history is not None and delta is not None and history and history[-1] is delta:
+                history.pop()
+            if latest is None and history is not None:
+                self.history[game_id] = history
+
+        after_commit(discarded=restore)
+
+    async def _sync(self, conn: Connection, game_id: str) -> Optional[GameRevision]:
+        game = await Game.get(conn, game_id, self.engine)
+        if game is None:
+            self._revise(game_id, None)
+            return None
+
+        players = [p.row for p in await game.get_players()]
+        current_game = map_game(game.row)
+        current_players = {p.id: map_player(p) for p in players}
+        previous = self.revisions.get(game_id)
+        async with reuse_cursor(conn) as cursor:
+            if previous is None:
+                events = await EventsTable.query_before(cursor, game_id, limit=SNAPSHOT_EVENT_LIMIT + 1)
+            else:
+                events = await EventsTable.query_after(cursor, game_id, previous.last_event_id)
+        new_events = [map_event(e) for e in events]
+
+        if previous is None:
+            latest = GameRevision(
+                # Counted from the clock, so a revision a client saw before a restart or before the game moved to
+                # another worker can't be mistaken for one of these
+                time.time_ns() // 1000,
+                current_game,
+                current_players,
+                new_events[-SNAPSHOT_EVENT_LIMIT:],
+                has_earlier_events=len(new_events) > SNAPSHOT_EVENT_LIMIT,
+                last_event_id=new_events[-1]["id"] if new_events else 0,
+            )
+            self._revise(game_id, latest)
+            self._estimate(game_id, game.row, players, current_game, current_players, None)
+            return latest
+
+        changed_game = {k: v for k, v in current_game.items() if previous.game.get(k) != v}
+        changed_players = [p for id, p in current_players.items() if previous.players.get(id) != p]
+        removed_players = [id for id in previous.players.keys() if id not in current_players]
+        if not changed_game and not changed_players and not removed_players and not new_events:
+            return previous
+
+        events_kept = previous.events + new_events
+        latest = GameRevision(
+            previous.revision + 1,
+            current_game,
+            current_players,
+            events_kept[-SNAPSHOT_EVENT_LIMIT:],
+            has_earlier_events=previous.has_earlier_events or len(events_kept) > SNAPSHOT_EVENT_LIMIT,
+            last_event_id=new_events[-1]["id"] if new_events else previous.last_event_id,
         )
+        delta = {
+            "base_revision": previous.revision,
+            "revision": latest.revision,
+            "game": changed_game,
+            "players": changed_players,
+            "removed_players": removed_players,
+            "events": new_events,
+        }
+        self._revise(game_id, latest, delta)
+        self.outbox.send("game_delta", delta, to=game_id, merge=_merge_two_deltas)
+        # A snapshot the request queued earlier would now go out ahead of the delta it was merged into
+        for to in self._queued_snapshots(game_id):
+            self.outbox.send("game", latest.snapshot, to=to)
+        self._hold(game_id, latest)
+        self._estimate(game_id, game.row, players, current_game, current_players, previous)
+        return latest
+
+    def _missed(self, game_id: str, revision: int) -> Optional[list[dict]]:
+        latest = self.revisions.get(game_id)
+        if latest is None:
+            return None
+        if revision == latest.revision:
+            return []
+        missed = [d for d in self.history.get(game_id, []) if d["revision"] > revision]
+        if not missed or missed[0]["base_revision"] != revision:
+            return None
+        return missed
+
+    async def resume(self, game_id: str, player_id: int, revision: int, to: str) -> bool:
+        """Catches a reconnecting player up from memory, False when only a snapshot will do"""
+        self.outbox.follow(game_id)
+        missed = self._missed(game_id, revision)
+        live = self.engine.loaded(game_id) if self.engine is not None else None
+        player = live.players.get(player_id) if live is not None else None
+        if missed is None or live is None or player is None:
+            self.metrics.snapshots += 1
+            return False
+
+        if missed:
+            self.outbox.send("game_delta", _merge_deltas(missed), to=to)
+        self._send_win_probabilities(game_id, to)
+        self.outbox.send("hand", map_hand(player, live.game), to=to)
+        self.metrics.resumed += 1
+        self.metrics.deltas_replayed += len(missed)
+        return True
+
+    def _queued_snapshots(self, game_id: str) -> set[str]:
+        queued = scoped_value(self)
+        if queued is None:
+            return set()
+        return queued.setdefault(game_id, set())
+
+    async def _send_game(self, conn: Connection, game_id: str, to: str) -> None:
+        # A game's revisions are made one at a time, and snapshots go out in the same order as the deltas
+        async with self._syncing.setdefault(game_id, asyncio.Lock()):
+            self.outbox.follow(game_id)
+            known = game_id in self.revisions
+            latest = await self._sync(conn, game_id)
+            if latest is None or (known and to == game_id):
+                return
+
+            self.outbox.send("game", latest.snapshot, to=to)
+            if to != game_id:
+                self._queued_snapshots(game_id).add(to)
+            self._send_win_probabilities(game_id, to)
+
+    def _send_win_probabilities(self, game_id: str, to: str) -> None:
+        probabilities = self.win_probabilities.get(game_id)
+        if probabilities:
+            self.outbox.send("win_probabilities", {"win_probabilities": probabilities}, to=to)
 
     async def notify_session(self, session: Session) -> None:
         current_player = await session.get_player()
-        await self.socket_server.emit(
+        await self.notify_cached_session(
+            session.id, session.player_id, current_player.game_id if current_player else None
+        )
+
+    async def notify_cached_session(self, session_id: str, player_id: Optional[int], game_id: Optional[str]) -> None:
+        self.outbox.send(
             "session",
             {
-                "session": map_session(session),
-                "game_id": current_player.game_id if current_player else None,
+                "session": map_session(session_id, player_id),
+                "game_id": game_id,
             },
-            room=session.id,
+            to=session_id,
         )
 
     async def notify_player(self, conn: Connection, player: Player) -> None:
@@ -96,25 +438,23 @@ class NotificationsManager:
         if session is None:
             raise NoActiveSessionException()
 
-        game = await Game.get(conn, player.game_id)
+        game = await Game.get(conn, player.game_id, self.engine)
         if game is None:
             raise GameNotFoundException(player.game_id)
 
         await self._send_game(conn, player.game_id, to=session.id)
-        await self.socket_server.emit(
-            "hand",
-            {
-                "influence_a": player.row.influence_a,
-                "influence_b": player.row.influence_b,
-                "top_of_deck": [Influence(int(i)) for i in game.row.deck[-2:]]
-                if game.row.turn_state == TurnState.EXCHANGING and game.row.player_turn_id == player.id
-                else [],
-            },
-            to=session.id,
-        )
+        self.outbox.send("hand", map_hand(player.row, game.row), to=session.id)
+
+    async def notify_hand(self, game: Game, player: Player) -> None:
+        """Just the player's own cards, for after a move whose broadcast already brought the game up to date"""
+        session = await player.get_session()
+        if session is None:
+            raise NoActiveSessionException()
+
+        self.outbox.send("hand", map_hand(player.row, game.row), to=session.id)
 
     async def notify_error(self, request: Request, title: str, message: str) -> None:
-        await self.socket_server.emit(
+        self.outbox.send(
             "error_msg",
             {
                 "title": title,
@@ -126,9 +466,24 @@ class NotificationsManager:
     async def broadcast_game(self, conn: Connection, game_id: str) -> None:
         await self._send_game(conn, game_id, to=game_id)
 
+    async def get_events(self, conn: Connection, game_id: str, before_id: Optional[int]) -> dict:
+        async with reuse_cursor(conn) as cursor:
+            events = await EventsTable.query_before(cursor, game_id, limit=EVENT_PAGE_LIMIT + 1, before_id=before_id)
+        return {
+            "events": [map_event(e) for e in events[-EVENT_PAGE_LIMIT:]],
+            "has_earlier_events": len(events) > EVENT_PAGE_LIMIT,
+        }
+
+    async def resync_player(self, conn: Connection, player: Player) -> None:
+        session = await player.get_session()
+        if session is None:
+            raise NoActiveSessionException()
+
+        await self._send_game(conn, player.game_id, to=session.id)
+
     async def broadcast_reset(self, request: Request) -> None:
         player = await request.session.get_player()
         if player is None:
             raise PlayerNotInGameException()
 
-        await self.socket_server.emit("reset", to=player.game_id)
+        self.outbox.send("reset", None, to=player.game_id)
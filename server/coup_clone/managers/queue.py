@@ -0,0 +1,75 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, TypeVar
+
+from coup_clone.instrumentation import LATENCY_BUCKETS, Histogram
+from coup_clone.managers.exceptions import GameBusyException
+
+GAME_QUEUE_DEPTH = int(os.environ.get("COUP_GAME_QUEUE_DEPTH", "16"))
+
+R = TypeVar("R")
+
+
+@dataclass
+class QueueMetrics:
+    games: int = 0
+    waiting: int = 0
+    moves: int = 0
+    rejected: int = 0
+    wait: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+
+
+@dataclass
+class _GameQueue:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    pending: int = 0
+
+
+class QueueManager:
+    """Runs the moves for a game one at a time in the order they arrived, different games run side by side
+
+    This is the only thing keeping a game's moves apart. Each move runs on a connection of its own and only hands its
+    changes to the writer once it is done, so moves for other games aren't held up behind it.
+    """
+
+    def __init__(self, depth: int = GAME_QUEUE_DEPTH):
+        self.depth = depth
+        self.metrics = QueueMetrics()
+        self._queues: dict[str, _GameQueue] = {}
+
+    async def run(self, game_id: str, move: Callable[[], Awaitable[R]]) -> R:
+        queue = self._queues.get(game_id)
+        if queue is None:
+            queue = self._queues[game_id] = _GameQueue()
+            self.metrics.games += 1
+        if queue.pending >= self.depth:
+            self.metrics.rejected += 1
+            raise GameBusyException(game_id)
+
+        queue.pending += 1
+        self.metrics.waiting += 1
+        start = time.perf_counter()
+        try:
+            # asyncio.Lock wakes waiters in order, so moves keep the order they were sent in
+            await queue.lock.acquire()
+        except BaseException:
+            self.metrics.waiting -= 1
+            self._done(game_id, queue)
+            raise
+
+        self.metrics.waiting -= 1
+        self.metrics.wait.observe(time.perf_counter() - start)
+        self.metrics.moves += 1
+        try:
+            return await move()
+        finally:
+            queue.lock.release()
+            self._done(game_id, queue)
+
+    def _done(self, game_id: str, queue: _GameQueue) -> None:
+        queue.pending -= 1
+        if queue.pending == 0:
+            del self._queues[game_id]
+            self.metrics.games -= 1
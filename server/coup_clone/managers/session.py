@@ -1,41 +1,54 @@
+from contextvars import ContextVar
+from typing import Optional
 from uuid import uuid4
 
 from aiosqlite import Connection
 from socketio import AsyncServer
 
-from coup_clone.db.sessions import SessionsTable
+from coup_clone.cache import CachedSession, SessionCache
+from coup_clone.db import reuse_cursor
+from coup_clone.db.sessions import SessionRow, SessionsTable
+from coup_clone.engine import GameEngine
 from coup_clone.managers.exceptions import NoActiveSessionException
 from coup_clone.managers.notifications import NotificationsManager
-from coup_clone.models import Session
+from coup_clone.models import Player, Session
 
 SESSION_KEY = "session"
 
+# Set while handling an event forwarded from the worker that the socket is connected to
+forwarded_session_id: ContextVar[Optional[str]] = ContextVar("forwarded_session_id", default=None)
+
 
 class SessionManager:
     def __init__(
         self,
         socket_server: AsyncServer,
         notifications_manager: NotificationsManager,
+        engine: Optional[GameEngine] = None,
+        cache: Optional[SessionCache] = None,
     ):
         self.socket_server = socket_server
         self.notifications_manager = notifications_manager
+        self.engine = engine
+        self.cache = cache
+        self._session_ids: dict[str, str] = {}
 
-    async def setup(self, conn: Connection, sid: str, auth: dict) -> Session:
+    async def setup(self, conn: Connection, sid: str, auth: Optional[dict]) -> Session:
         async with self.socket_server.session(sid) as socket_session:
             session = None
             session_id = auth.get(SESSION_KEY, None) if auth else None
 
-            async with conn.cursor() as cursor:
+            async with reuse_cursor(conn) as cursor:
                 if session_id:
                     session = await SessionsTable.get(cursor, session_id)
 
                 if session is None:
                     session = await SessionsTable.create(cursor, id=str(uuid4()))
-                    await conn.commit()
 
                 socket_session[SESSION_KEY] = session.id
+                self._session_ids[sid] = session.id
 
-                active_session = Session(conn, session)
+                active_session = Session(conn, session, self.engine, self.cache)
                 current_player = await active_session.get_player()
                 if current_player:
                     self.socket_server.enter_room(sid, current_player.game_id)
@@ -44,20 +57,56 @@ class SessionManager:
         await self.notifications_manager.notify_session(active_session)
         return active_session
 
-    async def get(self, conn: Connection, sid: str) -> Session:
+    async def resume(self, sid: str, session_id: str) -> Optional[CachedSession]:
+        """Sets up a reconnecting socket from the session cache alone, None when the session has to be loaded"""
+        cached = self.cached(session_id)
+        if cached is None:
+            return None
+        async with self.socket_server.session(sid) as socket_session:
+            socket_session[SESSION_KEY] = session_id
+        self._session_ids[sid] = session_id
+        if cached.game_id is not None:
+            self.socket_server.enter_room(sid, cached.game_id)
+        self.socket_server.enter_room(sid, session_id)
+        await self.notifications_manager.notify_cached_session(session_id, cached.player_id, cached.game_id)
+        return cached
+
+    async def get_id(self, sid: str) -> Optional[str]:
+        session_id = forwarded_session_id.get()
+        if session_id is not None:
+            return session_id
+        session_id = self._session_ids.get(sid)
+        if session_id is not None:
+            return session_id
         async with self.socket_server.session(sid) as socket_session:
-            session_id = socket_session.get(SESSION_KEY, None)
+            return socket_session.get(SESSION_KEY, None)
+
+    async def get(self, conn: Connection, sid: str, fill_cache: bool = True) -> Session:
+        session_id = await self.get_id(sid)
 
         if session_id is None:
             raise NoActiveSessionException()
 
-        async with conn.cursor() as cursor:
+        cached = self.cached(session_id)
+        if cached is not None:
+            return Session(conn, SessionRow(id=session_id, player_id=cached.player_id), self.engine, self.cache)
+
+        async with reuse_cursor(conn) as cursor:
             existing_session = await SessionsTable.get(cursor, session_id)
 
             if existing_session is None:
                 raise NoActiveSessionException()
 
-            return Session(
-                conn,
-                existing_session,
-            )
+        session = Session(conn, existing_session, self.engine, self.cache)
+        if fill_cache and self.cache is not None and session.player_id is not None:
+            # A player only leaves their game from a request queued for that game, like the one reading it here, so
+            # what is read can't be overtaken by a change still waiting to commit
+            player = await Player.get(conn, session.player_id, self.engine)
+            self.cache.put(session_id, session.player_id, player.game_id if player is not None else None)
+        return session
+
+    def cached(self, session_id: str) -> Optional[CachedSession]:
+        return self.cache.get(session_id) if self.cache is not None else None
+
+    def disconnect(self, sid: str) -> None:
+        self._session_ids.pop(sid, None)
@@ -1,15 +1,21 @@
 import random
 from abc import ABC
 from datetime import datetime, timedelta
-from typing import Any, Generic, Optional
+from typing import TYPE_CHECKING, Any, Generic, Optional
 
 from aiosqlite import Connection
 from typing_extensions import Self
 
+from coup_clone import deck, turns
+from coup_clone.db import reuse_cursor
 from coup_clone.db.games import GameRow, GamesTable, GameState, TurnAction, TurnState
 from coup_clone.db.players import Influence, PlayerRow, PlayersTable
 from coup_clone.db.sessions import SessionRow, SessionsTable
-from coup_clone.db.table import TID, T, Table
+from coup_clone.db.table import TID, T, Table, UnitOfWork
+
+if TYPE_CHECKING:
+    from coup_clone.cache import SessionCache
+    from coup_clone.engine import GameEngine
 
 DECK = [
     Influence.DUKE,
@@ -27,139 +33,150 @@ def get_shuffled_deck():
 class Model(ABC, Generic[T, TID]):
     TABLE: type[Table[T, TID]]
 
-    def __init__(self, conn: Connection, row: T):
+    def __init__(self, conn: Connection, row: T, engine: Optional["GameEngine"] = None):
         self.conn = conn
         self.row = row
+        # Running games are read from and changed in memory when given
+        self.engine = engine
 
     @property
     def id(self) -> TID:
         return self.row.id
 
     @classmethod
-    async def create(cls, conn: Connection, **kwargs: Any) -> Self:
-        async with conn.cursor() as cursor:
+    async def create(cls, conn: Connection, engine: Optional["GameEngine"] = None, **kwargs: Any) -> Self:
+        async with reuse_cursor(conn) as cursor:
             row = await cls.TABLE.create(cursor, **kwargs)
-            return cls(conn, row)
+            return cls(conn, row, engine)
 
     @classmethod
-    async def get(cls, conn: Connection, id: TID) -> Optional[Self]:
-        async with conn.cursor() as cursor:
+    async def get(cls, conn: Connection, id: TID, engine: Optional["GameEngine"] = None) -> Optional[Self]:
+        async with reuse_cursor(conn) as cursor:
             row = await cls.TABLE.get(cursor, id)
             if row is not None:
-                return cls(conn, row)
+                return cls(conn, row, engine)
             return None
 
     async def update(self, **kwargs: Any) -> None:
-        async with self.conn.cursor() as cursor:
-            await self.TABLE.update(cursor, self.id, **kwargs)
-            self.row = await self.TABLE.get(cursor, self.id)
+        if self.engine is not None and self.engine.tracks(self.row):
+            self.engine.update(self.conn, self.TABLE, self.row, **kwargs)
+        else:
+            UnitOfWork.of(self.conn).record(self.TABLE, self.row, **kwargs)
 
     async def delete(self) -> None:
-        async with self.conn.cursor() as cursor:
+        async with reuse_cursor(self.conn) as cursor:
             await self.TABLE.delete(cursor, self.id)
 
 
 class Game(Model[GameRow, str]):
     TABLE = GamesTable
 
+    @classmethod
+    async def create(cls, conn: Connection, engine: Optional["GameEngine"] = None, **kwargs: Any) -> Self:
+        game = await super().create(conn, engine, **kwargs)
+        if engine is not None:
+            engine.add_game(conn, game.row)
+        return game
+
+    @classmethod
+    async def get(cls, conn: Connection, id: str, engine: Optional["GameEngine"] = None) -> Optional[Self]:
+        if engine is None:
+            return await super().get(conn, id)
+        live = await engine.load(conn, id)
+        if live is None:
+            return None
+        return cls(conn, live.game, engine)
+
     async def get_current_player(self) -> Optional["Player"]:
         if self.row.player_turn_id is None:
             return None
-        return await Player.get(self.conn, self.row.player_turn_id)
+        return await Player.get(self.conn, self.row.player_turn_id, self.engine)
 
     async def get_target_player(self) -> Optional["Player"]:
         if self.row.target_id is None:
             return None
-        return await Player.get(self.conn, self.row.target_id)
+        return await Player.get(self.conn, self.row.target_id, self.engine)
 
     async def get_blocking_player(self) -> Optional["Player"]:
         if self.row.blocked_by_id is None:
             return None
-        return await Player.get(self.conn, self.row.blocked_by_id)
+        return await Player.get(self.conn, self.row.blocked_by_id, self.engine)
 
     async def take_from_deck(self, n: int = 2) -> list[Influence]:
-        deck = list(self.row.deck)
-        popped = [Influence(int(deck.pop())) for i in range(n)]
-        self.row.deck = "".join(deck)
-        async with self.conn.cursor() as cursor:
-            await GamesTable.update(cursor, self.id, deck=self.row.deck)
+        remaining, popped = deck.draw(self.row.deck, n)
+        await self.update(deck=remaining)
         return popped
 
     async def return_to_deck(self, influence: list[Influence]) -> None:
-        deck = list(self.row.deck) + [i.value for i in influence]
-        random.shuffle(deck)
-        self.row.deck = "".join(str(c) for c in deck)
-        async with self.conn.cursor() as cursor:
-            await GamesTable.update(cursor, self.id, deck=self.row.deck)
+        await self.update(deck=deck.put_back(self.row.deck, influence))
+
+    async def apply_changes(self, changes: turns.Changes) -> None:
+        if changes.game:
+            await self.update(**changes.game)
+        if changes.players:
+            for player in await self.get_players():
+                values = changes.players.get(player.id)
+                if values:
+                    await player.update(**values)
 
     async def reset_turn_state(self, player_id: int) -> None:
-        async with self.conn.cursor() as cursor:
-            await GamesTable.update(
-                cursor,
-                self.id,
-                player_turn_id=player_id,
-                turn_state=TurnState.START,
-                turn_action=None,
-                target_id=None,
-                challenged_by_id=None,
-                blocked_by_id=None,
-                block_challenged_by_id=None,
-                turn_state_modified=datetime.utcnow(),
-                turn_state_deadline=None,
-            )
-            await PlayersTable.reset_accepts_action(cursor, self.id)
-            self.row = await GamesTable.get(cursor, self.id)
+        players = [p.row for p in await self.get_players()]
+        await self.apply_changes(turns.start_turn(player_id, players))
 
     async def next_player_turn(self) -> None:
-        next_player = await self.get_next_player_turn()
-        if next_player is None:
-            raise Exception("No next player available")
-        await self.reset_turn_state(next_player.id)
+        players = [p.row for p in await self.get_players()]
+        await self.apply_changes(turns.next_turn(self.row, players))
 
     async def set_action_deadline(self, action: TurnAction, seconds_from_now: int = 10) -> None:
-        async with self.conn.cursor() as cursor:
-            await GamesTable.update(
-                cursor,
-                self.id,
-                turn_state_modified=datetime.utcnow(),
-                turn_state_deadline=datetime.utcnow() + timedelta(seconds=seconds_from_now),
-                turn_action=action,
-                turn_state=TurnState.ATTEMPTED,
-            )
-            self.row = await GamesTable.get(cursor, self.id)
+        await self.update(
+            turn_state_modified=datetime.utcnow(),
+            turn_state_deadline=datetime.utcnow() + timedelta(seconds=seconds_from_now),
+            turn_action=action,
+            turn_state=TurnState.ATTEMPTED,
+        )
+
+    async def release_if_deleted(self) -> None:
+        if self.engine is None:
+            return
+        async with reuse_cursor(self.conn) as cursor:
+            if await GamesTable.count(cursor, id=self.id) == 0:
+                self.engine.evict(self.id)
 
     async def get_players(self) -> list["Player"]:
-        async with self.conn.cursor() as cursor:
+        if self.engine is not None:
+            live = await self.engine.load(self.conn, self.id)
+            if live is not None:
+                return [Player(self.conn, p, self.engine) for p in live.players.values()]
+
+        async with reuse_cursor(self.conn) as cursor:
             players = await PlayersTable.query(cursor, game_id=self.id, order_by=["id"])
-        return [Player(self.conn, p) for p in players]
+        return [Player(self.conn, p, self.engine) for p in players]
 
     async def get_next_player_turn(self) -> Optional["Player"]:
-        players = [p for p in await self.get_players()]
-        if self.row.player_turn_id is None:
-            return players[0]
-        else:
-            current_index = [p.id for p in players].index(self.row.player_turn_id)
-            player_sequence = players[current_index + 1 :] + players[: current_index + 1]
-            return next(player for player in player_sequence if not player.is_out)
+        row = turns.next_player(self.row, [p.row for p in await self.get_players()])
+        return Player(self.conn, row, self.engine) if row is not None else None
 
     async def all_players_accepted(self) -> bool:
-        players = await self.get_players()
-        return all(p.row.accepts_action for p in players if p.id != self.row.player_turn_id and not p.is_out)
+        return turns.all_accepted(self.row, [p.row for p in await self.get_players()])
 
     async def reset(self) -> None:
         await self.update(
-            deck="".join(str(c) for c in get_shuffled_deck()),
+            deck=deck.pack(get_shuffled_deck()),
             state=GameState.RUNNING,
             winner_id=None,
         )
-        async with self.conn.cursor() as cursor:
-            await PlayersTable.reset_players(cursor, self.id)
 
         players = await self.get_players()
         cards = await self.take_from_deck(len(players) * 2)
         pairs = [(cards[i], cards[i + 1]) for i in range(0, len(cards), 2)]
         for player, influence in zip(players, pairs):
-            await player.update(influence_a=influence[0], influence_b=influence[1])
+            await player.update(
+                coins=2,
+                influence_a=influence[0],
+                influence_b=influence[1],
+                revealed_influence_a=False,
+                revealed_influence_b=False,
+            )
 
         await self.reset_turn_state(players[0].id)
 
@@ -167,6 +184,22 @@ class Game(Model[GameRow, str]):
 class Player(Model[PlayerRow, int]):
     TABLE = PlayersTable
 
+    @classmethod
+    async def create(cls, conn: Connection, engine: Optional["GameEngine"] = None, **kwargs: Any) -> Self:
+        player = await super().create(conn, engine, **kwargs)
+        if engine is not None:
+            engine.add_player(conn, player.row)
+        return player
+
+    @classmethod
+    async def get(cls, conn: Connection, id: int, engine: Optional["GameEngine"] = None) -> Optional[Self]:
+        if engine is None:
+            return await super().get(conn, id)
+        row = await engine.load_player(conn, id)
+        if row is None:
+            return None
+        return cls(conn, row, engine)
+
     @property
     def game_id(self) -> str:
         return self.row.game_id
@@ -181,42 +214,47 @@ class Player(Model[PlayerRow, int]):
 
     @property
     def is_out(self) -> bool:
-        return self.row.revealed_influence_a and self.row.revealed_influence_b
+        return turns.is_out(self.row)
 
     async def increment_coins(self, amount: int = 1) -> None:
-        self.row.coins += amount
-        async with self.conn.cursor() as cursor:
-            await PlayersTable.update(
-                cursor,
-                self.id,
-                coins=self.row.coins,
-            )
+        await self.update(coins=self.row.coins + amount)
 
     async def decrement_coins(self, amount: int = 1) -> None:
-        self.row.coins -= amount
-        async with self.conn.cursor() as cursor:
-            await PlayersTable.update(
-                cursor,
-                self.id,
-                coins=self.row.coins,
-            )
+        await self.update(coins=self.row.coins - amount)
+
+    async def delete(self) -> None:
+        if self.engine is not None:
+            self.engine.remove_player(self.conn, self.row)
+        await super().delete()
 
     async def get_session(self) -> Optional["Session"]:
-        async with self.conn.cursor() as cursor:
+        async with reuse_cursor(self.conn) as cursor:
             sessions = await SessionsTable.query(cursor, player_id=self.id)
         if not sessions:
             return None
-        return Session(self.conn, sessions[0])
+        return Session(self.conn, sessions[0], self.engine)
 
     async def get_game(self) -> Game:
-        async with self.conn.cursor() as cursor:
-            game = await GamesTable.get(cursor, self.row.game_id)
-        return Game(self.conn, game)
+        game = await Game.get(self.conn, self.row.game_id, self.engine)
+        if game is None:
+            raise Exception("Player's game is missing")
+        return game
 
 
 class Session(Model[SessionRow, str]):
     TABLE = SessionsTable
 
+    def __init__(
+        self,
+        conn: Connection,
+        row: SessionRow,
+        engine: Optional["GameEngine"] = None,
+        cache: Optional["SessionCache"] = None,
+    ):
+        super().__init__(conn, row, engine)
+        # Told when the session moves to another game
+        self.cache = cache
+
     @property
     def player_id(self) -> Optional[int]:
         return self.row.player_id
@@ -224,12 +262,7 @@ class Session(Model[SessionRow, str]):
     async def get_player(self) -> Optional[Player]:
         if self.player_id is None:
             return None
-
-        async with self.conn.cursor() as cursor:
-            player = await PlayersTable.get(cursor, self.player_id)
-        if player is None:
-            return None
-        return Player(self.conn, player)
+        return await Player.get(self.conn, self.player_id, self.engine)
 
     async def get_playerX(self) -> Player:
         player = await self.get_player()
@@ -238,12 +271,13 @@ class Session(Model[SessionRow, str]):
         return player
 
     async def set_player(self, player_id: int) -> None:
-        async with self.conn.cursor() as cursor:
-            await SessionsTable.update(cursor, self.id, player_id=player_id)
-        self.row.player_id = player_id
+        await self.update(player_id=player_id)
+        if self.cache is not None:
+            self.cache.invalidate(self.id)
 
     async def clear_current_player(self) -> None:
         if self.player_id is None:
             return
         await self.update(player_id=None)
-        self.row.player_id = None
+        if self.cache is not None:
+            self.cache.invalidate(self.id)
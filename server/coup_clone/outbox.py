@@ -0,0 +1,151 @@
+import asyncio
+import functools
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from socketio import AsyncServer
+
+from coup_clone.instrumentation import logger
+from coup_clone.scope import after_commit, after_scope, scoped_value
+
+# Combines a payload already waiting to go out with a newer one for the same recipient
+Merge = Callable[[Any, Any], Any]
+
+
+@dataclass
+class OutboxMetrics:
+    queued: int = 0
+    coalesced: int = 0
+    flushes: int = 0
+    emits: int = 0
+    errors: int = 0
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.pending: dict[tuple[str, str], Any] = {}
+        # The batches that followed the same streams before this one, which go out first
+        self.after: list[asyncio.Future] = []
+        # Set once this batch has gone out or been dropped
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.flushed = False
+
+
+class Outbox:
+    """Collects the notifications a request produces and sends them together once it has committed
+
+    Only the latest payload of an event is kept for each recipient, unless a merge is given to combine them. Payloads
+    that are the same object go to all their recipients in one emit, so they're only serialized once. Outside of a
+    request scope notifications are sent straight away.
+    """
+
+    def __init__(self, socket_server: AsyncServer):
+        self.socket_server = socket_server
+        self.metrics = OutboxMetrics()
+        # Flushes go out one after another so a client never sees a later revision before an earlier one
+        self._sending = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+        # The last batch to follow each stream
+        self._tails: dict[str, asyncio.Future] = {}
+
+    def _batch(self) -> Optional[_Batch]:
+        values = scoped_value(self)
+        if values is None:
+            return None
+        if "batch" not in values:
+            batch = values["batch"] = _Batch()
+            after_commit(functools.partial(self._flush_batch, batch))
+            # Dropped without being sent if the request fails, but what follows it is still let through
+            after_scope(functools.partial(self._drop_batch, batch))
+        return values["batch"]
+
+    def follow(self, stream: str) -> None:
+        """Keeps the request's notifications behind those of requests that followed stream before it
+
+        Requests commit in any order, a game's revisions have to go out in the order they were made.
+        """
+        batch = self._batch()
+        if batch is None or self._tails.get(stream) is batch.done:
+            return
+        tail = self._tails.get(stream)
+        if tail is not None and not tail.done():
+            batch.after.append(tail)
+        self._tails[stream] = batch.done
+
+        def untail(_: asyncio.Future) -> None:
+            if self._tails.get(stream) is batch.done:
+                del self._tails[stream]
+
+        batch.done.add_done_callback(untail)
+
+    def send(self, event: str, data: Any, to: str, merge: Optional[Merge] = None) -> None:
+        self.metrics.queued += 1
+        batch = self._batch()
+        if batch is None:
+            self._flush({(to, event): data})
+            return
+
+        key = (to, event)
+        if key in batch.pending:
+            self.metrics.coalesced += 1
+            # Moved to the back, it's now as recent as anything else waiting
+            earlier = batch.pending.pop(key)
+            if merge is not None:
+                data = merge(earlier, data)
+        batch.pending[key] = data
+
+    def _drop_batch(self, batch: _Batch) -> None:
+        if not batch.flushed:
+            batch.pending.clear()
+            self._flush_batch(batch)
+
+    def _flush_batch(self, batch: _Batch) -> Optional[asyncio.Task]:
+        if batch.flushed:
+            return None
+        batch.flushed = True
+        if not batch.after and not batch.pending:
+            batch.done.set_result(None)
+            return None
+        return self._flush(batch.pending, batch.after, batch.done)
+
+    def _flush(
+        self,
+        pending: dict[tuple[str, str], Any],
+        after: Optional[list[asyncio.Future]] = None,
+        done: Optional[asyncio.Future] = None,
+    ) -> asyncio.Task:
+        task = asyncio.create_task(self._emit(pending, after or [], done))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _emit(
+        self, pending: dict[tuple[str, str], Any], after: list[asyncio.Future], done: Optional[asyncio.Future]
+    ) -> None:
+        try:
+            for earlier in after:
+                await earlier
+            if pending:
+                await self._emit_now(pending)
+        finally:
+            if done is not None and not done.done():
+                done.set_result(None)
+
+    async def _emit_now(self, pending: dict[tuple[str, str], Any]) -> None:
+        grouped: dict[tuple[str, int], tuple[str, Any, list[str]]] = {}
+        for (to, event), data in pending.items():
+            grouped.setdefault((event, id(data)), (event, data, []))[2].append(to)
+
+        async with self._sending:
+            self.metrics.flushes += 1
+            for event, data, rooms in grouped.values():
+                try:
+                    await self.socket_server.emit(event, data, to=rooms[0] if len(rooms) == 1 else rooms)
+                except Exception:
+                    self.metrics.errors += 1
+                    logger.exception("emit failed", extra={"fields": {"event": event}})
+                self.metrics.emits += 1
+
+    async def stop(self) -> None:
+        if self._tasks:
+            await asyncio.wait(self._tasks)
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from aiosqlite import Connection
+from socketio import AsyncServer
+
+from coup_clone.cache import SessionCache
+from coup_clone.cluster import Cluster
+from coup_clone.db import ConnectionPool, reuse_cursor
+from coup_clone.db.games import GamesTable
+from coup_clone.db.writer import Writer
+from coup_clone.engine import GameEngine
+from coup_clone.instrumentation import logger
+
+REAPER_INTERVAL = float(os.environ.get("COUP_REAPER_INTERVAL", "300"))
+REAPER_TTL = float(os.environ.get("COUP_REAPER_TTL", "3600"))
+REAPER_BATCH_SIZE = int(os.environ.get("COUP_REAPER_BATCH_SIZE", "100"))
+# Pages handed back to the file system after each run, needs auto_vacuum = incremental
+REAPER_VACUUM_PAGES = int(os.environ.get("COUP_REAPER_VACUUM_PAGES", "0"))
+
+
+@dataclass
+class ReaperMetrics:
+    runs: int = 0
+    games: int = 0
+    players: int = 0
+    events: int = 0
+    pages_vacuumed: int = 0
+    last_run_seconds: float = 0
+
+
+@dataclass
+class _Reaped:
+    games: int = 0
+    players: int = 0
+    events: int = 0
+
+
+class GameReaper:
+    """Deletes games nobody is connected to that haven't changed turn in a while"""
+
+    def __init__(
+        self,
+        writer: Writer,
+        read_pool: ConnectionPool,
+        socket_server: AsyncServer,
+        engine: GameEngine,
+        cluster: Optional[Cluster] = None,
+        session_cache: Optional[SessionCache] = None,
+        interval: float = REAPER_INTERVAL,
+        ttl: float = REAPER_TTL,
+        batch_size: int = REAPER_BATCH_SIZE,
+        vacuum_pages: int = REAPER_VACUUM_PAGES,
+    ):
+        self.writer = writer
+        self.read_pool = read_pool
+        self.socket_server = socket_server
+        self.engine = engine
+        self.cluster = cluster
+        self.session_cache = session_cache
+        self.interval = interval
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.metrics = ReaperMetrics()
+        self._task: Optional[asyncio.Task] = None
+        if cluster is not None:
+            cluster.handle_connected(self.connected)
+
+    def connected(self, game_ids: list[str]) -> list[str]:
+        # Every socket joins the room of its game, on the worker it is connected to
+        rooms = self.socket_server.manager.rooms.get("/", {})
+        return [game_id for game_id in game_ids if rooms.get(game_id)]
+
+    async def _connected_anywhere(self, game_ids: list[str]) -> set[str]:
+        connected = set(self.connected(game_ids))
+        if self.cluster is not None:
+            connected.update(await self.cluster.connected(game_ids))
+        return connected
+
+    async def _candidates(self, cutoff: datetime, after: str) -> list[str]:
+        async with self.read_pool.acquire() as conn:
+            async with reuse_cursor(conn) as cursor:
+                return await GamesTable.idle(cursor, cutoff, after, self.batch_size)
+
+    async def _delete(self, conn: Connection, game_ids: list[str], cutoff: datetime) -> _Reaped:
+        reaped = _Reaped()
+        idle = []
+        for game_id in game_ids:
+            # A cached game may have moved on since the last flush
+            live = self.engine.loaded(game_id)
+            modified = live.game.turn_state_modified if live is not None else None
+            if modified is None or modified < cutoff:
+                idle.append(game_id)
+        if not idle:
+            return reaped
+
+        async with reuse_cursor(conn) as cursor:
+            reaped.players, reaped.events = await GamesTable.count_children(cursor, idle)
+            reaped.games = await GamesTable.delete_many(cursor, idle)
+        for game_id in idle:
+            self.engine.evict(game_id)
+            if self.session_cache is not None:
+                self.session_cache.invalidate_game(game_id)
+        return reaped
+
+    async def _vacuum(self, conn: Connection) -> int:
+        before = list(await conn.execute_fetchall("PRAGMA freelist_count;"))[0][0]
+        await conn.execute_fetchall(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+        after = list(await conn.execute_fetchall("PRAGMA freelist_count;"))[0][0]
+        return before - after
+
+    async def run_once(self) -> _Reaped:
+        started = time.perf_counter()
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        total = _Reaped()
+        after = ""
+        # Games are picked by when they last moved, which is only up to date once written behind
+        await self.engine.flush()
+        while True:
+            candidates = await self._candidates(cutoff, after)
+            if not candidates:
+                break
+            after = candidates[-1]
+
+            owned = [g for g in candidates if self.engine.owns(g)]
+            connected = await self._connected_anywhere(owned) if owned else set()
+            abandoned = [g for g in owned if g not in connected]
+            if abandoned:
+                # One short write per batch, so moves from live games are never held up for long
+                reaped = await self.writer.submit(lambda conn: self._delete(conn, abandoned, cutoff))
+                total.games += reaped.games
+                total.players += reaped.players
+                total.events += reaped.events
+
+        if total.games > 0 and self.vacuum_pages > 0:
+            self.metrics.pages_vacuumed += await self.writer.submit(self._vacuum)
+
+        self.metrics.runs += 1
+        self.metrics.games += total.games
+        self.metrics.players += total.players
+        self.metrics.events += total.events
+        self.metrics.last_run_seconds = time.perf_counter() - started
+        logger.info(
+            "reaper",
+            extra={
+                "fields": {
+                    "games": total.games,
+                    "players": total.players,
+                    "events": total.events,
+                    "duration_ms": round(self.metrics.last_run_seconds * 1000, 3),
+                }
+            },
+        )
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("reaper failed")
+
+    def start(self) -> None:
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
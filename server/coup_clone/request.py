@@ -1,7 +1,51 @@
+import functools
+from typing import Optional
+
 from aiosqlite import Connection
 from attr import dataclass
 
+from coup_clone.db import reuse_cursor
+from coup_clone.db.table import UnitOfWork
+from coup_clone.db.writer import Writer
+from coup_clone.engine import GameEngine
 from coup_clone.models import Session
+from coup_clone.scope import after_commit, mark_durable
+
+
+async def commit(conn: Connection, engine: Optional[GameEngine] = None, writer: Optional[Writer] = None) -> None:
+    """Writes the request's changes, as a job of its own on the writer when the request isn't already running as one"""
+    work = UnitOfWork.finish(conn)
+    staged = engine.stage(conn, work) if engine is not None else None
+
+    async def flush(conn: Connection) -> None:
+        async with reuse_cursor(conn) as cursor:
+            await work.flush(cursor)
+
+    try:
+        if writer is None:
+            await flush(conn)
+        else:
+            await writer.submit(flush)
+    except BaseException:
+        if engine is not None and staged is not None:
+            engine.revert(staged)
+        raise
+
+    if writer is not None:
+        mark_durable()
+    if engine is None or staged is None:
+        return
+    # Otherwise the writer commits once the whole batch this request belongs to is done, which may still fail
+    if writer is not None or not after_commit(
+        functools.partial(engine.apply, staged), functools.partial(engine.revert, staged)
+    ):
+        engine.apply(staged)
+
+
+def rollback(conn: Connection, engine: Optional[GameEngine] = None) -> None:
+    UnitOfWork.finish(conn)
+    if engine is not None:
+        engine.rollback(conn)
 
 
 @dataclass
@@ -9,3 +53,12 @@ class Request:
     sid: str
     conn: Connection
     session: Session
+    engine: Optional[GameEngine] = None
+    # Given when the request runs on a connection of its own rather than as a job on the writer
+    writer: Optional[Writer] = None
+
+    async def commit(self) -> None:
+        await commit(self.conn, self.engine, self.writer)
+
+    def rollback(self) -> None:
+        rollback(self.conn, self.engine)
@@ -0,0 +1,193 @@
+import enum
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from coup_clone.actions import ACTIONS, GameAction
+from coup_clone.db.games import GameRow, GameState, TurnAction, TurnState
+from coup_clone.db.players import Influence, PlayerRow
+from coup_clone.managers.exceptions import IllegalMoveException
+
+
+class Move(enum.Enum):
+    TAKE_ACTION = "take_action"
+    ACCEPT_ACTION = "accept_action"
+    CHALLENGE = "challenge"
+    BLOCK = "block"
+    ACCEPT_BLOCK = "accept_block"
+    CHALLENGE_BLOCK = "challenge_block"
+    REVEAL = "reveal"
+    EXCHANGE = "exchange"
+
+
+class Role(enum.Enum):
+    CURRENT = 0
+    OPPONENT = 1
+    # The target of the action if it has one, otherwise any opponent
+    DEFENDER = 2
+    TARGET = 3
+    CHALLENGER = 4
+    BLOCKER = 5
+    NOT_BLOCKER = 6
+    BLOCK_CHALLENGER = 7
+
+
+@dataclass(frozen=True)
+class Transition:
+    role: Role
+    # None passes the turn to the next player
+    next_state: Optional[TurnState]
+    # The action's effect runs and its success message is logged
+    resolves: bool = False
+    # The revealed card backed the claim, it goes back in the deck and is replaced
+    proves: bool = False
+
+
+@dataclass(frozen=True)
+class LegalMove:
+    move: Move
+    action: Optional[TurnAction] = None
+    influence: Optional[Influence] = None
+
+
+TransitionKey = tuple[TurnState, TurnAction, Move, Optional[Influence]]
+
+
+def _defends(game: GameRow, player_id: int) -> bool:
+    return player_id != game.player_turn_id and (game.target_id is None or player_id == game.target_id)
+
+
+ROLES: dict[Role, Callable[[GameRow, int], bool]] = {
+    Role.CURRENT: lambda game, player_id: player_id == game.player_turn_id,
+    Role.OPPONENT: lambda game, player_id: player_id != game.player_turn_id,
+    Role.DEFENDER: _defends,
+    Role.TARGET: lambda game, player_id: player_id == game.target_id,
+    Role.CHALLENGER: lambda game, player_id: player_id == game.challenged_by_id,
+    Role.BLOCKER: lambda game, player_id: player_id == game.blocked_by_id,
+    Role.NOT_BLOCKER: lambda game, player_id: player_id != game.blocked_by_id,
+    Role.BLOCK_CHALLENGER: lambda game, player_id: player_id == game.block_challenged_by_id,
+}
+
+REVEALABLE = [i for i in Influence if i != Influence.UNKNOWN]
+
+
+def _resolved(action: GameAction) -> Optional[TurnState]:
+    return None if action.next_state == TurnState.START else action.next_state
+
+
+def _compile_action(turn_action: TurnAction, action: GameAction) -> dict[TransitionKey, Transition]:
+    transitions: dict[TransitionKey, Transition] = {}
+
+    def add(state: TurnState, move: Move, transition: Transition, influence: Optional[Influence] = None) -> None:
+        transitions[(state, turn_action, move, influence)] = transition
+
+    contested = action.influence is not None or bool(action.can_be_blocked_by)
+    if contested:
+        add(TurnState.START, Move.TAKE_ACTION, Transition(Role.CURRENT, TurnState.ATTEMPTED))
+        # Only applied once every opponent still in the game has accepted
+        add(TurnState.ATTEMPTED, Move.ACCEPT_ACTION, Transition(Role.OPPONENT, _resolved(action), resolves=True))
+    else:
+        add(TurnState.START, Move.TAKE_ACTION, Transition(Role.CURRENT, _resolved(action), resolves=True))
+
+    if action.influence is not None:
+        add(TurnState.ATTEMPTED, Move.CHALLENGE, Transition(Role.OPPONENT, TurnState.CHALLENGED))
+        for influence in REVEALABLE:
+            if influence == action.influence:
+                proven = Transition(Role.CURRENT, TurnState.CHALLENGER_REVEALING, resolves=True, proves=True)
+                add(TurnState.CHALLENGED, Move.REVEAL, proven, influence)
+            else:
+                add(TurnState.CHALLENGED, Move.REVEAL, Transition(Role.CURRENT, None), influence)
+            add(TurnState.CHALLENGER_REVEALING, Move.REVEAL, Transition(Role.CHALLENGER, _resolved(action)), influence)
+
+    if action.can_be_blocked_by:
+        add(TurnState.ATTEMPTED, Move.BLOCK, Transition(Role.DEFENDER, TurnState.BLOCKED))
+        add(TurnState.BLOCKED, Move.ACCEPT_BLOCK, Transition(Role.CURRENT, None))
+        add(TurnState.BLOCKED, Move.CHALLENGE_BLOCK, Transition(Role.NOT_BLOCKER, TurnState.BLOCK_CHALLENGED))
+        for influence in REVEALABLE:
+            if influence in action.can_be_blocked_by:
+                blocked = Transition(Role.BLOCKER, TurnState.BLOCK_CHALLENGER_REVEALING, proves=True)
+                add(TurnState.BLOCK_CHALLENGED, Move.REVEAL, blocked, influence)
+            else:
+                resolved = Transition(Role.BLOCKER, _resolved(action), resolves=True)
+                add(TurnState.BLOCK_CHALLENGED, Move.REVEAL, resolved, influence)
+            add(TurnState.BLOCK_CHALLENGER_REVEALING, Move.REVEAL, Transition(Role.BLOCK_CHALLENGER, None), influence)
+
+    if action.next_state == TurnState.TARGET_REVEALING:
+        for influence in REVEALABLE:
+            add(TurnState.TARGET_REVEALING, Move.REVEAL, Transition(Role.TARGET, None), influence)
+
+    if action.next_state == TurnState.EXCHANGING:
+        add(TurnState.EXCHANGING, Move.EXCHANGE, Transition(Role.CURRENT, None))
+
+    return transitions
+
+
+def _compile() -> dict[TransitionKey, Transition]:
+    transitions: dict[TransitionKey, Transition] = {}
+    for turn_action, action in ACTIONS.items():
+        transitions.update(_compile_action(turn_action, action))
+    return transitions
+
+
+TRANSITIONS = _compile()
+
+# The same transitions grouped by what the game row holds, START has no action until one is taken
+# along with who may make each move, so listing legal moves needs no further lookups
+_BY_TURN: dict[
+    tuple[TurnState, Optional[TurnAction]], list[tuple[TransitionKey, Callable[[GameRow, int], bool], GameAction]]
+] = {}
+for _key, _transition in TRANSITIONS.items():
+    _turn = (_key[0], None if _key[2] == Move.TAKE_ACTION else _key[1])
+    _BY_TURN.setdefault(_turn, []).append((_key, ROLES[_transition.role], ACTIONS[_key[1]]))
+
+
+def transition(
+    game: GameRow,
+    player_id: int,
+    move: Move,
+    action: Optional[TurnAction] = None,
+    influence: Optional[Influence] = None,
+) -> Transition:
+    turn_action = action if move == Move.TAKE_ACTION else game.turn_action
+    found = None
+    if game.turn_state is not None and turn_action is not None:
+        found = TRANSITIONS.get((game.turn_state, turn_action, move, influence))
+    if found is None or not ROLES[found.role](game, player_id):
+        raise IllegalMoveException(move.value)
+    return found
+
+
+def accepted(turn_action: TurnAction) -> Transition:
+    return TRANSITIONS[(TurnState.ATTEMPTED, turn_action, Move.ACCEPT_ACTION, None)]
+
+
+def legal_moves(game: GameRow, player: PlayerRow) -> list[LegalMove]:
+    if game.state != GameState.RUNNING or game.turn_state is None:
+        return []
+    if player.revealed_influence_a and player.revealed_influence_b:
+        return []
+
+    # Compared by identity, enum members hash slowly and this runs for every player after every move
+    hand = (
+        None if player.revealed_influence_a else player.influence_a,
+        None if player.revealed_influence_b else player.influence_b,
+    )
+
+    moves = []
+    for (_, turn_action, move, influence), allowed, action in _BY_TURN.get((game.turn_state, game.turn_action), []):
+        if not allowed(game, player.id):
+            continue
+        if move is Move.TAKE_ACTION:
+            if action.cost > player.coins:
+                continue
+            if player.coins >= 10 and turn_action is not TurnAction.COUP:
+                continue
+            moves.append(LegalMove(move, action=turn_action))
+        elif move is Move.REVEAL:
+            if influence is hand[0] or influence is hand[1]:
+                moves.append(LegalMove(move, influence=influence))
+        elif move is Move.ACCEPT_ACTION:
+            if not player.accepts_action:
+                moves.append(LegalMove(move))
+        else:
+            moves.append(LegalMove(move))
+    return moves
@@ -0,0 +1,85 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+
+class _Scope:
+    def __init__(self) -> None:
+        self.committed: list[Callable[[], Optional[Awaitable]]] = []
+        self.discarded: list[Callable[[], None]] = []
+        self.ended: list[Callable[[], None]] = []
+        self.values: dict[object, dict] = {}
+        # Set once the request's writes are committed, nothing can throw them away after that
+        self.durable = False
+
+
+_scope: ContextVar[Optional[_Scope]] = ContextVar("request_scope", default=None)
+
+
+@asynccontextmanager
+async def request_scope() -> AsyncIterator[None]:
+    """Runs what was held with after_commit once the block is done, or what was to undo it if the block raises
+
+    Whatever the callbacks return to be awaited is waited on before leaving the block, so a request's notifications
+    have been sent by the time it is answered.
+    """
+    scope = _Scope()
+    token = _scope.set(scope)
+    try:
+        try:
+            yield
+        except BaseException:
+            for discarded in reversed(scope.discarded):
+                discarded()
+            raise
+        finally:
+            _scope.reset(token)
+        for committed in scope.committed:
+            result = committed()
+            if result is not None:
+                await result
+    finally:
+        for ended in scope.ended:
+            ended()
+
+
+def after_commit(
+    committed: Optional[Callable[[], Optional[Awaitable]]] = None,
+    discarded: Optional[Callable[[], None]] = None,
+) -> bool:
+    """False outside a request scope, where nothing is held"""
+    scope = _scope.get()
+    if scope is None:
+        return False
+    if committed is not None:
+        scope.committed.append(committed)
+    if discarded is not None and not scope.durable:
+        scope.discarded.append(discarded)
+    return True
+
+
+def after_scope(ended: Callable[[], None]) -> bool:
+    """Runs once the block is done however it went, after what was held for the commit, False outside a scope"""
+    scope = _scope.get()
+    if scope is None:
+        return False
+    scope.ended.append(ended)
+    return True
+
+
+def mark_durable() -> None:
+    """Once the request's writes are committed nothing can throw them away, so what would undo them is dropped"""
+    scope = _scope.get()
+    if scope is not None:
+        scope.durable = True
+        scope.discarded.clear()
+
+
+def scoped_value(owner: object) -> Optional[dict]:
+    """A dict owner can keep things in until the request scope ends, None outside one"""
+    scope = _scope.get()
+    if scope is None:
+        return None
+    if owner not in scope.values:
+        scope.values[owner] = {}
+    return scope.values[owner]
@@ -0,0 +1,263 @@
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Coroutine, Iterable, Iterator, Optional
+
+from coup_clone import deck, rules, turns
+from coup_clone.actions import ACTIONS, get_action
+from coup_clone.db.games import GameRow, GameState, TurnAction, TurnState
+from coup_clone.db.players import Influence, PlayerRow, PlayerState
+from coup_clone.managers.exceptions import IllegalMoveException
+from coup_clone.models import DECK
+from coup_clone.rules import LegalMove, Move, Transition
+from coup_clone.utils import not_null
+
+MAX_STEPS = 1000
+
+
+class StalledGameException(Exception):
+    def __init__(self, game: GameRow):
+        super().__init__(f"No player can move in {game.turn_state!r} after {game.turn_action!r}")
+
+
+def _drive(effect: Coroutine[Any, Any, None]) -> None:
+    # Effects only await the in-memory players below, so they finish without an event loop
+    try:
+        effect.send(None)
+    except StopIteration:
+        return
+    effect.close()
+    raise RuntimeError("Action effects must not wait on anything when simulated")
+
+
+class _EffectPlayer:
+    def __init__(self, row: PlayerRow):
+        self.row = row
+
+    async def increment_coins(self, amount: int = 1) -> None:
+        self.row.coins += amount
+
+    async def decrement_coins(self, amount: int = 1) -> None:
+        self.row.coins -= amount
+
+
+class _EffectGame:
+    """Stands in for models.Game, with just what the effects in ACTIONS use"""
+
+    def __init__(self, game: "SimulatedGame"):
+        self.game = game
+
+    async def get_current_player(self) -> Optional[_EffectPlayer]:
+        player = self.game.players.get(self.game.row.player_turn_id or 0)
+        return _EffectPlayer(player) if player is not None else None
+
+    async def get_target_player(self) -> Optional[_EffectPlayer]:
+        player = self.game.players.get(self.game.row.target_id or 0)
+        return _EffectPlayer(player) if player is not None else None
+
+
+class Agent:
+    """Picks moves for one player, the default picks at random"""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+
+    def choose(self, game: "SimulatedGame", player: PlayerRow, moves: list[LegalMove]) -> LegalMove:
+        return self.rng.choice(moves)
+
+    def target(self, game: "SimulatedGame", player: PlayerRow, action: TurnAction) -> int:
+        return self.rng.choice([p.id for p in game.players.values() if p.id != player.id and not game.is_out(p)])
+
+    def keep(self, game: "SimulatedGame", player: PlayerRow, cards: list[Influence], n: int) -> list[Influence]:
+        return self.rng.sample(cards, n)
+
+
+class ScriptedAgent(Agent):
+    """Plays the given moves in order, then falls back to random ones"""
+
+    def __init__(self, rng: random.Random, script: Iterable[LegalMove]):
+        super().__init__(rng)
+        self.script: Iterator[LegalMove] = iter(script)
+
+    def choose(self, game: "SimulatedGame", player: PlayerRow, moves: list[LegalMove]) -> LegalMove:
+        move = next(self.script, None)
+        if move is None:
+            return super().choose(game, player, moves)
+        if move not in moves:
+            raise IllegalMoveException(move.move.value)
+        return move
+
+
+class SimulatedGame:
+    """One game held in plain rows, moved through the same transition table and row changes as GameManager"""
+
+    def __init__(self, players: int, rng: random.Random):
+        self.rng = rng
+        cards = deck.pack(c.value for c in rng.sample(DECK, k=len(DECK)))
+        self.players: dict[int, PlayerRow] = {}
+        for player_id in range(1, players + 1):
+            cards, hand = deck.draw(cards, 2)
+            self.players[player_id] = PlayerRow(
+                id=player_id,
+                game_id="simulated",
+                state=PlayerState.READY,
+                name=f"player {player_id}",
+                coins=2,
+                influence_a=hand[0],
+                influence_b=hand[1],
+                revealed_influence_a=False,
+                revealed_influence_b=False,
+                host=player_id == 1,
+                accepts_action=False,
+            )
+        self.row = GameRow(
+            id="simulated",
+            state=GameState.RUNNING,
+            deck=cards,
+            player_turn_id=1,
+            turn_action=None,
+            turn_state=TurnState.START,
+            target_id=None,
+            challenged_by_id=None,
+            blocked_by_id=None,
+            block_challenged_by_id=None,
+            turn_state_modified=None,
+            turn_state_deadline=None,
+            winner_id=None,
+        )
+        self.steps = 0
+
+    @staticmethod
+    def is_out(player: PlayerRow) -> bool:
+        return turns.is_out(player)
+
+    def legal_moves(self) -> dict[int, list[LegalMove]]:
+        moves = {}
+        for player in self.players.values():
+            legal = rules.legal_moves(self.row, player)
+            if legal:
+                moves[player.id] = legal
+        return moves
+
+    def play(self, player_id: int, move: LegalMove, agent: Agent) -> None:
+        player = self.players[player_id]
+        game = self.row
+        transition = rules.transition(game, player_id, move.move, action=move.action, influence=move.influence)
+        self.steps += 1
+        match move.move:
+            case Move.TAKE_ACTION:
+                turn_action = not_null(move.action)
+                action = get_action(turn_action)
+                target_id = agent.target(self, player, turn_action) if action.is_targetted else None
+                self._change(turns.take_action(player, turn_action, action.cost, target_id))
+                self._apply(transition)
+            case Move.ACCEPT_ACTION:
+                player.accepts_action = True
+                if turns.all_accepted(game, self.players.values()):
+                    self._apply(transition)
+            case Move.CHALLENGE:
+                self._change(turns.challenge(player, transition.next_state))
+            case Move.BLOCK:
+                self._change(turns.block(player, transition.next_state))
+            case Move.CHALLENGE_BLOCK:
+                self._change(turns.challenge_block(player, transition.next_state))
+            case Move.REVEAL:
+                influence = not_null(move.influence)
+                self._change(turns.reveal(game, player, influence, transition.proves, self.rng))
+                self._apply(transition)
+                winner = turns.winner(self.players.values())
+                if winner is not None:
+                    game.state = GameState.FINISHED
+                    game.winner_id = winner.id
+            case Move.EXCHANGE:
+                hand = turns.exchange_hand(game, player)
+                keep = agent.keep(self, player, hand, len(hand) - 2)
+                returned = list(hand)
+                for card in keep:
+                    returned.remove(card)
+                self._change(turns.exchange(game, player, keep, returned, self.rng))
+                self._apply(transition)
+            case _:
+                self._apply(transition)
+
+    def _change(self, changes: turns.Changes) -> None:
+        for name, value in changes.game.items():
+            setattr(self.row, name, value)
+        for player_id, values in changes.players.items():
+            for name, value in values.items():
+                setattr(self.players[player_id], name, value)
+
+    def _apply(self, transition: Transition) -> None:
+        if transition.resolves:
+            effect = ACTIONS[not_null(self.row.turn_action)].effect
+            if effect is not None:
+                _drive(effect(_EffectGame(self)))  # type: ignore[arg-type]
+        self._change(turns.advance(self.row, list(self.players.values()), transition.next_state))
+
+
+@dataclass
+class SimulationResult:
+    games: int = 0
+    finished: int = 0
+    stalled: int = 0
+    steps: int = 0
+    wins: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+
+    def merge(self, other: "SimulationResult") -> None:
+        self.games += other.games
+        self.finished += other.finished
+        self.stalled += other.stalled
+        self.steps += other.steps
+        self.wins.update(other.wins)
+        self.errors.update(other.errors)
+
+
+def play_game(players: int, rng: random.Random, agents: Optional[dict[int, Agent]] = None) -> SimulatedGame:
+    game = SimulatedGame(players, rng)
+    agents = agents or {}
+    while game.row.state == GameState.RUNNING:
+        if game.steps >= MAX_STEPS:
+            raise StalledGameException(game.row)
+        moves = game.legal_moves()
+        if not moves:
+            raise StalledGameException(game.row)
+        # Whoever can move gets to, in no particular order, as players would race each other to respond
+        player_id = rng.choice(list(moves))
+        agent = agents.get(player_id) or Agent(rng)
+        game.play(player_id, agent.choose(game, game.players[player_id], moves[player_id]), agent)
+    return game
+
+
+def simulate(games: int, players: int = 4, seed: int = 0) -> SimulationResult:
+    result = SimulationResult()
+    for n in range(games):
+        rng = random.Random(seed + n)
+        result.games += 1
+        try:
+            game = play_game(players, rng)
+        except StalledGameException:
+            result.stalled += 1
+            continue
+        except Exception as e:
+            result.errors[f"{e.__class__.__name__}: {e}"] += 1
+            continue
+        result.finished += 1
+        result.steps += game.steps
+        result.wins[game.row.winner_id] += 1
+    return result
+
+
+def simulate_parallel(games: int, players: int = 4, seed: int = 0, workers: Optional[int] = None) -> SimulationResult:
+    workers = workers or os.cpu_count() or 1
+    size = -(-games // workers)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(simulate, min(size, games - start), players, seed + start) for start in range(0, games, size)
+        ]
+        result = SimulationResult()
+        for future in futures:
+            result.merge(future.result())
+    return result
@@ -0,0 +1,158 @@
+import random
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Iterable, Optional
+
+from coup_clone import deck
+from coup_clone.db.games import GameRow, TurnAction, TurnState
+from coup_clone.db.players import Influence, PlayerRow
+
+
+@dataclass
+class Changes:
+    """What a move sets on the game row and on each player's row, worked out from the rows alone
+
+    GameManager writes these through the models and the simulator sets them on its rows, so a move changes a game the
+    same way in both.
+    """
+
+    game: dict[str, Any] = field(default_factory=dict)
+    players: dict[int, dict[str, Any]] = field(default_factory=dict)
+
+    def player(self, player_id: int) -> dict[str, Any]:
+        return self.players.setdefault(player_id, {})
+
+
+def is_out(player: PlayerRow) -> bool:
+    return player.revealed_influence_a and player.revealed_influence_b
+
+
+def next_player(game: GameRow, players: list[PlayerRow]) -> Optional[PlayerRow]:
+    if not players:
+        return None
+    if game.player_turn_id is None:
+        return players[0]
+    current = [p.id for p in players].index(game.player_turn_id)
+    following = players[current + 1 :] + players[: current + 1]
+    return next((p for p in following if not is_out(p)), None)
+
+
+def all_accepted(game: GameRow, players: Iterable[PlayerRow]) -> bool:
+    return all(p.accepts_action for p in players if p.id != game.player_turn_id and not is_out(p))
+
+
+def winner(players: Iterable[PlayerRow]) -> Optional[PlayerRow]:
+    remaining = [p for p in players if not is_out(p)]
+    return remaining[0] if len(remaining) == 1 else None
+
+
+def start_turn(player_id: int, players: Iterable[PlayerRow]) -> Changes:
+    changes = Changes(
+        {
+            "player_turn_id": player_id,
+            "turn_state": TurnState.START,
+            "turn_action": None,
+            "target_id": None,
+            "challenged_by_id": None,
+            "blocked_by_id": None,
+            "block_challenged_by_id": None,
+            "turn_state_modified": datetime.utcnow(),
+            "turn_state_deadline": None,
+        }
+    )
+    for player in players:
+        if player.accepts_action:
+            changes.player(player.id)["accepts_action"] = False
+    return changes
+
+
+def next_turn(game: GameRow, players: list[PlayerRow]) -> Changes:
+    player = next_player(game, players)
+    if player is None:
+        raise Exception("No next player available")
+    return start_turn(player.id, players)
+
+
+def advance(game: GameRow, players: list[PlayerRow], next_state: Optional[TurnState]) -> Changes:
+    if next_state == TurnState.TARGET_REVEALING:
+        # A target who lost their last card defending against the action has nothing left to reveal
+        target = next((p for p in players if p.id == game.target_id), None)
+        if target is None or is_out(target):
+            next_state = None
+    if next_state is None:
+        return next_turn(game, players)
+    if next_state in (TurnState.ATTEMPTED, TurnState.BLOCKED):
+        return Changes({"turn_state": next_state})
+    # Only an attempted action or a block waits on a deadline, one left over would expire the wrong state
+    return Changes({"turn_state": next_state, "turn_state_deadline": None})
+
+
+def take_action(player: PlayerRow, turn_action: TurnAction, cost: int, target_id: Optional[int]) -> Changes:
+    changes = Changes({"turn_action": turn_action, "target_id": target_id})
+    if cost > 0:
+        changes.player(player.id)["coins"] = player.coins - cost
+    return changes
+
+
+def challenge(player: PlayerRow, next_state: Optional[TurnState]) -> Changes:
+    return Changes({"turn_state": next_state, "challenged_by_id": player.id, "turn_state_deadline": None})
+
+
+def block(player: PlayerRow, next_state: Optional[TurnState]) -> Changes:
+    return Changes({"turn_state": next_state, "blocked_by_id": player.id})
+
+
+def challenge_block(player: PlayerRow, next_state: Optional[TurnState]) -> Changes:
+    return Changes({"turn_state": next_state, "block_challenged_by_id": player.id, "turn_state_deadline": None})
+
+
+def reveal(
+    game: GameRow, player: PlayerRow, influence: Influence, proves: bool, rng: Optional[random.Random] = None
+) -> Changes:
+    if player.influence_a == influence and not player.revealed_influence_a:
+        slot = "a"
+    elif player.influence_b == influence and not player.revealed_influence_b:
+        slot = "b"
+    else:
+        raise Exception("Invalid influence for reveal")
+
+    changes = Changes()
+    if proves:
+        # The card that backed the claim goes back in the deck and is replaced, the new one stays hidden
+        remaining, drawn = deck.draw(deck.put_back(game.deck, [influence], rng), 1)
+        changes.game["deck"] = remaining
+        changes.player(player.id)[f"influence_{slot}"] = drawn[0]
+    else:
+        changes.player(player.id)[f"revealed_influence_{slot}"] = True
+    return changes
+
+
+def exchange_hand(game: GameRow, player: PlayerRow) -> list[Influence]:
+    """The two cards on top of the deck and the player's hidden ones, to choose from"""
+    hand = deck.peek(game.deck, 2)
+    if not player.revealed_influence_a:
+        hand.append(player.influence_a)
+    if not player.revealed_influence_b:
+        hand.append(player.influence_b)
+    return hand
+
+
+def exchange(
+    game: GameRow,
+    player: PlayerRow,
+    keep: list[Influence],
+    returned: list[Influence],
+    rng: Optional[random.Random] = None,
+) -> Changes:
+    remaining, _ = deck.draw(game.deck, 2)
+    changes = Changes({"deck": deck.put_back(remaining, returned, rng)})
+    hidden = [
+        slot
+        for slot, revealed in (("a", player.revealed_influence_a), ("b", player.revealed_influence_b))
+        if not revealed
+    ]
+    if len(keep) != len(hidden):
+        raise Exception("Something weird has happened")
+    for slot, card in zip(hidden, keep):
+        changes.player(player.id)[f"influence_{slot}"] = card
+    return changes
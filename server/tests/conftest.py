@@ -0,0 +1,47 @@
+import random
+from typing import AsyncIterator
+
+import pytest
+from aiosqlite import Connection
+
+from coup_clone import db
+from coup_clone.db import migrations
+from coup_clone.db.players import Influence
+from coup_clone.db.writer import Writer
+from coup_clone.simulator import SimulatedGame
+
+HANDS = {
+    1: (Influence.DUKE, Influence.CAPTAIN),
+    2: (Influence.CONTESSA, Influence.AMBASSADOR),
+    3: (Influence.ASSASSIN, Influence.DUKE),
+}
+
+
+@pytest.fixture
+def game() -> SimulatedGame:
+    """Three players at the start of the first one's turn, holding the hands above"""
+    game = SimulatedGame(3, random.Random(0))
+    for player_id, (influence_a, influence_b) in HANDS.items():
+        game.players[player_id].influence_a = influence_a
+        game.players[player_id].influence_b = influence_b
+    return game
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    return str(tmp_path / "coup.db")
+
+
+@pytest.fixture
+async def conn(db_path: str) -> AsyncIterator[Connection]:
+    async with db.open(db_path) as conn:
+        await migrations.migrate(conn)
+        yield conn
+
+
+@pytest.fixture
+async def writer(conn: Connection, db_path: str) -> AsyncIterator[Writer]:
+    writer = Writer(db_path)
+    await writer.start()
+    yield writer
+    await writer.stop()
@@ -0,0 +1,66 @@
+import random
+from collections import Counter
+
+import pytest
+
+from coup_clone import deck
+from coup_clone.db.players import Influence
+from coup_clone.managers.exceptions import NotEnoughCardsException
+from coup_clone.models import DECK
+
+
+def test_pack_round_trips():
+    cards = [Influence(c) for c in DECK]
+    packed = deck.pack(cards)
+
+    assert deck.size(packed) == len(DECK) == 15
+    assert deck.unpack(packed) == cards
+    assert Counter(deck.unpack(packed)) == {i: 3 for i in Influence if i != Influence.UNKNOWN}
+
+
+def test_empty_deck():
+    assert deck.size(deck.EMPTY) == 0
+    assert deck.unpack(deck.EMPTY) == []
+    assert deck.pack([]) == deck.EMPTY
+
+
+def test_from_digits_matches_the_old_text_column():
+    assert deck.from_digits("152") == deck.pack([Influence.DUKE, Influence.CAPTAIN, Influence.AMBASSADOR])
+
+
+def test_draw_takes_from_the_top():
+    packed = deck.pack([Influence.DUKE, Influence.CAPTAIN, Influence.ASSASSIN])
+
+    remaining, drawn = deck.draw(packed, 2)
+
+    assert drawn == [Influence.ASSASSIN, Influence.CAPTAIN]
+    assert deck.unpack(remaining) == [Influence.DUKE]
+    assert deck.peek(packed, 2) == [Influence.CAPTAIN, Influence.ASSASSIN]
+
+
+def test_drawing_more_than_is_left_raises():
+    with pytest.raises(NotEnoughCardsException):
+        deck.draw(deck.pack([Influence.DUKE]), 2)
+
+
+def test_put_back_keeps_every_card():
+    rng = random.Random(0)
+    packed = deck.pack(rng.sample(DECK, k=len(DECK)))
+
+    for _ in range(100):
+        remaining, drawn = deck.draw(packed, 2)
+        assert deck.size(remaining) == 13
+        packed = deck.put_back(remaining, drawn, rng)
+        assert deck.size(packed) == 15
+        assert Counter(deck.unpack(packed)) == Counter(Influence(c) for c in DECK)
+
+
+def test_put_back_can_land_anywhere():
+    below = deck.pack([Influence.DUKE] * 4)
+
+    positions = {
+        deck.unpack(deck.put_back(below, [Influence.CONTESSA], random.Random(seed))).index(Influence.CONTESSA)
+        for seed in range(200)
+    }
+
+    assert positions == {0, 1, 2, 3, 4}
@@ -0,0 +1,135 @@
+import sqlite3
+
+import pytest
+
+from coup_clone import db, deck
+from coup_clone.db import migrations
+
+# How the database was set up before there were migrations, the tables were the same as the first migration makes
+BASELINE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS check_player_count_in_game
+    BEFORE INSERT
+    ON players
+    WHEN (SELECT COUNT(id) FROM players WHERE game_id = NEW.game_id) >= 6
+    BEGIN
+        SELECT RAISE(FAIL, "Game full");
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS clear_playerless_games_on_delete
+    AFTER DELETE
+    ON players
+    WHEN (
+        SELECT COUNT(sessions.id)
+        FROM sessions
+        JOIN players ON sessions.player_id = players.id
+        WHERE game_id = OLD.game_id
+    ) = 0
+    BEGIN
+        DELETE FROM games WHERE id = OLD.game_id;
+    END;
+    """,
+]
+
+
+@pytest.fixture
+def baseline_db(db_path: str) -> str:
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    for statement in migrations.MIGRATIONS[0].steps:
+        conn.execute(str(statement))
+    for trigger in BASELINE_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute("INSERT INTO games (id, deck) VALUES ('a', '152'), ('b', '');")
+    conn.executemany(
+        "INSERT INTO players (game_id, influence_a, influence_b) VALUES (?, 1, 2);", [("a",), ("a",), ("b",)]
+    )
+    conn.execute("INSERT INTO sessions (id, player_id) VALUES ('s1', 1), ('s2', 3), ('s3', NULL);")
+    conn.close()
+    return db_path
+
+
+async def games(conn) -> list[tuple]:
+    return list(await conn.execute_fetchall("SELECT id, deck, player_count, session_count FROM games ORDER BY id;"))
+
+
+async def test_baseline_database_is_upgraded(baseline_db):
+    async with db.open(baseline_db) as conn:
+        applied = await migrations.migrate(conn, batch_size=1)
+
+        assert [m.version for m in applied] == [1, 2, 3, 4]
+        assert await migrations.get_version(conn) == 4
+        columns = [row[1] for row in await conn.execute_fetchall("PRAGMA table_info(games);")]
+        assert "deck_digits" not in columns
+        assert await games(conn) == [
+            ("a", deck.from_digits("152"), 2, 1),
+            ("b", deck.EMPTY, 1, 1),
+        ]
+        assert await migrations.migrate(conn) == []
+
+
+async def test_replaced_triggers_keep_the_counters(baseline_db):
+    async with db.open(baseline_db) as conn:
+        await migrations.migrate(conn)
+
+        await conn.execute("DELETE FROM players WHERE id = 2;")
+        assert await games(conn) == [("a", deck.from_digits("152"), 1, 1), ("b", deck.EMPTY, 1, 1)]
+
+
+async def test_dry_run_leaves_the_database_alone(baseline_db):
+    async with db.open(baseline_db) as conn:
+        estimates = await migrations.dry_run(conn, batch_size=1)
+
+        assert [(e.migration.version, e.rows) for e in estimates] == [(1, 0), (2, 0), (3, 2), (4, 2)]
+        assert await migrations.get_version(conn) == 0
+        columns = [row[1] for row in await conn.execute_fetchall("PRAGMA table_info(games);")]
+        assert "player_count" not in columns
+
+
+async def add_player(conn, game_id: str, session_id: str) -> int:
+    cursor = await conn.execute(
+        "INSERT INTO players (game_id, influence_a, influence_b) VALUES (?, 1, 2) RETURNING id;", (game_id,)
+    )
+    player_id = (await cursor.fetchone())[0]
+    await cursor.close()
+    await conn.execute("INSERT INTO sessions (id, player_id) VALUES (?, ?);", (session_id, player_id))
+    return player_id
+
+
+async def counts(conn, game_id: str = "g") -> list[tuple]:
+    return list(await conn.execute_fetchall("SELECT player_count, session_count FROM games WHERE id = ?;", (game_id,)))
+
+
+async def test_joining_is_counted(conn):
+    await conn.execute("INSERT INTO games (id, deck) VALUES ('g', 1);")
+    for n in range(6):
+        await add_player(conn, "g", f"s{n}")
+
+    assert await counts(conn) == [(6, 6)]
+    with pytest.raises(sqlite3.IntegrityError, match="Game full"):
+        await add_player(conn, "g", "s6")
+
+
+async def test_leaving_is_counted_until_the_game_is_empty(conn):
+    await conn.execute("INSERT INTO games (id, deck) VALUES ('g', 1);")
+    first = await add_player(conn, "g", "s1")
+    await add_player(conn, "g", "s2")
+
+    await conn.execute("UPDATE sessions SET player_id = NULL WHERE id = 's2';")
+    assert await counts(conn) == [(2, 1)]
+
+    await conn.execute("DELETE FROM players WHERE id = ?;", (first,))
+    assert await counts(conn) == []
+
+
+async def test_deleting_the_last_session_deletes_the_game(conn):
+    await conn.execute("INSERT INTO games (id, deck) VALUES ('g', 1);")
+    await add_player(conn, "g", "s1")
+    await add_player(conn, "g", "s2")
+
+    await conn.execute("DELETE FROM sessions WHERE id = 's1';")
+    assert await counts(conn) == [(2, 1)]
+
+    await conn.execute("DELETE FROM sessions WHERE id = 's2';")
+    assert await counts(conn) == []
+    assert list(await conn.execute_fetchall("SELECT COUNT(*) FROM players;")) == [(0,)]
@@ -0,0 +1,197 @@
+import asyncio
+from typing import Any, Callable, Coroutine
+
+import pytest
+from aiosqlite import Connection
+
+from coup_clone import db
+from coup_clone.db.events import EventsTable
+from coup_clone.db.games import GameState
+from coup_clone.estimator import EstimatorMetrics
+from coup_clone.managers.notifications import NotificationsManager
+from coup_clone.models import Player
+from coup_clone.scope import request_scope
+from coup_clone.utils import not_null
+
+
+class Emitted:
+    """Stands in for the socket server, keeping what was emitted"""
+
+    def __init__(self) -> None:
+        self.emitted: list[tuple[str, Any, Any]] = []
+
+    async def emit(self, event: str, data: Any, to: Any) -> None:
+        self.emitted.append((event, data, to))
+
+    def of(self, event: str) -> list[Any]:
+        return [data for emitted, data, _ in self.emitted if emitted == event]
+
+    def received(self, *rooms: str) -> list[tuple[str, Any]]:
+        """What a client in rooms was sent, in order"""
+        return [
+            (event, data) for event, data, to in self.emitted if set(to if isinstance(to, list) else [to]) & set(rooms)
+        ]
+
+
+class HeldEstimator:
+    """Finishes estimates only once told to"""
+
+    enabled = True
+
+    def __init__(self) -> None:
+        self.metrics = EstimatorMetrics()
+        self.finish = asyncio.Event()
+
+    async def estimate_in_background(self, game, players) -> dict[int, float]:
+        await self.finish.wait()
+        return {p.id: round(1 / len(players), 3) for p in players}
+
+    def stop(self) -> None:
+        pass
+
+
+async def wait_until(condition: Callable[[], bool]) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("Condition never held")
+
+
+@pytest.fixture
+async def table(conn):
+    await conn.execute("INSERT INTO games (id, deck, state) VALUES ('g', 1, ?);", (GameState.RUNNING,))
+    await conn.execute("INSERT INTO players (game_id, influence_a, influence_b) VALUES ('g', 1, 2), ('g', 3, 4);")
+    await conn.execute("UPDATE games SET player_turn_id = 1;")
+    await conn.execute("INSERT INTO sessions (id, player_id) VALUES ('s1', 1), ('s2', 2);")
+    await conn.commit()
+    return conn
+
+
+async def move(conn, notifications: NotificationsManager, statement: str) -> None:
+    async with request_scope():
+        await conn.execute(statement)
+        await notifications.broadcast_game(conn, "g")
+
+
+def assert_sequential(snapshot: dict, deltas: list[dict]) -> None:
+    revision = snapshot["revision"]
+    for delta in deltas:
+        assert (delta["base_revision"], delta["revision"]) == (revision, revision + 1)
+        revision = delta["revision"]
+
+
+def assert_applies(received: list[tuple[str, Any]]) -> None:
+    """Every delta continues from the revision the client holds, as it checks before applying one"""
+    revision = None
+    for event, data in received:
+        if event == "game":
+            revision = data["revision"]
+        elif event == "game_delta" and revision is not None:
+            assert data["base_revision"] == revision
+            revision = data["revision"]
+    assert revision is not None
+
+
+async def during_a_move(
+    conn: Connection,
+    notifications: NotificationsManager,
+    monkeypatch: pytest.MonkeyPatch,
+    other: Coroutine[Any, Any, None],
+) -> None:
+    """Runs other once the move has read the latest revision, the move's request ends only after other is done"""
+    query_after = EventsTable.query_after
+    paused, go, finish = asyncio.Event(), asyncio.Event(), asyncio.Event()
+
+    async def pause(cursor, game_id, after_id):
+        if not paused.is_set():
+            paused.set()
+            await go.wait()
+        return await query_after(cursor, game_id, after_id)
+
+    async def slow_move() -> None:
+        async with request_scope():
+            await conn.execute("UPDATE players SET name = 'alice' WHERE id = 1;")
+            await conn.commit()
+            await notifications.broadcast_game(conn, "g")
+            await finish.wait()
+
+    monkeypatch.setattr(EventsTable, "query_after", staticmethod(pause))
+    moving = asyncio.create_task(slow_move())
+    await paused.wait()
+    # As far as other gets on its own, either done or waiting on the move
+    waiting = asyncio.create_task(other)
+    await asyncio.wait([waiting], timeout=0.1)
+    go.set()
+    await asyncio.wait([waiting], timeout=0.1)
+    finish.set()
+    await asyncio.gather(moving, waiting)
+    monkeypatch.setattr(EventsTable, "query_after", query_after)
+
+
+async def test_estimate_finishing_during_a_move_takes_no_revision(table, monkeypatch):
+    socket_server = Emitted()
+    estimator = HeldEstimator()
+    notifications = NotificationsManager(socket_server, estimator)  # type: ignore[arg-type]
+    await notifications.broadcast_game(table, "g")
+
+    query_after = EventsTable.query_after
+
+    async def finish_estimate_first(cursor, game_id, after_id):
+        # The move has read the latest revision and is waiting on the database when the estimate comes in
+        estimator.finish.set()
+        await wait_until(lambda: "g" in notifications.win_probabilities)
+        return await query_after(cursor, game_id, after_id)
+
+    monkeypatch.setattr(EventsTable, "query_after", staticmethod(finish_estimate_first))
+    await move(table, notifications, "UPDATE players SET name = 'alice' WHERE id = 1;")
+    monkeypatch.setattr(EventsTable, "query_after", query_after)
+    await move(table, notifications, "UPDATE games SET player_turn_id = 2;")
+    await notifications.stop()
+
+    [snapshot] = socket_server.of("game")
+    deltas = socket_server.of("game_delta")
+    assert len(deltas) == 2
+    assert_sequential(snapshot, deltas)
+    assert notifications.revisions["g"].revision == deltas[-1]["revision"]
+    assert socket_server.of("win_probabilities")[0] == {"win_probabilities": {1: 0.5, 2: 0.5}}
+
+
+async def test_resync_during_a_move_keeps_the_order_of_revisions(table, db_path, monkeypatch):
+    socket_server = Emitted()
+    notifications = NotificationsManager(socket_server)  # type: ignore[arg-type]
+    await notifications.broadcast_game(table, "g")
+
+    async def resync() -> None:
+        async with request_scope(), db.open(db_path) as conn:
+            await notifications.resync_player(conn, not_null(await Player.get(conn, 2)))
+
+    await during_a_move(table, notifications, monkeypatch, resync())
+    await move(table, notifications, "UPDATE games SET player_turn_id = 2;")
+    await notifications.stop()
+
+    assert len(socket_server.of("game_delta")) == 2
+    assert_applies(socket_server.received("g"))
+    assert_applies(socket_server.received("g", "s2"))
+
+
+async def test_join_during_a_move_keeps_the_order_of_revisions(table, db_path, monkeypatch):
+    socket_server = Emitted()
+    notifications = NotificationsManager(socket_server)  # type: ignore[arg-type]
+    await notifications.broadcast_game(table, "g")
+
+    async def join() -> None:
+        async with request_scope(), db.open(db_path) as conn:
+            await conn.execute("INSERT INTO players (game_id, influence_a, influence_b) VALUES ('g', 5, 1);")
+            await conn.execute("INSERT INTO sessions (id, player_id) VALUES ('s3', 3);")
+            await conn.commit()
+            await notifications.broadcast_game(conn, "g")
+            await notifications.notify_player(conn, not_null(await Player.get(conn, 3)))
+
+    await during_a_move(table, notifications, monkeypatch, join())
+    await move(table, notifications, "UPDATE games SET player_turn_id = 3;")
+    await notifications.stop()
+
+    assert len(socket_server.of("game_delta")) == 3
+    assert_applies(socket_server.received("g"))
+    assert_applies(socket_server.received("g", "s3"))
@@ -0,0 +1,148 @@
+from typing import Any, Optional
+
+import pytest
+
+from coup_clone import rules
+from coup_clone.actions import ACTIONS
+from coup_clone.db.games import GameState, TurnAction, TurnState
+from coup_clone.db.players import Influence
+from coup_clone.managers.exceptions import IllegalMoveException
+from coup_clone.rules import LegalMove, Move
+from coup_clone.simulator import SimulatedGame
+
+# A turn in every state, with the players who have a move to make in it
+TURNS: list[tuple[TurnState, Optional[TurnAction], dict[str, Any], set[int]]] = [
+    (TurnState.START, None, {}, {1}),
+    (TurnState.ATTEMPTED, TurnAction.FOREIGN_AID, {}, {2, 3}),
+    (TurnState.BLOCKED, TurnAction.FOREIGN_AID, {"blocked_by_id": 2}, {1, 3}),
+    (TurnState.CHALLENGED, TurnAction.TAX, {"challenged_by_id": 2}, {1}),
+    (TurnState.BLOCK_CHALLENGED, TurnAction.FOREIGN_AID, {"blocked_by_id": 3, "block_challenged_by_id": 1}, {3}),
+    (TurnState.TARGET_REVEALING, TurnAction.COUP, {"target_id": 2}, {2}),
+    (TurnState.CHALLENGER_REVEALING, TurnAction.TAX, {"challenged_by_id": 3}, {3}),
+    (
+        TurnState.BLOCK_CHALLENGER_REVEALING,
+        TurnAction.STEAL,
+        {"target_id": 2, "blocked_by_id": 2, "block_challenged_by_id": 1},
+        {1},
+    ),
+    (TurnState.EXCHANGING, TurnAction.EXCHANGE, {}, {1}),
+]
+
+CANDIDATES = [
+    (move, action, influence)
+    for move in Move
+    for action in (list(TurnAction) if move is Move.TAKE_ACTION else [None])
+    for influence in (rules.REVEALABLE if move is Move.REVEAL else [None])
+]
+
+
+def at(game: SimulatedGame, turn_state: TurnState, turn_action: Optional[TurnAction], **row: Any) -> None:
+    game.row.turn_state = turn_state
+    game.row.turn_action = turn_action
+    for field, value in row.items():
+        setattr(game.row, field, value)
+
+
+def allowed(game: SimulatedGame, player_id: int, move: Move, action: Optional[TurnAction], influence: Any) -> bool:
+    try:
+        rules.transition(game.row, player_id, move, action, influence)
+    except IllegalMoveException:
+        return False
+    return True
+
+
+def test_every_turn_state_is_covered():
+    assert {turn_state for turn_state, _, _, _ in TURNS} == set(TurnState)
+
+
+@pytest.mark.parametrize("turn_state, turn_action, row, movers", TURNS)
+def test_legal_moves_are_the_allowed_transitions(game, turn_state, turn_action, row, movers):
+    at(game, turn_state, turn_action, **row)
+
+    for player in game.players.values():
+        legal = rules.legal_moves(game.row, player)
+        hand = {player.influence_a, player.influence_b}
+        for move, action, influence in CANDIDATES:
+            expected = allowed(game, player.id, move, action, influence)
+            if move is Move.TAKE_ACTION and expected:
+                expected = ACTIONS[action].cost <= player.coins
+            if move is Move.REVEAL:
+                expected = expected and influence in hand
+            assert (LegalMove(move, action, influence) in legal) == expected, (player.id, move, action, influence)
+
+    assert {p.id for p in game.players.values() if rules.legal_moves(game.row, p)} == movers
+
+
+def test_only_the_current_player_takes_an_action(game):
+    assert rules.transition(game.row, 1, Move.TAKE_ACTION, TurnAction.INCOME).resolves
+    with pytest.raises(IllegalMoveException):
+        rules.transition(game.row, 2, Move.TAKE_ACTION, TurnAction.INCOME)
+
+
+def test_contested_action_waits_to_be_accepted(game):
+    transition = rules.transition(game.row, 1, Move.TAKE_ACTION, TurnAction.TAX)
+    assert transition.next_state == TurnState.ATTEMPTED
+    assert not transition.resolves
+    assert rules.accepted(TurnAction.TAX).resolves
+
+
+def test_unclaimed_action_cant_be_challenged(game):
+    at(game, TurnState.ATTEMPTED, TurnAction.FOREIGN_AID)
+    with pytest.raises(IllegalMoveException):
+        rules.transition(game.row, 2, Move.CHALLENGE)
+
+
+def test_only_the_target_blocks_a_targetted_action(game):
+    at(game, TurnState.ATTEMPTED, TurnAction.STEAL, target_id=3)
+    with pytest.raises(IllegalMoveException):
+        rules.transition(game.row, 2, Move.BLOCK)
+    assert rules.transition(game.row, 3, Move.BLOCK).next_state == TurnState.BLOCKED
+
+
+def test_any_opponent_blocks_an_untargetted_action(game):
+    at(game, TurnState.ATTEMPTED, TurnAction.FOREIGN_AID)
+    assert rules.transition(game.row, 2, Move.BLOCK).next_state == TurnState.BLOCKED
+    assert rules.transition(game.row, 3, Move.BLOCK).next_state == TurnState.BLOCKED
+    with pytest.raises(IllegalMoveException):
+        rules.transition(game.row, 1, Move.BLOCK)
+
+
+def test_revealing_the_claimed_card_proves_the_challenge_wrong(game):
+    at(game, TurnState.CHALLENGED, TurnAction.TAX, challenged_by_id=2)
+
+    proven = rules.transition(game.row, 1, Move.REVEAL, influence=Influence.DUKE)
+    assert (proven.next_state, proven.resolves, proven.proves) == (TurnState.CHALLENGER_REVEALING, True, True)
+
+    caught = rules.transition(game.row, 1, Move.REVEAL, influence=Influence.CAPTAIN)
+    assert (caught.next_state, caught.resolves, caught.proves) == (None, False, False)
+
+
+def test_revealing_a_blocking_card_proves_the_block_challenge_wrong(game):
+    at(game, TurnState.BLOCK_CHALLENGED, TurnAction.FOREIGN_AID, blocked_by_id=3, block_challenged_by_id=1)
+
+    proven = rules.transition(game.row, 3, Move.REVEAL, influence=Influence.DUKE)
+    assert (proven.next_state, proven.resolves, proven.proves) == (TurnState.BLOCK_CHALLENGER_REVEALING, False, True)
+
+    caught = rules.transition(game.row, 3, Move.REVEAL, influence=Influence.ASSASSIN)
+    assert (caught.next_state, caught.resolves, caught.proves) == (None, True, False)
+
+
+def test_ten_coins_must_coup(game):
+    game.players[1].coins = 10
+    assert rules.legal_moves(game.row, game.players[1]) == [LegalMove(Move.TAKE_ACTION, TurnAction.COUP)]
+
+
+def test_accepted_action_isnt_offered_again(game):
+    at(game, TurnState.ATTEMPTED, TurnAction.TAX)
+    game.players[2].accepts_action = True
+    assert LegalMove(Move.ACCEPT_ACTION) not in rules.legal_moves(game.row, game.players[2])
+    assert LegalMove(Move.ACCEPT_ACTION) in rules.legal_moves(game.row, game.players[3])
+
+
+def test_no_moves_outside_a_running_game_or_once_out(game):
+    game.players[1].revealed_influence_a = True
+    game.players[1].revealed_influence_b = True
+    assert rules.legal_moves(game.row, game.players[1]) == []
+
+    game.row.state = GameState.FINISHED
+    assert rules.legal_moves(game.row, game.players[2]) == []
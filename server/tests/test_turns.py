@@ -0,0 +1,63 @@
+from coup_clone import rules, turns
+from coup_clone.actions import ACTIONS
+from coup_clone.db.games import TurnAction, TurnState
+from coup_clone.rules import Move
+from coup_clone.simulator import SimulatedGame, simulate
+
+
+def challenger_revealing(game: SimulatedGame, turn_action: TurnAction) -> None:
+    game.row.turn_action = turn_action
+    game.row.turn_state = TurnState.CHALLENGER_REVEALING
+    game.row.target_id = 3
+    game.row.challenged_by_id = 2
+
+
+def test_steal_takes_a_target():
+    assert ACTIONS[TurnAction.STEAL].is_targetted
+
+
+def test_challenger_reveal_passes_the_turn_after_a_resolved_action(game):
+    challenger_revealing(game, TurnAction.STEAL)
+
+    transition = rules.transition(game.row, 2, Move.REVEAL, influence=game.players[2].influence_a)
+    changes = turns.advance(game.row, list(game.players.values()), transition.next_state)
+
+    assert transition.next_state is None
+    assert changes.game["player_turn_id"] == 2
+    assert changes.game["turn_state"] == TurnState.START
+
+
+def test_challenger_reveal_leads_on_to_the_target_revealing(game):
+    challenger_revealing(game, TurnAction.ASSASSINATE)
+
+    transition = rules.transition(game.row, 2, Move.REVEAL, influence=game.players[2].influence_a)
+
+    assert transition.next_state == TurnState.TARGET_REVEALING
+
+
+def test_target_reveal_passes_the_turn(game):
+    challenger_revealing(game, TurnAction.ASSASSINATE)
+    game.row.turn_state = TurnState.TARGET_REVEALING
+
+    transition = rules.transition(game.row, 3, Move.REVEAL, influence=game.players[3].influence_b)
+
+    assert transition.next_state is None
+
+
+def test_target_already_out_is_skipped(game):
+    challenger_revealing(game, TurnAction.ASSASSINATE)
+    game.players[3].revealed_influence_a = True
+    game.players[3].revealed_influence_b = True
+
+    changes = turns.advance(game.row, list(game.players.values()), TurnState.TARGET_REVEALING)
+
+    assert changes.game["turn_state"] == TurnState.START
+    assert changes.game["player_turn_id"] == 2
+
+
+def test_random_games_all_finish():
+    result = simulate(200, players=4, seed=0)
+
+    assert result.finished == 200
+    assert result.stalled == 0
+    assert not result.errors
@@ -0,0 +1,81 @@
+import pytest
+
+from coup_clone.db import reuse_cursor
+from coup_clone.db.events import EventsTable
+from coup_clone.db.games import GamesTable, GameState
+from coup_clone.db.players import PlayersTable
+from coup_clone.db.table import UnitOfWork
+from coup_clone.scope import request_scope
+
+
+async def create_game(conn):
+    async with reuse_cursor(conn) as cursor:
+        game = await GamesTable.create(cursor, id="game", deck=1)
+        player = await PlayersTable.create(cursor, game_id=game.id, influence_a=1, influence_b=2)
+    return game, player
+
+
+async def test_changes_to_a_row_are_one_update(conn):
+    game, player = await create_game(conn)
+
+    async with request_scope():
+        work = UnitOfWork.of(conn)
+        work.record(PlayersTable, player, coins=3)
+        work.record(PlayersTable, player, coins=5, name="alice")
+        work.record(GamesTable, game, state=GameState.RUNNING)
+        assert UnitOfWork.of(conn) is work
+        async with reuse_cursor(conn) as cursor:
+            await UnitOfWork.finish(conn).flush(cursor)
+
+    assert (work.updates, work.statements) == (3, 2)
+    assert work.statements_saved == 4
+    assert list(await conn.execute_fetchall("SELECT coins, name FROM players;")) == [(5, "alice")]
+    assert list(await conn.execute_fetchall("SELECT state FROM games;")) == [(GameState.RUNNING,)]
+
+
+async def test_appended_rows_are_one_insert(conn):
+    await create_game(conn)
+
+    async with request_scope():
+        work = UnitOfWork.of(conn)
+        for message in ("one", "two", "three"):
+            work.append(EventsTable, game_id="game", message=message)
+        async with reuse_cursor(conn) as cursor:
+            await UnitOfWork.finish(conn).flush(cursor)
+
+    assert (work.appended, work.statements) == (3, 1)
+    assert [r[0] for r in await conn.execute_fetchall("SELECT message FROM events ORDER BY id;")] == [
+        "one",
+        "two",
+        "three",
+    ]
+
+
+async def test_deferred_changes_are_left_out(conn):
+    game, player = await create_game(conn)
+
+    async with request_scope():
+        work = UnitOfWork.of(conn)
+        work.record(PlayersTable, player, coins=5)
+        work.record(GamesTable, game, state=GameState.RUNNING)
+        assert work.defer((GamesTable, game.id)) == {"state": GameState.RUNNING}
+        async with reuse_cursor(conn) as cursor:
+            await UnitOfWork.finish(conn).flush(cursor)
+
+    assert (work.statements, work.deferred) == (1, 1)
+    assert list(await conn.execute_fetchall("SELECT state FROM games;")) == [(GameState.LOBBY,)]
+
+
+async def test_unfinished_work_ends_with_its_scope(conn):
+    _, player = await create_game(conn)
+
+    async with request_scope():
+        UnitOfWork.of(conn).record(PlayersTable, player, coins=5)
+
+    async with request_scope():
+        assert UnitOfWork.finish(conn).rows == {}
+
+
+async def test_rows_change_only_inside_a_scope(conn):
+    with pytest.raises(RuntimeError):
+        UnitOfWork.of(conn)
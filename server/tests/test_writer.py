@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from aiosqlite import Connection
+
+from coup_clone.db import reuse_cursor
+from coup_clone.db.sessions import SessionsTable
+from coup_clone.db.writer import Writer
+
+
+def insert_session(session_id: str, fail: bool = False):
+    async def run(conn: Connection) -> str:
+        async with reuse_cursor(conn) as cursor:
+            await SessionsTable.create(cursor, id=session_id)
+        if fail:
+            raise ValueError(session_id)
+        return session_id
+
+    return run
+
+
+async def session_ids(conn: Connection) -> list[str]:
+    return [row[0] for row in await conn.execute_fetchall("SELECT id FROM sessions ORDER BY id;")]
+
+
+async def test_failed_job_is_rolled_back_alone(conn, writer):
+    results = await asyncio.gather(
+        writer.submit(insert_session("a")),
+        writer.submit(insert_session("b", fail=True)),
+        writer.submit(insert_session("c")),
+        return_exceptions=True,
+    )
+
+    assert results[0] == "a"
+    assert isinstance(results[1], ValueError)
+    assert results[2] == "c"
+    assert writer.metrics.commits == 1
+    assert writer.metrics.largest_batch == 3
+    assert writer.metrics.failed_jobs == 1
+    assert await session_ids(conn) == ["a", "c"]
+
+
+async def test_batch_continues_after_a_failed_job(conn, writer):
+    with pytest.raises(ValueError):
+        await writer.submit(insert_session("a", fail=True))
+
+    assert await writer.submit(insert_session("a")) == "a"
+    assert await session_ids(conn) == ["a"]
+
+
+async def test_failed_commit_fails_every_job_in_the_batch(conn, writer):
+    async def fail_commit(conn: Connection) -> None:
+        # Deferred until the commit, which then fails for the whole batch
+        await conn.execute("PRAGMA defer_foreign_keys = ON;")
+        await conn.execute("INSERT INTO sessions (id, player_id) VALUES ('orphan', 1000);")
+
+    results = await asyncio.gather(
+        writer.submit(insert_session("a")),
+        writer.submit(fail_commit),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(r, Exception) for r in results)
+    assert writer.metrics.failed_commits == 1
+    assert await session_ids(conn) == []
+
+
+async def test_submit_needs_a_running_writer(db_path):
+    with pytest.raises(RuntimeError):
+        await Writer(db_path).submit(insert_session("a"))